@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+The code is copyright of Vishal Saxena, 2022 and permission and license is 
+required to reuse this code.
+
+BTU characterization with the vectorized sip.btu_transfer: the theta sweep of
+BTU_char_v1.py and a full phiU x phiL map, each in a single call.
+
+@author: vsaxena
+"""
+#%matplotlib inline
+
+###############################################################################
+## Imports
+###############################################################################
+import numpy as np
+import sys
+import time
+import matplotlib.pyplot as plt
+
+# setting path
+sys.path.append('../siroap_libs/')
+
+# Import local library
+import sip_library as sip
+
+
+###############################################################################
+btu_loss    = 0.25 # dB
+ng          = 4.24 # group index
+neff        = 2.34 # effective index
+wl0         = 1.5e-6    # Wavelength
+btu_length  = 750e-6    # BTU effective optical length
+phi_offset  = np.pi*0.05  # Random offset in the BTU, See ISSCC 2023 paper for definition
+
+# Characterization Parameters
+num_theta = 1000
+num_map = 500 # phiU x phiL map points per axis
+
+###############################################################################
+btu = sip.BTU(phiU=0, phiL=0, phi_offset=phi_offset, neff=neff, ng=ng, wl0=wl0,
+              length=btu_length, loss=btu_loss, trainable=False)
+
+# Transfer curve: phiU = theta, phiL = -theta as in BTU_char_v1.py
+theta_range = np.linspace(0, np.pi, num_theta, endpoint=False)
+t0 = time.perf_counter()
+curve = sip.btu_transfer(btu, theta_range, -theta_range)
+t_curve = time.perf_counter() - t0
+d1 = curve['bar'][:, 0]
+d2 = curve['cross'][:, 0]
+
+print("Transfer curve: %i points in %.2f ms" % (num_theta, 1e3*t_curve))
+print("Extinction ratio: bar %.1f dB, cross %.1f dB"
+      % (sip.extinction_ratio(d1), sip.extinction_ratio(d2)))
+
+fig1 = plt.figure()
+plt.plot(theta_range/np.pi, d1, label='bar')
+plt.plot(theta_range/np.pi, d2, label='cross')
+plt.ylabel('Transmission (a.u.)')
+plt.xlabel('Theta/pi, rad')
+plt.legend(loc='lower right')
+plt.show()
+
+# 2D map over phiU x phiL
+phi = np.linspace(0, 2*np.pi, num_map)
+t0 = time.perf_counter()
+phase_map = sip.btu_transfer(btu, phi[:, None], phi[None, :])
+t_map = time.perf_counter() - t0
+print("phiU x phiL map: %i points in %.2f ms" % (num_map**2, 1e3*t_map))
+
+fig2 = plt.figure()
+plt.imshow(sip.dB10(phase_map['bar'][:, :, 0]), origin='lower',
+           extent=[0, 2, 0, 2], vmin=-40, vmax=0)
+plt.colorbar(label='Bar transmission, dB')
+plt.xlabel('phiL/pi, rad')
+plt.ylabel('phiU/pi, rad')
+plt.show()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the adaptive sweep (siroap_sweep.adaptive_sweep) of the
+terminated APF2, CROW2 and CROW3 meshes against a uniform sweep of 1001
+points and against a uniform sweep with as many points as the adaptive
+one. All are linearly interpolated (in dB) onto a dense reference
+sweep of the sparse solver, the error is the largest deviation over all
+detectors down to the floor of the adaptive sweep.
+
+The adaptive sweep is checked to stay within tol of the reference wherever
+the reference is 10 dB above the floor (closer to it, the clipping at the
+floor bends the response), and to keep to max_points. Capped at max_cap
+points, it has to be at least as accurate as the uniform sweep of the same
+size.
+
+@author: vsaxena
+"""
+
+###############################################################################
+## Imports
+###############################################################################
+import numpy as np
+import sys
+import time
+
+# setting path
+sys.path.append('../siroap_libs/')
+
+# Import local library
+import siroap_solvers as solvers
+import siroap_sweep as sweep
+
+from bench_designs import APF2, CROW2, CROW3, build_mesh, GHz, fc
+
+###############################################################################
+# Simualation Parameters
+fmin = fc + GHz*10
+fmax = fc + GHz*21
+size = 1001
+size_ref = 20001
+tol = 0.1 # dB
+floor = -60 # dB
+max_cap = 201 # max_points of the capped sweep
+designs = {'APF2': APF2, 'CROW2': CROW2, 'CROW3': CROW3}
+
+
+def dB(power):
+    return 10*np.log10(np.maximum(power, 10**(floor/10)))
+
+
+def get_error(f, det, f_ref, det_ref, margin=None):
+    """ largest deviation [dB] of the interpolated sweep from the reference,
+    where the reference is margin [dB] above the floor (if given) """
+    error = np.array([np.interp(f_ref, f, dB(det[:, d])) - dB(det_ref[:, d]) for d in range(det.shape[1])])
+    if margin is not None:
+        error = error[dB(det_ref.T) > floor + margin]
+    return np.abs(error).max()
+
+
+print("%8s %12s %8s %10s %14s" % ("design", "sweep", "#points", "time [s]", "max error [dB]"))
+for name, design in designs.items():
+    mesh = build_mesh(design)
+    solver = solvers.SparseMeshSolver(mesh, design['src_list'], design['det_list'])
+    f_ref = np.linspace(fmin, fmax, size_ref)
+    det_ref = np.concatenate([det for _, det in sweep.sweep(solver, f_ref, chunk_size=2000)])
+
+    net = mesh.terminate(design['src_list'], design['det_list'])
+    t0 = time.perf_counter()
+    f = np.linspace(fmin, fmax, size)
+    det = np.concatenate([det for _, det in sweep.sweep(net, f)])
+    t_uniform = time.perf_counter() - t0
+    print("%8s %12s %8i %10.2f %14.3f" % (name, "uniform", len(f), t_uniform,
+                                        get_error(f, det, f_ref, det_ref)))
+
+    t0 = time.perf_counter()
+    f, det = sweep.adaptive_sweep(net, fmin, fmax, tol=tol, floor=floor)
+    t_adaptive = time.perf_counter() - t0
+    print("%8s %12s %8i %10.2f %14.3f" % (name, "adaptive", len(f), t_adaptive,
+                                        get_error(f, det, f_ref, det_ref)))
+    assert get_error(f, det, f_ref, det_ref, margin=10) <= tol
+    assert len(f) <= 1001 # default max_points
+
+    # the point cap: the budget goes to the worst intervals, the capped
+    # sweep is not worse than a uniform one of the same size
+    f_cap, det_cap = sweep.adaptive_sweep(net, fmin, fmax, tol=tol, max_points=max_cap, floor=floor)
+    assert len(f_cap) <= max_cap
+    f_u = np.linspace(fmin, fmax, len(f_cap))
+    det_u = np.concatenate([det for _, det in sweep.sweep(net, f_u)])
+    error_cap = get_error(f_cap, det_cap, f_ref, det_ref, margin=10)
+    error_u = get_error(f_u, det_u, f_ref, det_ref, margin=10)
+    print("%8s %12s %8i %10s %14.3f" % (name, "capped", len(f_cap), "-",
+                                        get_error(f_cap, det_cap, f_ref, det_ref)))
+    print("%8s %12s %8i %10s %14.3f" % (name, "uniform", len(f_u), "-",
+                                        get_error(f_u, det_u, f_ref, det_ref)))
+    assert error_cap <= error_u
+
+    f = np.linspace(fmin, fmax, len(f))
+    det = np.concatenate([det for _, det in sweep.sweep(net, f)])
+    print("%8s %12s %8i %10s %14.3f" % (name, "uniform", len(f), "-",
+                                        get_error(f, det, f_ref, det_ref)))
+
+# at least the initial grid is simulated
+try:
+    sweep.adaptive_sweep(net, fmin, fmax, num_initial=33, max_points=20)
+except ValueError:
+    pass
+else:
+    raise AssertionError("num_initial > max_points accepted")
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of a batched parameter sweep (SqrMesh_NxM.forward_batch) over a
+kappa x phi grid of the APF2 design, against a loop of set_state,
+initialize and forward calls on the terminated photontorch network.
+
+@author: vsaxena
+"""
+
+###############################################################################
+## Imports
+###############################################################################
+import numpy as np
+import sys
+import time
+
+import torch
+import photontorch as pt
+
+# setting path
+sys.path.append('../siroap_libs/')
+
+# Import local library
+from bench_designs import APF2, build_mesh, GHz, fc
+
+###############################################################################
+# Simualation Parameters
+size = 51
+fmin = 10 # GHz
+fmax = 21 # GHz
+kappas = np.linspace(0.2, 0.5, 40)
+phis = np.linspace(0, 0.2, 25)
+num_loop = 20 # configurations timed with the photontorch loop
+
+env = pt.Environment(f=fc + GHz*np.linspace(fmin, fmax, size), freqdomain=True)
+pt.set_environment(env)
+
+src_list, det_list = APF2['src_list'], APF2['det_list']
+mesh = build_mesh(APF2)
+mesh_dicts = [{'H1_1': ['coupler', kappa], 'H3_1': ['coupler', kappa],
+               'V0_2': ['phase_shifter_bar', phi], 'V3_2': ['phase_shifter_bar', -phi]}
+              for kappa in kappas for phi in phis]
+
+t0 = time.perf_counter()
+phiU, phiL = mesh.get_config_batch(mesh_dicts)
+P_batch = mesh.forward_batch(phiU, phiL, src_list, det_list)
+t_batch = time.perf_counter() - t0
+
+net = mesh.terminate(src_list, det_list)
+P_loop = []
+with torch.no_grad():
+    t0 = time.perf_counter()
+    for mesh_dict in mesh_dicts[:num_loop]:
+        for key, state in mesh_dict.items():
+            mesh.set_state(key, state)
+        net.initialize()
+        P_loop.append(net(source=1))
+    t_loop = (time.perf_counter() - t0) * len(mesh_dicts) / num_loop
+
+error = max(float((P - P_batch[i]).abs().max()) for i, P in enumerate(P_loop))
+print("%i configurations x %i frequencies" % (len(mesh_dicts), size))
+print("%12s %12s %10s %12s" % ("loop [s]", "batch [s]", "speedup", "max error"))
+print("%12.2f %12.2f %10.1f %12.2e" % (t_loop, t_batch, t_loop/t_batch, error))
+assert error < 1e-4 # photontorch simulates in float32
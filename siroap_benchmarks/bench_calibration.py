@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the phi_offset calibration engine (siroap_calibration) on
+a simulated chip with random phase offsets: the APF2 design on the 4x4
+mesh, with its monitor taps and outputs as detectors, and a 7x4 array of
+weak (1%) couplers fed from all west ports and read at all other edge
+ports. Compared are the coordinate descent with concurrent sweeps, the
+same with one BTU per sweep, and the batched gradient estimation from
+random probe configurations.
+
+In the APF2 configuration most BTUs are in the cross state and get no
+light, so their offsets cannot be calibrated in it. They are known
+(from the calibration of other configurations) in the first APF2 case,
+while in the second case they are zero in the model: their leakage then
+limits the accuracy of the observable offsets. Every method has to
+converge, to the offsets of the chip within max_error of the case.
+
+The error is taken modulo 2*pi, a shift by 2*pi only changes the sign of
+the S-matrix of a BTU.
+
+A mesh without observable BTUs is checked to return a non-converged
+result without measuring.
+
+@author: vsaxena
+"""
+
+###############################################################################
+## Imports
+###############################################################################
+import numpy as np
+import sys
+import time
+
+# setting path
+sys.path.append('../siroap_libs/')
+
+# Import local library
+import siroap_library as siroap
+import siroap_calibration as calibration
+
+from bench_designs import APF2, build_mesh, btu_factory1
+
+###############################################################################
+# Simualation Parameters
+sigma = 0.3 # rms phase offset [rad]
+rng = np.random.default_rng(1)
+
+
+def build_array():
+    """ 7x4 array of 1% couplers """
+    mesh = siroap.SqrMesh_NxM(7, 4, btu_factory1)
+    for key in mesh.components.keys():
+        mesh.set_state(key, ['coupler', np.sqrt(0.99)])
+    return mesh
+
+# max_error [rad]: the leakage of the unknown dark BTUs biases the fit
+APF2_dark = {'build': lambda: build_mesh(APF2), 'src_list': APF2['src_list'],
+             'det_list': APF2['det_list'], 'known': True, 'max_error': 1e-6}
+cases = {'APF2 4x4': APF2_dark,
+         'APF2 4x4, dark unknown': dict(APF2_dark, known=False, max_error=0.15),
+         'array 7x4': {'build': build_array, 'src_list': list(range(14)),
+                       'det_list': list(range(14, 44)), 'known': False, 'max_error': 1e-6}}
+methods = {'sweep, concurrent': ('sweep', 0.05),
+           'sweep, sequential': ('sweep', None),
+           'gradient': ('gradient', 0.05)}
+
+print("%23s %18s %5s %7s %8s %7s %9s %10s %10s %10s" % (
+    "mesh", "method", "#btus", "#rounds", "#measure", "passes", "time [s]",
+    "max error", "residual", "converged"))
+for case, design in cases.items():
+    mesh = design['build']()
+    phi_offset = rng.normal(0, sigma, len(mesh.components))
+    chip = calibration.SimulatedChip(mesh, design['src_list'], design['det_list'], phi_offset)
+    for name, (method, overlap) in methods.items():
+        model = design['build']()
+        engine = calibration.MeshCalibration(model, chip, design['src_list'], design['det_list'],
+                                             overlap=overlap)
+        if design['known']:
+            # the offsets of the BTUs without light are known
+            phiU, phiL = model.get_config_batch([{}])
+            observable = engine.get_schedule(phiU[0], phiL[0], np.zeros(len(phi_offset)))[0]
+            for k, btu in enumerate(model.components.values()):
+                btu.phi_offset.data.fill_(0 if observable[k] else phi_offset[k])
+        chip.num_measurements = 0
+        t0 = time.perf_counter()
+        report = engine.run(method=method, seed=0)
+        t_run = time.perf_counter() - t0
+
+        keys = list(model.components.keys())
+        index = [keys.index(key) for key in report['observable']]
+        error = np.angle(np.exp(1j*(report['phi_offset'][index] - phi_offset[index])))
+        rounds = "%i" % len(report['rounds']) if method == 'sweep' else "-"
+        print("%23s %18s %5i %7s %8i %7i %9.2f %10.2e %10.2e %10s" % (
+            case, name, len(index), rounds, chip.num_measurements,
+            report['passes'], t_run, np.abs(error).max(), report['residual'], report['converged']))
+        assert report['converged'] and np.abs(error).max() < design['max_error']
+
+# no observable BTU (no power change reaches tol): nothing is measured
+mesh = build_mesh(APF2)
+chip = calibration.SimulatedChip(mesh, APF2['src_list'], APF2['det_list'], np.zeros(len(mesh.components)))
+for method in ['sweep', 'gradient']:
+    chip.num_measurements = 0
+    engine = calibration.MeshCalibration(mesh, chip, APF2['src_list'], APF2['det_list'], tol=2)
+    report = engine.run(method=method)
+    assert not report['converged'] and report['observable'] == [] and chip.num_measurements == 0
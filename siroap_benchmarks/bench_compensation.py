@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the thermal crosstalk compensation (siroap_thermal): heater
+phases for a batch of random target configurations from the cached LU
+factorization of I + X, against a sparse solve with a new factorization
+for every configuration. The nonlinear heater model uses the chord
+iteration on the same factorization.
+
+@author: vsaxena
+"""
+
+###############################################################################
+## Imports
+###############################################################################
+import numpy as np
+import sys
+import time
+
+import torch
+import scipy.sparse as sparse
+import scipy.sparse.linalg as splinalg
+
+# setting path
+sys.path.append('../siroap_libs/')
+
+# Import local library
+import siroap_library as siroap
+import siroap_thermal as thermal
+
+from bench_designs import btu_factory1
+
+###############################################################################
+mesh_sizes = [4, 8, 16, 32]
+num_configs = 100
+
+
+def heat(phi):
+    """ heater with a superlinear heat(phase) """
+    return phi + 0.05*phi**2
+
+
+print("%8s %8s %14s %14s %14s %14s %10s" % ("mesh", "#btus", "per config [s]", "factorize [s]",
+      "cached [s]", "nonlinear [s]", "max error"))
+for N in mesh_sizes:
+    mesh = siroap.SqrMesh_NxM(N, N, btu_factory1)
+    K = len(mesh.components)
+    targetU = torch.rand(num_configs, K, dtype=torch.float64)*2*np.pi
+    targetL = torch.rand(num_configs, K, dtype=torch.float64)*2*np.pi
+
+    # a new factorization for every configuration
+    model = thermal.ThermalCrosstalk(mesh)
+    A = (sparse.identity(2*K) + model.get_matrix()).tocsc()
+    t0 = time.perf_counter()
+    ref = np.stack([splinalg.spsolve(A, np.concatenate([targetU[n], targetL[n]]))
+                    for n in range(num_configs)])
+    t_loop = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    model.get_factorization()
+    t_factorize = time.perf_counter() - t0
+    model.compensate(targetU[:1], targetL[:1]) # warm up
+    t0 = time.perf_counter()
+    phiU, phiL = model.compensate(targetU, targetL)
+    t_cached = time.perf_counter() - t0
+    error = np.abs(torch.cat([phiU, phiL], -1).numpy() - ref).max()
+
+    nonlinear = thermal.ThermalCrosstalk(mesh, heat=heat)
+    nonlinear.get_factorization()
+    t0 = time.perf_counter()
+    phiU, phiL = nonlinear.compensate(targetU, targetL)
+    t_nonlinear = time.perf_counter() - t0
+    effU, effL = nonlinear.apply(phiU, phiL)
+    error = max(error, (effU - targetU).abs().max().item(), (effL - targetL).abs().max().item())
+    print("%8s %8i %14.2e %14.2e %14.2e %14.2e %10.2e" % ('%ix%i' % (N, N), K, t_loop, t_factorize,
+          t_cached, t_nonlinear, error))
+    assert error < 1e-8
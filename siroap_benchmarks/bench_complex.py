@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Numerical equivalence and timing of the native complex path
+(get_S_complex, sip.btu_S_complex and siroap_solvers.ComplexMeshSolver)
+against the real/imag split path of photontorch. Every comparison is
+asserted: the photontorch S-matrices and network are computed in float32,
+so they are compared at float32 accuracy, the complex128 solver against the
+float64 sparse solver at double accuracy.
+
+@author: vsaxena
+"""
+
+###############################################################################
+## Imports
+###############################################################################
+import numpy as np
+import sys
+import time
+
+import torch
+import photontorch as pt
+
+# setting path
+sys.path.append('../siroap_libs/')
+
+# Import local library
+import sip_library as sip
+import siroap_solvers as solvers
+
+from bench_designs import designs, build_mesh, GHz, fc
+from bench_designs import neff, ng, wl0, btu_length, btu_loss
+
+###############################################################################
+# Simualation Parameters
+size = 1001
+fmin = 10 # GHz
+fmax = 21 # GHz
+
+env = pt.Environment(f=fc + GHz*np.linspace(fmin, fmax, size), freqdomain=True)
+pt.set_environment(env)
+
+###############################################################################
+## Components: set_S (real|imag) against get_S_complex
+###############################################################################
+components = [
+    sip.BTU(phiU=0.3, phiL=1.1, phi_offset=0.2, loss=0.25, apply_loss=True),
+    sip.Waveguide(length=750e-6, loss=2.5, phase=0.4),
+    sip.DirectionalCoupler(coupling=0.3),
+]
+print("%20s %12s" % ("component", "max error"))
+with torch.no_grad():
+    for comp in components:
+        S = torch.zeros(2, size, comp.num_ports, comp.num_ports, dtype=torch.float64)
+        comp.set_S(S)
+        S_complex = comp.get_S_complex()
+        error = (torch.complex(S[0], S[1]) - S_complex).abs().max()
+        print("%20s %12.2e" % (type(comp).__name__, error))
+        np.testing.assert_allclose(S_complex.numpy(), torch.complex(S[0], S[1]).numpy(),
+                                   rtol=0, atol=1e-6, err_msg=type(comp).__name__)
+
+###############################################################################
+## Mesh solve
+###############################################################################
+print()
+print("%8s %16s %12s %12s %14s" % ("design", "solver", "time [s]", "vs pt", "vs sparse"))
+for name, design in designs.items():
+    mesh = build_mesh(design)
+    src_list, det_list = design['src_list'], design['det_list']
+
+    net = mesh.terminate(src_list, det_list)
+    with torch.no_grad():
+        t0 = time.perf_counter()
+        P_pt = net(source=1)
+        t_pt = time.perf_counter() - t0
+    H_sparse = solvers.SparseMeshSolver(mesh, src_list, det_list).solve()
+    P_sparse = np.abs(H_sparse.sum(2))**2
+
+    print("%8s %16s %12.3f %12s %14.2e" % (
+        name, "photontorch", t_pt, "-", np.abs(P_pt[0, :, :, 0].numpy() - P_sparse).max()))
+    np.testing.assert_allclose(P_pt[0, :, :, 0].numpy(), P_sparse, rtol=0, atol=1e-4)
+    for dtype in [torch.complex128, torch.complex64]:
+        solver = solvers.ComplexMeshSolver(mesh, src_list, det_list, dtype=dtype)
+        with torch.no_grad():
+            t0 = time.perf_counter()
+            P = solver.forward(source=1)
+            t = time.perf_counter() - t0
+        P_solve = np.abs(solver.solve().sum(2))**2
+        print("%8s %16s %12.3f %12.2e %14.2e" % (
+            name, str(dtype).split('.')[1], t, (P - P_pt).abs().max(),
+            np.abs(P_solve - P_sparse).max()))
+        atol = 1e-12 if dtype == torch.complex128 else 1e-4
+        np.testing.assert_allclose(P.numpy(), P_pt.numpy(), rtol=0, atol=1e-4)
+        np.testing.assert_allclose(P_solve, P_sparse, rtol=0, atol=atol)
+
+###############################################################################
+## Gradient of the detected power against finite differences
+###############################################################################
+def btu_factory_trainable():
+    return sip.BTU(phiU=0, phiL=0, phi_offset=0, neff=neff, ng=ng, wl0=wl0,
+                   length=btu_length, loss=btu_loss, trainable=True)
+
+design = designs['APF2']
+mesh = build_mesh(design, btu_factory_trainable)
+solver = solvers.ComplexMeshSolver(mesh, design['src_list'], design['det_list'])
+wl = env.wl[::100]
+btu = mesh.components['H4_1']
+with torch.enable_grad(): # the environment disables gradients by default
+    solver.forward(source=1, wl=wl)[0, :, 0, 0].sum().backward()
+grad = btu.phiU.grad.item()
+
+h = 1e-6
+sparse = solvers.SparseMeshSolver(mesh, design['src_list'], design['det_list'])
+with torch.no_grad():
+    btu.phiU += h
+    p_plus = (np.abs(sparse.solve(wl).sum(2)[:, 0])**2).sum()
+    btu.phiU -= 2*h
+    p_minus = (np.abs(sparse.solve(wl).sum(2)[:, 0])**2).sum()
+    btu.phiU += h
+print()
+print("d(sum P_%s)/d(phiU of H4_1): autograd %.6f, finite difference %.6f"
+      % (solver.detector_names[0], grad, (p_plus - p_minus)/(2*h)))
+np.testing.assert_allclose(grad, (p_plus - p_minus)/(2*h), rtol=1e-5, atol=1e-6)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the assembly time of SqrMesh_NxM from 4x4 to 64x64: the
+index-based construction against building the same network from parsed
+connection strings (pt.Network with SqrMesh_NxM.get_connections, the
+former construction path). The BTUs are shared by both, so only the
+connection matrix and port order are timed.
+
+Every case runs in its own process for its peak resident memory
+(ru_maxrss). The dense photontorch connection matrix C of the network
+takes 4*(4*#btus)^2 bytes, which limits the largest meshes on small
+machines. The index-built reference network for the C and port order
+check is only kept up to compare_sizes, so the larger meshes are timed
+with a single network in memory.
+
+@author: vsaxena
+"""
+
+###############################################################################
+## Imports
+###############################################################################
+import gc
+import resource
+import subprocess
+import sys
+import time
+
+import photontorch as pt
+
+# setting path
+sys.path.append('../siroap_libs/')
+
+# Import local library
+import siroap_library as siroap
+
+from bench_designs import btu_factory1
+
+###############################################################################
+mesh_sizes = [4, 8, 16, 32, 64]
+compare_sizes = [4, 8, 16] # C and port_order checked against the string path
+
+
+def run(mode, N):
+    # the BTUs are built once, only the assembly of the network is timed
+    keys = ["V%i_%i" % (i, j) for i in range(N) for j in range(N+1)] \
+        + ["H%i_%i" % (i, j) for i in range(N+1) for j in range(N)] # creation order
+    ref = None
+    if mode == 'strings' or N in compare_sizes:
+        ref = siroap.SqrMesh_NxM(N, N, btu_factory1)
+        components, connections = dict(ref.components), ref.get_connections()
+        btus = iter([ref.components[key] for key in keys])
+        if N not in compare_sizes:
+            # only the timed network (and its dense C) stays in memory
+            del ref
+            gc.collect()
+            ref = None
+    else:
+        btus = iter([btu_factory1() for key in keys])
+    t0 = time.perf_counter()
+    if mode == 'strings':
+        mesh = pt.Network(components, connections)
+    else:
+        mesh = siroap.SqrMesh_NxM(N, N, lambda: next(btus))
+    t = time.perf_counter() - t0
+    if ref is not None:
+        assert (ref.C == mesh.C).all() and (ref.port_order == mesh.port_order).all()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024 # MB on linux
+    print("%8s %8s %8i %10.3f %14.0f" % (mode, '%ix%i' % (N, N), len(mesh.components), t, peak))
+
+
+if len(sys.argv) == 3:
+    run(sys.argv[1], int(sys.argv[2]))
+else:
+    print("%8s %8s %8s %10s %14s" % ("mode", "mesh", "#btus", "time [s]", "peak RSS [MB]"))
+    for N in mesh_sizes:
+        for mode in ['index', 'strings']:
+            if subprocess.run([sys.executable, __file__, mode, str(N)]).returncode:
+                print("%8s %8s %8s %10s %14s" % (mode, '%ix%i' % (N, N), '-', "failed", "-")) # out of memory
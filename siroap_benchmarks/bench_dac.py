@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the DAC heater model (siroap_dac): a batch of random
+variants of the APF2 design is converted to DAC write vectors with the
+vectorized per-heater LUTs, against np.interp per heater and
+configuration, and simulated in DAC-code space against the phase-space
+batch solve (the difference is the quantization of the DACs). With a
+thermal crosstalk model attached, the write vectors are decoded again and
+their effective phases are checked against the targets.
+
+@author: vsaxena
+"""
+
+###############################################################################
+## Imports
+###############################################################################
+import numpy as np
+import sys
+import time
+
+import torch
+import photontorch as pt
+
+# setting path
+sys.path.append('../siroap_libs/')
+
+# Import local library
+import siroap_library as siroap
+import siroap_dac as dac
+import siroap_thermal as thermal
+
+from bench_designs import APF2, build_mesh, btu_factory1, GHz, fc
+
+###############################################################################
+# Simualation Parameters
+size = 101
+fmin = 10 # GHz
+fmax = 21 # GHz
+num_configs = 2000
+rng = np.random.default_rng(0)
+
+
+def loop_codes(model, phiU, phiL):
+    """ reference: np.interp of the inverse LUT per heater and configuration """
+    phi = np.concatenate([phiU, phiL], -1)
+    codes = np.zeros(phi.shape, dtype=np.int64)
+    lut_codes, lut_phases = model.codes.numpy(), model.phases.numpy()
+    for n in range(phi.shape[0]):
+        for h in range(phi.shape[1]):
+            p = lut_phases[h, 0] + (phi[n, h] - lut_phases[h, 0]) % (2*np.pi)
+            codes[n, h] = np.round(np.interp(p, lut_phases[h], lut_codes))
+    return codes
+
+
+# random variants of the APF2 design
+mesh_dicts = []
+for n in range(num_configs):
+    mesh_dict = dict(APF2['mesh_dict'])
+    for key in ['H1_1', 'H3_1']:
+        mesh_dict[key] = ['coupler', rng.uniform(0.2, 0.5)]
+    phi = rng.uniform(-0.2, 0.2)
+    mesh_dict['V0_2'] = ['phase_shifter_bar', phi]
+    mesh_dict['V3_2'] = ['phase_shifter_bar', -phi]
+    mesh_dicts.append(mesh_dict)
+
+mesh = build_mesh(APF2)
+model = dac.HeaterDAC(mesh, phase_max=2.5*np.pi*(1 + 0.05*rng.standard_normal(2*len(mesh.components))))
+
+t0 = time.perf_counter()
+codes = model.get_codes(mesh_dicts)
+t_dicts = time.perf_counter() - t0
+phiU, phiL = mesh.get_config_batch(mesh_dicts)
+t0 = time.perf_counter()
+model.to_codes(phiU, phiL)
+t_codes = time.perf_counter() - t0
+t0 = time.perf_counter()
+ref = loop_codes(model, phiU.numpy(), phiL.numpy())
+t_loop = time.perf_counter() - t0
+print("%i APF2 mesh_dicts to DAC codes in %.3f s" % (num_configs, t_dicts))
+print("phases to DAC codes: %.4f s vectorized, %.3f s per heater (%.0fx), max code difference %i"
+      % (t_codes, t_loop, t_loop/t_codes, np.abs(codes - ref).max()))
+np.testing.assert_array_equal(codes, ref)
+
+# a heater phase moves by at most half a code step in the quantization
+half_step = 0.5*(model.phases.diff()/model.codes.diff()).max().item()
+
+# round trip of the phases, modulo 2*pi
+qU, qL = model.to_phases(codes)
+error = np.angle(np.exp(1j*(torch.cat([qU, qL], -1) - torch.cat([phiU, phiL], -1)).numpy()))
+print("phase quantization error: rms %.2e, max %.2e rad" % (np.sqrt((error**2).mean()), np.abs(error).max()))
+assert np.abs(error).max() <= half_step
+
+# round trip with thermal crosstalk: codes -> phases -> effective phases
+hot = build_mesh(APF2)
+hot.thermal = thermal.ThermalCrosstalk(hot)
+hot_model = dac.HeaterDAC(hot, phase_max=model.phases[:, -1])
+t0 = time.perf_counter()
+hot_codes = hot_model.get_codes(mesh_dicts)
+t_hot = time.perf_counter() - t0
+params = hot.get_btu_params()
+targetU, targetL = hot.get_config_batch(mesh_dicts, *hot.get_effective_phases(
+    params['phiU'].double(), params['phiL'].double()))
+effU, effL = hot.get_effective_phases(*hot_model.to_phases(hot_codes))
+error = np.angle(np.exp(1j*(torch.cat([effU, effL], -1) - torch.cat([targetU, targetL], -1)).numpy()))
+# every heater adds its quantization error times its coupling
+bound = half_step*(1 + abs(hot.thermal.get_matrix()).sum(1).max())
+print("with thermal crosstalk: %i mesh_dicts in %.3f s, effective phase error max %.2e rad (bound %.2e)"
+      % (num_configs, t_hot, np.abs(error).max(), bound))
+assert np.abs(error).max() <= bound
+
+# large mesh, random phases
+for N in [8, 16, 32]:
+    big = siroap.SqrMesh_NxM(N, N, btu_factory1)
+    big_model = dac.HeaterDAC(big)
+    phiU = torch.rand(num_configs, len(big.components), dtype=torch.float64)*2*np.pi
+    phiL = torch.rand(num_configs, len(big.components), dtype=torch.float64)*2*np.pi
+    t0 = time.perf_counter()
+    big_codes = big_model.to_codes(phiU, phiL)
+    t_to = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    big_model.to_phases(big_codes)
+    t_from = time.perf_counter() - t0
+    print("%ix%i: %i write vectors of %i codes, to_codes %.3f s, to_phases %.3f s"
+          % (N, N, num_configs, big_model.num_heaters, t_to, t_from))
+
+# simulation in DAC-code space
+f = fc + GHz*np.linspace(fmin, fmax, size)
+with pt.Environment(f=f, freqdomain=True):
+    t0 = time.perf_counter()
+    det_codes = model.forward_codes(codes[:200], APF2['src_list'], APF2['det_list'])
+    t_sim = time.perf_counter() - t0
+    phiU, phiL = mesh.get_config_batch(mesh_dicts[:200])
+    det = mesh.forward_batch(phiU, phiL, APF2['src_list'], APF2['det_list'])
+print("200 configurations simulated from DAC codes in %.3f s, max power error from "
+      "quantization %.2e" % (t_sim, (det_codes - det).abs().max().item()))
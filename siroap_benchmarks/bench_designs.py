@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Filter designs of siroap_designs/ used by the benchmark scripts.
+
+Only the BTUs that are not in the 'cross' state are listed, all other BTUs
+keep the cross state of the BTU factory.
+
+@author: vsaxena
+"""
+import numpy as np
+import sys
+
+# setting path
+sys.path.append('../siroap_libs/')
+
+# Import local library
+import sip_library as sip
+import siroap_library as siroap
+
+
+###############################################################################
+c           = 3e8 # speed of light
+btu_loss    = 0.25 # dB
+ng          = 4.24 # group index
+neff        = 2.34 # effective index
+wl0         = 1.55e-6
+btu_length  = 750e-6
+
+GHz = 1e9
+fc = (c/(ng*wl0))  # reference frequency
+
+N = 4
+M = 4
+
+def btu_factory1():
+    return sip.BTU(phiU=0,phiL=0,phi_offset=0,neff=neff,ng=ng,wl0=wl0,length=btu_length, loss=btu_loss, trainable=False)
+
+###############################################################################
+## SqMesh_4x4_APF2_v1.py
+###############################################################################
+kappa_splitter = np.sqrt(0.5)
+kappa       = 0.3412 # Coupling coefficients
+phi         = 0.0665 # Phase shifts in the rings
+kappa_drop  = float(1/100) # Drop port kappa, 1% monitor tap
+beta        = 3.1 # quadrature bias
+
+APF2 = {'src_list': [2],
+        'det_list': [10, 16, 23, 29],
+        'mesh_dict': {'V0_1': ['bar'],
+                      'V0_2': ['phase_shifter_bar', phi],
+                      'V1_1': ['phase_shifter_cross', beta],
+                      'V2_1': ['phase_shifter_cross', 0],
+                      'V3_1': ['bar'],
+                      'V3_2': ['phase_shifter_bar', -phi],
+                      'H0_1': ['coupler', kappa_drop],
+                      'H1_1': ['coupler', kappa],
+                      'H2_0': ['coupler', kappa_splitter],
+                      'H2_2': ['coupler', kappa_splitter],
+                      'H3_1': ['coupler', kappa],
+                      'H4_1': ['coupler', kappa_drop],
+                      }}
+
+###############################################################################
+## SqMesh_4x4_Crow2_v1.py
+###############################################################################
+CROW2 = {'src_list': [30],
+         'det_list': [31, 5],
+         'mesh_dict': {'V0_0': ['phase_shifter_bar', 0],
+                       'V0_1': ['bar'],
+                       'V1_0': ['phase_shifter_bar', 0],
+                       'V1_1': ['bar'],
+                       'H0_0': ['coupler', 0.36],
+                       'H1_0': ['coupler', 0.0685],
+                       'H2_0': ['coupler', 0.36],
+                       }}
+
+###############################################################################
+## SqMesh_4x4_Crow3_v1.py
+###############################################################################
+CROW3 = {'src_list': [30],
+         'det_list': [31, 11],
+         'mesh_dict': {'V0_0': ['phase_shifter_bar', -6.04904],
+                       'V0_1': ['bar'],
+                       'V1_0': ['phase_shifter_bar', -0.06557],
+                       'V1_1': ['bar'],
+                       'V2_0': ['phase_shifter_bar', -6.04904],
+                       'V2_1': ['bar'],
+                       'H0_0': ['coupler', 0.36],
+                       'H1_0': ['coupler', 0.0685],
+                       'H2_0': ['coupler', 0.0685],
+                       'H3_0': ['coupler', 0.36],
+                       }}
+
+designs = {'APF2': APF2, 'CROW2': CROW2, 'CROW3': CROW3}
+
+
+def build_mesh(design, btu_factory=btu_factory1):
+    """ unterminated 4x4 mesh configured with the mesh_dict of a design """
+    mesh = siroap.SqrMesh_NxM(N, M, btu_factory)
+    for key in design['mesh_dict'].keys():
+        mesh.set_state(key, design['mesh_dict'][key])
+    return mesh
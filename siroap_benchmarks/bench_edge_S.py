@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the full edge-port S-matrix (SqrMesh_NxM.get_edge_S) against
+characterizing the mesh with one terminate/forward cycle per source port.
+
+@author: vsaxena
+"""
+
+###############################################################################
+## Imports
+###############################################################################
+import numpy as np
+import sys
+import time
+
+import torch
+import photontorch as pt
+
+# setting path
+sys.path.append('../siroap_libs/')
+
+# Import local library
+import siroap_solvers as solvers
+
+from bench_designs import APF2, build_mesh, GHz, fc, N, M
+
+###############################################################################
+# Simualation Parameters
+size = 101
+fmin = 10 # GHz
+fmax = 21 # GHz
+
+env = pt.Environment(f=fc + GHz*np.linspace(fmin, fmax, size), freqdomain=True)
+pt.set_environment(env)
+
+mesh = build_mesh(APF2)
+ports = list(range(4*(N + M)))
+
+t0 = time.perf_counter()
+S = mesh.get_edge_S()
+t_edge = time.perf_counter() - t0
+
+# one photontorch run per source, all other edge ports detected
+error = 0
+t0 = time.perf_counter()
+with torch.no_grad():
+    for src in ports:
+        det_list = [p for p in ports if p != src]
+        P = mesh.terminate([src], det_list)(source=1)
+        error = max(error, (P - solvers.edge_S_forward(S, [src], det_list)).abs().max().item())
+t_loop = time.perf_counter() - t0
+
+print("%i edge ports, %i frequencies" % (len(ports), size))
+print("%16s %16s %10s %12s" % ("per source [s]", "get_edge_S [s]", "speedup", "max error"))
+print("%16.2f %16.3f %10.1f %12.2e" % (t_loop, t_edge, t_loop/t_edge, error))
+assert error < 1e-4 # photontorch simulates in float32
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the environment cache (sip.get_phi0): the per-component
+set_S calls of all BTUs and of as many waveguides, as repeated by every
+initialize() during tuning, with the cache (after) and with a cache that
+is rebuilt on every lookup (before).
+
+@author: vsaxena
+"""
+
+###############################################################################
+## Imports
+###############################################################################
+import numpy as np
+import sys
+import time
+
+import torch
+import photontorch as pt
+
+# setting path
+sys.path.append('../siroap_libs/')
+
+# Import local library
+import sip_library as sip
+import siroap_library as siroap
+
+from bench_designs import btu_factory1, GHz, fc
+
+
+###############################################################################
+# Simualation Parameters
+size = 1001
+fmin = 10 # GHz
+fmax = 21 # GHz
+repeats = 5
+
+mesh_sizes = [4, 8, 16]
+
+env = pt.Environment(f=fc + GHz*np.linspace(fmin, fmax, size), freqdomain=True)
+pt.set_environment(env)
+
+
+def timeit(func):
+    func() # warm-up
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    return (time.perf_counter() - t0) / repeats
+
+
+def set_S_all(components, S):
+    """ the per-component work of initialize(): one set_S per component """
+    def func():
+        for comp in components:
+            comp.set_S(S[comp.num_ports])
+    return func
+
+
+get_env_cache = sip.get_env_cache
+with torch.no_grad():
+    print("%8s %8s %14s %14s %10s" % ("mesh", "#btus", "before [ms]", "after [ms]", "speedup"))
+    for N in mesh_sizes:
+        mesh = siroap.SqrMesh_NxM(N, N, btu_factory1)
+        components = list(mesh.components.values())
+        components += [sip.Waveguide(length=750e-6, ng=4.24) for _ in components]
+        S = {n: torch.zeros(2, size, n, n) for n in [2, 4]}
+
+        sip.get_env_cache = lambda env=None: {}
+        t_before = timeit(set_S_all(components, S))
+
+        sip.get_env_cache = get_env_cache
+        t_after = timeit(set_S_all(components, S))
+
+        print("%8s %8i %14.2f %14.2f %10.1f" % (
+            "%ix%i" % (N, N), len(mesh.components), 1e3*t_before, 1e3*t_after, t_before/t_after))
+
+        # the cached terms give the same S-matrices
+        for comp in components[::N]:
+            S_before, S_after = torch.zeros_like(S[comp.num_ports]), torch.zeros_like(S[comp.num_ports])
+            sip.get_env_cache = lambda env=None: {}
+            comp.set_S(S_before)
+            sip.get_env_cache = get_env_cache
+            comp.set_S(S_after)
+            np.testing.assert_array_equal(S_after.numpy(), S_before.numpy())
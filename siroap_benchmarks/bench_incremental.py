@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the low-rank incremental re-solve (IncrementalMeshSolver)
+against a full sparse re-solve after every single BTU change, as in a
+coordinate-descent tuning loop at a few monitor wavelengths. A chain of
+updates, which keeps returning to the BTU next to the source and runs
+past max_updates, is first checked against a full re-solve after every
+step.
+
+@author: vsaxena
+"""
+
+###############################################################################
+## Imports
+###############################################################################
+import numpy as np
+import sys
+import time
+
+# setting path
+sys.path.append('../siroap_libs/')
+
+# Import local library
+import siroap_library as siroap
+import siroap_solvers as solvers
+
+from bench_designs import btu_factory1, GHz, fc, c
+
+
+###############################################################################
+# Simualation Parameters
+num_steps = 200
+num_check = 40 # chained updates checked against a full re-solve
+mesh_sizes = [4, 8, 16]
+wl = c/(fc + GHz*np.array([12.0, 15.5, 19.0])) # monitor wavelengths
+
+src_list = [2]
+print("%8s %8s %16s %16s %10s %12s" % (
+    "mesh", "#ports", "full [ms/step]", "incr [ms/step]", "speedup", "max error"))
+for N in mesh_sizes:
+    det_list = [i for i in range(8*N) if i not in src_list]
+    mesh = siroap.SqrMesh_NxM(N, N, btu_factory1)
+    rng = np.random.default_rng(0)
+    keys = list(mesh.components)
+    steps = [(rng.choice(keys), rng.random()) for _ in range(num_steps)]
+
+    incr = solvers.IncrementalMeshSolver(mesh, src_list, det_list, wl=wl)
+    full = solvers.SparseMeshSolver(mesh, src_list, det_list)
+
+    # chained updates, every third one of the BTU that feeds the source
+    src_key = keys[incr.btus[incr.sources[0, 0]//4]]
+    for n in range(num_check):
+        key = src_key if n % 3 == 0 else rng.choice(keys)
+        incr.set_state(key, ['coupler', rng.random()])
+        np.testing.assert_allclose(incr.solve(), full.solve(wl), rtol=0, atol=1e-12,
+                                   err_msg="update %i (%s)" % (n, key))
+
+    t0 = time.perf_counter()
+    for key, kappa in steps:
+        incr.set_state(key, ['coupler', kappa])
+        H_incr = incr.solve()
+    t_incr = (time.perf_counter() - t0)/num_steps
+
+    t0 = time.perf_counter()
+    for key, kappa in steps:
+        mesh.set_state(key, ['coupler', kappa])
+        H_full = full.solve(wl)
+    t_full = (time.perf_counter() - t0)/num_steps
+
+    np.testing.assert_allclose(H_incr, H_full, rtol=0, atol=1e-12)
+    print("%8s %8i %16.3f %16.3f %10.1f %12.2e" % (
+        "%ix%i" % (N, N), incr.num_ports, 1e3*t_full, 1e3*t_incr,
+        t_full/t_incr, np.abs(H_incr - H_full).max()))
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the adjoint Jacobian (SqrMesh_NxM.get_jacobian) of all
+detector powers to the phiU/phiL/phi_offset of all BTUs, against central
+finite differences with the sparse solver and against one autograd
+backward pass through siroap_solvers.ComplexMeshSolver (which only gives
+the gradient of a single scalar).
+
+@author: vsaxena
+"""
+
+###############################################################################
+## Imports
+###############################################################################
+import numpy as np
+import sys
+import time
+
+import torch
+import photontorch as pt
+
+# setting path
+sys.path.append('../siroap_libs/')
+
+# Import local library
+import sip_library as sip
+import siroap_solvers as solvers
+
+from bench_designs import APF2, build_mesh, GHz, fc
+from bench_designs import neff, ng, wl0, btu_length, btu_loss
+
+###############################################################################
+# Simualation Parameters
+size = 1001
+fmin = 10 # GHz
+fmax = 21 # GHz
+h = 1e-6 # finite difference step
+
+env = pt.Environment(f=fc + GHz*np.linspace(fmin, fmax, size), freqdomain=True)
+pt.set_environment(env)
+
+
+def btu_factory_trainable():
+    return sip.BTU(phiU=0, phiL=0, phi_offset=0, neff=neff, ng=ng, wl0=wl0,
+                   length=btu_length, loss=btu_loss, trainable=True)
+
+src_list, det_list = APF2['src_list'], APF2['det_list']
+mesh = build_mesh(APF2, btu_factory_trainable)
+names = ['phiU', 'phiL', 'phi_offset']
+
+t0 = time.perf_counter()
+J = mesh.get_jacobian(src_list, det_list)
+t_adjoint = time.perf_counter() - t0
+
+# central finite differences: two sparse solves per parameter
+solver = solvers.SparseMeshSolver(mesh, src_list, det_list)
+error = 0
+t0 = time.perf_counter()
+with torch.no_grad():
+    for k, btu in enumerate(mesh.components.values()):
+        for name in names:
+            param = getattr(btu, name)
+            param += h
+            P_plus = np.abs(solver.solve().sum(2))**2
+            param -= 2*h
+            P_minus = np.abs(solver.solve().sum(2))**2
+            param += h
+            error = max(error, np.abs((P_plus - P_minus)/(2*h) - J[name][:, :, k]).max())
+t_fd = time.perf_counter() - t0
+
+# autograd: gradient of the total detected power only
+t0 = time.perf_counter()
+with torch.enable_grad(): # the environment disables gradients by default
+    solvers.ComplexMeshSolver(mesh, src_list, det_list).forward().double().sum().backward()
+t_autograd = time.perf_counter() - t0
+grad = np.array([[getattr(btu, name).grad.item() for btu in mesh.components.values()]
+                 for name in names])
+error_autograd = np.abs(grad - np.array([J[name].sum((0, 1)) for name in names])).max()
+
+print("%i frequencies, %i detectors, %i BTU parameters" % (size, len(det_list), 3*len(mesh.components)))
+print("%34s %10s %12s" % ("method", "time [s]", "max error"))
+print("%34s %10.2f %12s" % ("adjoint, full Jacobian", t_adjoint, "-"))
+print("%34s %10.2f %12.2e" % ("finite differences, full Jacobian", t_fd, error))
+print("%34s %10.2f %12.2e" % ("autograd, gradient of sum(P)", t_autograd, error_autograd))
+assert error < 1e-7 and error_autograd < 1e-10
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of SqrMesh_NxM.initialize() with the per-BTU set_S path of the
+baseline (before) and the vectorized mesh-level set_S path (after), which
+must give the same S-matrix.
+
+The unterminated mesh is initialized, which evaluates the S-matrices of all
+BTUs but skips the network reduction, so the timing isolates the
+per-component cost.
+
+@author: vsaxena
+"""
+
+###############################################################################
+## Imports
+###############################################################################
+import numpy as np
+import sys
+import time
+
+import torch
+import photontorch as pt
+
+# setting path
+sys.path.append('../siroap_libs/')
+
+# Import local library
+import sip_library as sip
+import siroap_library as siroap
+
+
+###############################################################################
+c           = 3e8 # speed of light
+ng          = 4.24 # group index
+wl0         = 1.55e-6
+
+# Simualation Parameters
+GHz = 1e9
+size = 11 # the dense network S-matrix grows as size*(#ports)^2
+fmin = 10 # GHz
+fmax = 21 # GHz
+repeats = 5
+
+mesh_sizes = [4, 8, 16]
+
+###############################################################################
+freq = GHz*np.linspace(fmin, fmax, size) # frequency offset points
+fc = (c/(ng*wl0))                             # reference frequency
+env = pt.Environment(f=fc + freq, freqdomain=True)
+pt.set_environment(env)
+
+
+def timeit(func):
+    func() # warm-up
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    return (time.perf_counter() - t0) / repeats
+
+
+def baseline_btu_set_S(self, S):
+    """ BTU.set_S of the baseline, evaluated once per BTU """
+    wls = torch.tensor(self.env.wl, dtype=torch.float64, device=self.device)
+    phiA = (self.phiU + self.phiL)/2
+    phiD = (self.phiU - self.phiL)/2 + self.phi_offset/2
+    neff = self.neff - (wls - self.wl0) * (self.ng - self.neff) / self.wl0
+    phi0 = (2 * np.pi * neff * self.length / wls) % (2 * np.pi)
+    phiC = phi0 + phiA
+    cos_phiC = torch.cos(phiC).to(torch.get_default_dtype())
+    sin_phiC = torch.sin(phiC).to(torch.get_default_dtype())
+    cos_phiD = torch.cos(phiD).to(torch.get_default_dtype())
+    sin_phiD = torch.sin(phiD).to(torch.get_default_dtype())
+    S[0, :, 0, 1] = S[0, :, 1, 0] = -sin_phiC * sin_phiD
+    S[1, :, 0, 1] = S[1, :, 1, 0] = cos_phiC * sin_phiD
+    S[0, :, 0, 2] = S[0, :, 2, 0] = -sin_phiC * cos_phiD
+    S[1, :, 0, 2] = S[1, :, 2, 0] = cos_phiC * cos_phiD
+    S[0, :, 3, 1] = S[0, :, 1, 3] = -sin_phiC * cos_phiD
+    S[1, :, 3, 1] = S[1, :, 1, 3] = cos_phiC * cos_phiD
+    S[0, :, 3, 2] = S[0, :, 2, 3] = sin_phiC * sin_phiD
+    S[1, :, 3, 2] = S[1, :, 2, 3] = -cos_phiC * sin_phiD
+    # the returned lossy S-matrix is ignored by photontorch
+    return S * 10 ** (-self.loss / 20)
+
+
+def initialize_baseline(mesh):
+    """ the baseline path: pt.Network.set_S with one baseline BTU.set_S per BTU """
+    set_S = sip.BTU.set_S
+    sip.BTU.set_S = baseline_btu_set_S
+    mesh.set_S = pt.Network.set_S.__get__(mesh)
+    try:
+        mesh.initialize()
+    finally:
+        sip.BTU.set_S = set_S
+        del mesh.set_S
+
+
+rng = np.random.default_rng(0)
+with torch.no_grad():
+    print("%8s %8s %14s %14s %10s %12s" % ("mesh", "#btus", "before [ms]", "after [ms]", "speedup", "max error"))
+    for N in mesh_sizes:
+        mesh = siroap.SqrMesh_NxM(N, N)
+        num_btus = len(mesh.components)
+        for btu in mesh.components.values():
+            btu.phiU.fill_(rng.uniform(0, 2*np.pi))
+            btu.phiL.fill_(rng.uniform(0, 2*np.pi))
+            btu.phi_offset.fill_(rng.normal(0, 0.1))
+
+        t_after = timeit(mesh.initialize)
+        S_after = mesh.S.clone()
+
+        t_before = timeit(lambda: initialize_baseline(mesh))
+        S_before = mesh.S.clone()
+
+        error = float((S_after - S_before).abs().max())
+        # the baseline rounds cos and sin to the default dtype before the products
+        np.testing.assert_allclose(S_after.numpy(), S_before.numpy(), rtol=0, atol=1e-6)
+        print("%8s %8i %14.2f %14.2f %10.1f %12.2e" % (
+            "%ix%i" % (N, N), num_btus, 1e3*t_before, 1e3*t_after, t_before/t_after, error))
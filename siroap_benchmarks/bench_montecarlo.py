@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the batched Monte Carlo analysis (siroap_montecarlo) of the
+APF2 design: random phase offsets, losses and coupler imbalances of all
+BTUs, solved in chunks of stacked samples, against solving one sample at
+a time with the sparse solver after setting the BTU parameters (without
+coupler imbalance, which the BTUs do not model), and the statistics of
+the notch filter at p23 over the samples. The BTUs apply their loss, so
+that the loss variations are around the nominal BTU loss.
+
+The full sparse system (reduce=False) has to match the loop exactly. The
+default dense solve of the reduced system loses the light leaked by the
+pruned and collapsed BTUs, which is bounded by max_leak, and has to be at
+least min_speedup times faster than the loop.
+
+@author: vsaxena
+"""
+
+###############################################################################
+## Imports
+###############################################################################
+import numpy as np
+import sys
+import time
+
+import torch
+import photontorch as pt
+
+# setting path
+sys.path.append('../siroap_libs/')
+
+# Import local library
+import siroap_montecarlo as montecarlo
+import siroap_solvers as solvers
+
+from bench_designs import APF2, build_mesh, btu_factory1, GHz, fc
+
+###############################################################################
+# Simualation Parameters
+size = 201
+fmin = 10 # GHz
+fmax = 21 # GHz
+num_samples = 2000
+num_loop = 20 # samples of the one-at-a-time reference
+passband = [(fc + GHz*fmin, fc + GHz*13), (fc + GHz*18, fc + GHz*fmax)]
+stopband = (fc + GHz*15.2, fc + GHz*15.6)
+max_ripple = 1.0 # dB
+min_rejection = 5.0 # dB
+max_leak = 0.02 # field error of the reduced system
+min_speedup = 5
+
+env = pt.Environment(f=fc + GHz*np.linspace(fmin, fmax, size), freqdomain=True)
+pt.set_environment(env)
+
+def btu_factory():
+    """ BTUs of the designs with their loss in the S-matrix """
+    btu = btu_factory1()
+    btu.apply_loss = True
+    return btu
+
+src_list, det_list = APF2['src_list'], APF2['det_list']
+mesh = build_mesh(APF2, btu_factory)
+
+# reference: one sparse solve per sample, without coupler imbalance
+mc = montecarlo.MonteCarloAnalysis(mesh, src_list, det_list, sigma_split=0, seed=0, reduce=False)
+samples = mc.draw(num_loop)
+solver = solvers.SparseMeshSolver(mesh, src_list, det_list)
+btus = list(mesh.components.values())
+nominal = [(btu.phi_offset.item(), btu.loss) for btu in btus]
+H_loop = np.zeros((num_loop, size, len(det_list), len(src_list)), dtype=np.complex128)
+t0 = time.perf_counter()
+with torch.no_grad():
+    for n in range(num_loop):
+        for k, btu in enumerate(btus):
+            btu.phi_offset.fill_(samples['phi_offset'][n, k])
+            btu.loss = float(samples['loss'][n, k])
+        H_loop[n] = solver.solve()
+t_loop = (time.perf_counter() - t0)/num_loop
+for btu, (phi_offset, loss) in zip(btus, nominal):
+    btu.phi_offset.fill_(phi_offset)
+    btu.loss = loss
+error = np.abs(mc.solve(samples) - H_loop).max()
+mc = montecarlo.MonteCarloAnalysis(mesh, src_list, det_list, sigma_split=0, seed=0)
+leak = np.abs(mc.solve(samples) - H_loop).max()
+
+print("%i BTUs, %i frequencies, max error against the loop: full %.2e, reduced (%i ports) %.2e"
+      % (len(btus), size, error, mc.solver.num_ports, leak))
+assert error < 1e-12 and leak < max_leak
+print("%8s %12s %10s %14s %8s" % ("system", "max_points", "time [s]", "time/sample", "speedup"))
+print("%8s %12s %10.2f %14.2e %8s" % ("loop", "-", t_loop*num_samples, t_loop, "-"))
+for reduce, max_points in [(False, 2**14), (True, 2**12), (True, 2**14), (True, 2**16)]:
+    mc = montecarlo.MonteCarloAnalysis(mesh, src_list, det_list, max_points=max_points, seed=0,
+                                       reduce=reduce)
+    t0 = time.perf_counter()
+    result = mc.run(num_samples, passband=passband, stopband=stopband)
+    t_batch = time.perf_counter() - t0
+    speedup = t_loop*num_samples/t_batch
+    print("%8s %12i %10.2f %14.2e %8.1f" % ("reduced" if reduce else "full", max_points, t_batch,
+                                            t_batch/num_samples, speedup))
+    assert speedup > min_speedup or not reduce
+
+# statistics of the notch at p23
+d = det_list.index(23)
+print("\n%i samples, p23: sigma_phi %.2f rad, sigma_loss %.2f dB, sigma_split %.2f" % (
+    num_samples, mc.sigma_phi, mc.sigma_loss, mc.sigma_split))
+print("%16s %9s %9s %9s %9s %9s %9s" % ("figure [dB]", "nominal", "mean", "std", "p5", "p50", "p95"))
+for name in ['ripple', 'insertion_loss', 'rejection']:
+    stats = mc.get_statistics(result[name][:, d])
+    print("%16s %9.2f %9.2f %9.2f %9.2f %9.2f %9.2f" % (
+        name, result['nominal'][name][d], stats['mean'], stats['std'], stats['p5'], stats['p50'], stats['p95']))
+passed = (result['ripple'][:, d] < max_ripple) & (result['rejection'][:, d] > min_rejection)
+print("yield (ripple < %.1f dB, rejection > %.1f dB): %.1f%%" % (max_ripple, min_rejection, 100*passed.mean()))
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the process-pool sweep runner (siroap_sweep.parallel_sweep)
+on a frequency sweep and a configuration sweep of the terminated APF2
+mesh, for an increasing number of worker processes.
+
+@author: vsaxena
+"""
+
+###############################################################################
+## Imports
+###############################################################################
+import numpy as np
+import os
+import sys
+import time
+
+# setting path
+sys.path.append('../siroap_libs/')
+
+# Import local library
+import siroap_sweep as sweep
+
+from bench_designs import APF2, build_mesh, GHz, fc
+
+###############################################################################
+# Simualation Parameters
+size = 2000
+fmin = 10 # GHz
+fmax = 21 # GHz
+kappas = np.linspace(0.2, 0.5, 32)
+max_workers = os.cpu_count()
+
+
+def build_apf2():
+    """ worker model: the terminated APF2 mesh """
+    return build_mesh(APF2).terminate(APF2['src_list'], APF2['det_list'])
+
+
+if __name__ == '__main__':
+    f = fc + GHz*np.linspace(fmin, fmax, size)
+    configs = [{'H1_1': ['coupler', kappa], 'H3_1': ['coupler', kappa]} for kappa in kappas]
+    num_workers = [1] + [n for n in [2, 4, 8, 16, 32] if n <= max_workers]
+
+    print("%d cores" % max_workers)
+    print("%10s %10s %14s %12s %16s %12s" % (
+        "#workers", "freq [s]", "freq speedup", "configs [s]", "configs speedup", "max error"))
+    for n in num_workers:
+        t0 = time.perf_counter()
+        det = sweep.parallel_sweep(build_apf2, f, num_workers=n)
+        t_freq = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        det_configs = sweep.parallel_sweep(build_apf2, f[::20], configs, num_workers=n)
+        t_configs = time.perf_counter() - t0
+
+        if n == 1:
+            t_freq1, t_configs1, det1, det_configs1 = t_freq, t_configs, det, det_configs
+        error = max(np.abs(det - det1).max(), np.abs(det_configs - det_configs1).max())
+        print("%10i %10.2f %14.1f %12.2f %16.1f %12.2e" % (
+            n, t_freq, t_freq1/t_freq, t_configs, t_configs1/t_configs, error))
+        assert error < 1e-12
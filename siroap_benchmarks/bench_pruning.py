@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the reachability pruning (SqrMesh_NxM.get_active_btus) on a
+large mesh with a sparse configuration: a few random couplers and bar
+states in an otherwise cross-state mesh, without and with thermal
+crosstalk. With crosstalk, the pruned terminated APF2 network is checked
+against the sparse solver as well.
+
+@author: vsaxena
+"""
+
+###############################################################################
+## Imports
+###############################################################################
+import numpy as np
+import sys
+import time
+
+import torch
+import photontorch as pt
+
+# setting path
+sys.path.append('../siroap_libs/')
+
+# Import local library
+import siroap_library as siroap
+import siroap_solvers as solvers
+import siroap_thermal as thermal
+
+from bench_designs import APF2, build_mesh, btu_factory1, GHz, fc
+
+
+###############################################################################
+# Simualation Parameters
+size = 201
+fmin = 10 # GHz
+fmax = 21 # GHz
+
+N = 16
+num_couplers = 40
+num_bars = 100
+src_list = [2]
+det_list = [i for i in range(8*N) if i not in src_list] # monitor all other edge ports
+
+env = pt.Environment(f=fc + GHz*np.linspace(fmin, fmax, size), freqdomain=True)
+pt.set_environment(env)
+
+mesh = siroap.SqrMesh_NxM(N, N, btu_factory1)
+rng = np.random.default_rng(0)
+keys = list(mesh.components)
+for key in rng.choice(keys, num_bars, replace=False):
+    mesh.set_state(key, ['bar'])
+for key in rng.choice(keys, num_couplers, replace=False):
+    mesh.set_state(key, ['coupler', 0.3])
+
+t0 = time.perf_counter()
+active = mesh.get_active_btus(src_list, det_list)
+print("reachability analysis: %i of %i BTUs active (%.3f s)"
+      % (active.sum(), len(active), time.perf_counter() - t0))
+
+print("%10s %10s %10s %12s %12s" % ("thermal", "prune", "#btus", "time [s]", "max error"))
+for model in [None, thermal.ThermalCrosstalk(mesh)]:
+    mesh.thermal = model
+    H_full = None
+    for prune in [False, True]:
+        t0 = time.perf_counter()
+        solver = solvers.SparseMeshSolver(mesh, src_list, det_list, prune=prune)
+        H = solver.solve()
+        t = time.perf_counter() - t0
+        H_full = H if H_full is None else H_full
+        print("%10s %10s %10i %12.3f %12.2e" % (model is not None, prune, solver.num_btus, t,
+                                               np.abs(H - H_full).max()))
+        np.testing.assert_allclose(H, H_full, rtol=0, atol=1e-12)
+
+# the pruned terminated network with crosstalk (photontorch simulates in float32)
+design = APF2
+mesh = build_mesh(design)
+mesh.thermal = thermal.ThermalCrosstalk(mesh)
+H = solvers.SparseMeshSolver(mesh, design['src_list'], design['det_list']).solve()
+for prune in [False, True]:
+    net = mesh.terminate(design['src_list'], design['det_list'], prune=prune)
+    with torch.no_grad():
+        det = net(source=1).cpu().numpy()[0, :, :, 0]
+    error = np.abs(det - np.abs(H[:, :, 0])**2).max()
+    print("APF2 with crosstalk, prune=%s: %i BTUs pruned, max error vs sparse solver %.2e"
+          % (prune, len(getattr(net, 'pruned', [])), error))
+    assert error < 1e-4
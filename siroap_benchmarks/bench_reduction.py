@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the cross/bar passthrough collapsing
+(siroap_solvers.ReducedMeshSolver) on the APF2 and CROW designs, checked
+against the full sparse solver and the photontorch network.
+
+@author: vsaxena
+"""
+
+###############################################################################
+## Imports
+###############################################################################
+import numpy as np
+import sys
+import time
+
+import torch
+import photontorch as pt
+
+# setting path
+sys.path.append('../siroap_libs/')
+
+# Import local library
+import siroap_solvers as solvers
+
+from bench_designs import designs, build_mesh, GHz, fc
+
+###############################################################################
+# Simualation Parameters
+size = 1001
+fmin = 10 # GHz
+fmax = 21 # GHz
+
+env = pt.Environment(f=fc + GHz*np.linspace(fmin, fmax, size), freqdomain=True)
+pt.set_environment(env)
+
+print("%8s %10s %12s %14s %14s %12s" % (
+    "design", "#btus", "#btus red.", "full [s]", "reduced [s]", "max error"))
+for name, design in designs.items():
+    mesh = build_mesh(design)
+
+    full = solvers.SparseMeshSolver(mesh, design['src_list'], design['det_list'])
+    t0 = time.perf_counter()
+    H_full = full.solve()
+    t_full = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    reduced = solvers.ReducedMeshSolver(mesh, design['src_list'], design['det_list'])
+    H_reduced = reduced.solve()
+    t_reduced = time.perf_counter() - t0
+
+    print("%8s %10i %12i %14.4f %14.4f %12.2e" % (
+        name, full.num_btus, reduced.num_btus, t_full, t_reduced,
+        np.abs(H_full - H_reduced).max()))
+    np.testing.assert_allclose(H_reduced, H_full, rtol=0, atol=1e-12)
+
+    # against the photontorch network, which simulates in float32
+    with torch.no_grad():
+        P_pt = mesh.terminate(design['src_list'], design['det_list'])(source=1)[0, :, :, 0].numpy()
+    np.testing.assert_allclose(np.abs(H_reduced.sum(2))**2, P_pt, rtol=0, atol=1e-4)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the resonance finder (siroap_zdomain.ZDomainMeshSolver.
+get_resonances) on the APF2, CROW2 and CROW3 designs: the resonances from
+the poles of the z-domain description (no sweep), from the rational (AAA)
+fit of a 1001 point sweep of the sparse solver (the fallback for meshes
+without commensurate delays), and, for APF2, the peaks of a dense sweep of
+the sparse solver at the 1% monitor taps of its rings (p10 and p29), which
+see the Lorentzian resonances of the single rings, with their FWHM.
+
+The resonances of the poles have to match those of the fit (frequency,
+FWHM and extinction, which the fit evaluates with the sparse solver), the
+power at resonance that of a dense sweep, and for APF2 the frequency and
+FWHM of the peaks at the monitor taps.
+
+@author: vsaxena
+"""
+
+###############################################################################
+## Imports
+###############################################################################
+import numpy as np
+import sys
+import time
+
+from scipy.constants import c
+from scipy.signal import find_peaks, peak_widths
+
+# setting path
+sys.path.append('../siroap_libs/')
+
+# Import local library
+import siroap_solvers as solvers
+import siroap_zdomain as zdomain
+
+from bench_designs import APF2, CROW2, CROW3, build_mesh, GHz, fc
+
+###############################################################################
+# Simualation Parameters
+fmin = 10 # GHz
+fmax = 21 # GHz
+size = 1001
+size_dense = 20001
+designs = {'APF2': APF2, 'CROW2': CROW2, 'CROW3': CROW3}
+monitors = {'APF2': [10, 29]}
+tol_extinction = 0.5 # dB
+tol_power = 0.1 # dB
+
+
+class Fitted(zdomain.ZDomainMeshSolver):
+    """ z-domain engine that always takes the rational fit """
+    def get_unit_delay(self):
+        return None
+
+
+def interp(f_new, f, H):
+    """ linear interpolation of the complex response H[#f, ...], accurate
+    to the bottom of the notches where the power in dB is not """
+    H = H.reshape(len(f), -1)
+    H_new = [np.interp(f_new, f, h.real) + 1j*np.interp(f_new, f, h.imag) for h in H.T]
+    return np.array(H_new).T
+
+
+print("%6s %8s %10s %10s %14s %14s %10s %16s" % ("design", "method", "#points", "time [s]",
+      "f - fc [GHz]", "FWHM [GHz]", "Q", "extinction [dB]"))
+for name, design in designs.items():
+    mesh = build_mesh(design)
+    src_list, det_list = design['src_list'], design['det_list']
+    wl = c/(fc + GHz*np.linspace(fmin, fmax, size))
+    results = {}
+    for method, engine, num_points in [('poles', zdomain.ZDomainMeshSolver, 0), ('AAA', Fitted, size)]:
+        t0 = time.perf_counter()
+        result = engine(mesh, src_list, det_list).get_resonances(wl)
+        t = time.perf_counter() - t0
+        fsr = result['fsr'] if method == 'poles' else fsr
+        results[method] = result['resonances']
+        for r in result['resonances']:
+            print("%6s %8s %10i %10.3f %14.4f %14.4f %10.0f %16.2f" % (name, method, num_points, t,
+                  (r['f'] - fc)/GHz, r['linewidth']/GHz, r['Q'], r['extinction'].max()))
+
+    print("%6s fsr of the response: %.4f GHz" % (name, fsr/GHz))
+
+    # dense sweep
+    f = fc + GHz*np.linspace(fmin, fmax, size_dense)
+    t0 = time.perf_counter()
+    H = solvers.SparseMeshSolver(mesh, src_list, det_list).solve(c/f)
+    t = time.perf_counter() - t0
+    power = np.abs(H[:, :, 0])**2
+
+    # the poles give the resonances of the fit of the sweep, the extinction
+    # of the fit is evaluated with the sparse solver
+    poles, fitted = results['poles'], results['AAA']
+    assert len(poles) == len(fitted) > 0
+    for rp, ra in zip(poles, fitted):
+        assert abs(rp['f'] - ra['f']) < 1e-4*GHz
+        np.testing.assert_allclose(rp['linewidth'], ra['linewidth'], rtol=1e-3, atol=0)
+        np.testing.assert_allclose(rp['extinction'], ra['extinction'], rtol=0, atol=tol_extinction)
+
+    # and the power at resonance that of the sweep
+    for r in poles + fitted:
+        sweep = 10*np.log10(np.maximum(np.abs(interp(r['f'], f, H))**2, 1e-30))
+        np.testing.assert_allclose(r['transmission'].ravel(), sweep.ravel(), rtol=0, atol=tol_power)
+
+    # peaks of the dense sweep at the monitor taps
+    for port in monitors.get(name, []):
+        d = det_list.index(port)
+        peaks = find_peaks(power[:, d], prominence=0.5*power[:, d].max())[0]
+        widths = peak_widths(power[:, d], peaks)[0]*(f[1] - f[0])
+        for peak, width in zip(peaks, widths):
+            print("%6s %8s %10i %10.3f %14.4f %14.4f %10.0f %16s" % (name, "sweep p%i" % port, size_dense,
+                  t, (f[peak] - fc)/GHz, width/GHz, f[peak]/width, "-"))
+            for r in poles + fitted:
+                if abs(r['f'] - f[peak]) < r['linewidth']/2:
+                    break
+            else:
+                raise AssertionError("peak of p%i at %.4f GHz not found" % (port, (f[peak] - fc)/GHz))
+            assert abs(r['f'] - f[peak]) <= 2*(f[1] - f[0])
+            np.testing.assert_allclose(r['linewidth'], width, rtol=1e-2, atol=0)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the closed-form ring filter analysis (siroap_rings.RingAnalyzer)
+against the sparse mesh solve, for the APF2, CROW2 and CROW3 designs. The
+rings found in every design and their equivalent parameters are printed.
+
+@author: vsaxena
+"""
+
+###############################################################################
+## Imports
+###############################################################################
+import numpy as np
+import sys
+import time
+
+# setting path
+sys.path.append('../siroap_libs/')
+
+# Import local library
+import siroap_solvers as solvers
+import siroap_rings as rings
+
+from bench_designs import designs, build_mesh, GHz, fc, c
+
+###############################################################################
+# Simualation Parameters
+size = 10001
+fmin = 10 # GHz
+fmax = 21 # GHz
+wl = c/(fc + GHz*np.linspace(fmin, fmax, size))
+
+print("%8s %12s %12s %12s" % ('design', 'rings [s]', 'sparse [s]', 'max error'))
+for name, design in designs.items():
+    mesh = build_mesh(design)
+    src_list, det_list = design['src_list'], design['det_list']
+
+    t0 = time.perf_counter()
+    analyzer = rings.RingAnalyzer(mesh, src_list, det_list)
+    H = analyzer.solve(wl)
+    t_rings = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    H_ref = solvers.SparseMeshSolver(mesh, src_list, det_list).solve(wl)
+    t_sparse = time.perf_counter() - t0
+    print("%8s %12.3f %12.3f %12.2e" % (name, t_rings, t_sparse, np.abs(H - H_ref).max()))
+    np.testing.assert_allclose(H, H_ref, rtol=0, atol=1e-10)
+
+    for structure in analyzer.get_structures():
+        print("%10s %s: rings %s, bus %s, taps %s" % ('', structure['kind'], structure['rings'],
+                                                     structure['bus'], structure['taps']))
+    for ring in analyzer.get_rings():
+        print("%12s cell %s: kappa %s, loss %.2f dB, phase %.4f rad, FSR %.2f GHz"
+              % ('', ring['cell'], ', '.join('%s=%.4f' % kv for kv in ring['kappa'].items()),
+                 ring['loss'], ring['phase'], ring['fsr']/GHz))
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the sparse direct solver (siroap_solvers.SparseMeshSolver)
+against the dense photontorch network solve.
+
+The dense solve is only run for the small meshes, it quickly runs out of
+memory for the larger ones.
+
+@author: vsaxena
+"""
+
+###############################################################################
+## Imports
+###############################################################################
+import numpy as np
+import sys
+import time
+
+import torch
+import photontorch as pt
+
+# setting path
+sys.path.append('../siroap_libs/')
+
+# Import local library
+import siroap_library as siroap
+import siroap_solvers as solvers
+
+
+###############################################################################
+c           = 3e8 # speed of light
+ng          = 4.24 # group index
+wl0         = 1.55e-6
+
+# Simualation Parameters
+GHz = 1e9
+size = 1001
+fmin = 0 # GHz
+fmax = 50 # GHz
+
+mesh_sizes = [4, 8, 16, 32]
+dense_sizes = [4]
+
+###############################################################################
+freq = GHz*np.linspace(fmin, fmax, size) # frequency offset points
+fc = (c/(ng*wl0))                             # reference frequency
+env = pt.Environment(f=fc + freq, freqdomain=True)
+pt.set_environment(env)
+
+print("%8s %8s %14s %14s %12s" % ("mesh", "#ports", "dense [s]", "sparse [s]", "max error"))
+for N in mesh_sizes:
+    mesh = siroap.SqrMesh_NxM(N, N)
+    # every third BTU acts as a coupler to create many loops
+    for key in list(mesh.components)[::3]:
+        mesh.set_state(key, ['coupler', 0.3])
+    src_list = [0]
+    det_list = [1, 2*N+1, 4*N+1, 6*N+1]
+
+    t0 = time.perf_counter()
+    det_sparse = solvers.SparseMeshSolver(mesh, src_list, det_list).forward(source=1)
+    t_sparse = time.perf_counter() - t0
+
+    t_dense, error = np.nan, np.nan
+    if N in dense_sizes:
+        with torch.no_grad():
+            t0 = time.perf_counter()
+            det_dense = mesh.terminate(src_list, det_list).forward(source=1)
+            t_dense = time.perf_counter() - t0
+        error = float((det_dense - det_sparse).abs().max())
+        # photontorch simulates in float32
+        np.testing.assert_allclose(det_sparse.numpy(), det_dense.numpy(), rtol=0, atol=1e-4)
+
+    print("%8s %8i %14.2f %14.2f %12.2e" % (
+        "%ix%i" % (N, N), 4*len(mesh.components), t_dense, t_sparse, error))
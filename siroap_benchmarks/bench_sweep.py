@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the peak memory of a single-environment sweep against the
+chunked streaming sweep (siroap_sweep) of the terminated APF2 mesh.
+
+Every case runs in its own process, so that the peak resident memory
+(ru_maxrss) of the process is the peak of that case. The chunked peak
+has to stay flat over the sizes, and the streamed file has to match the
+single-environment sweep wherever that fits into memory.
+
+@author: vsaxena
+"""
+
+###############################################################################
+## Imports
+###############################################################################
+import numpy as np
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import torch
+import photontorch as pt
+
+# setting path
+sys.path.append('../siroap_libs/')
+
+# Import local library
+import siroap_sweep as sweep
+
+from bench_designs import APF2, build_mesh, GHz, fc
+
+###############################################################################
+# Simualation Parameters
+fmin = 10 # GHz
+fmax = 21 # GHz
+chunk_size = 250
+sizes = [1000, 2000, 4000]
+
+
+flat_tol = 50 # MB, spread of the chunked peak over the sizes
+
+
+def run(mode, size, filename):
+    f = fc + GHz*np.linspace(fmin, fmax, size)
+    net = build_mesh(APF2).terminate(APF2['src_list'], APF2['det_list'])
+    t0 = time.perf_counter()
+    if mode == 'full':
+        with torch.no_grad(), pt.Environment(f=f, freqdomain=True):
+            det = net(source=1)
+        np.save(filename, det.cpu().numpy()[0, :, :, 0])
+    else:
+        sweep.sweep_to_file(net, f, filename, chunk_size)
+    t = time.perf_counter() - t0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024 # MB on linux
+    print("%8s %8i %10.2f %14.0f" % (mode, size, t, peak))
+
+
+if len(sys.argv) == 4:
+    run(sys.argv[1], int(sys.argv[2]), sys.argv[3])
+else:
+    print("%8s %8s %10s %14s" % ("mode", "#points", "time [s]", "peak RSS [MB]"))
+    folder = tempfile.mkdtemp()
+    peaks = {}
+    for size in sizes:
+        for mode in ['full', 'chunked']:
+            filename = os.path.join(folder, '%s_%i.npy' % (mode, size))
+            proc = subprocess.run([sys.executable, __file__, mode, str(size), filename],
+                                  stdout=subprocess.PIPE, universal_newlines=True)
+            if proc.returncode:
+                print("%8s %8i %10s %14s" % (mode, size, "failed", "-")) # out of memory
+                continue
+            print(proc.stdout, end='')
+            peaks[mode, size] = float(proc.stdout.split()[-1])
+
+        # the streamed file holds the same sweep as the single environment
+        if ('full', size) in peaks:
+            np.testing.assert_allclose(
+                np.load(os.path.join(folder, 'chunked_%i.npy' % size), mmap_mode='r'),
+                np.load(os.path.join(folder, 'full_%i.npy' % size)), rtol=0, atol=1e-6,
+            )
+
+    # the chunked peak does not grow with the number of points
+    chunked = [peaks['chunked', size] for size in sizes]
+    assert max(chunked) - min(chunked) < flat_tol, chunked
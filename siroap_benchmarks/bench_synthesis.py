@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the gradient-based filter synthesis (siroap_synthesis):
+the coupling coefficients and ring phases of the APF2 and CROW2 designs
+are re-synthesized from random starts, with the detected power of the
+hand-tuned design as target. The synthesized mesh_dict is checked with
+the sparse solver: its detected power has to match the target within
+max_error, in less than max_time.
+
+@author: vsaxena
+"""
+
+###############################################################################
+## Imports
+###############################################################################
+import numpy as np
+import sys
+import time
+
+# setting path
+sys.path.append('../siroap_libs/')
+
+# Import local library
+import siroap_solvers as solvers
+import siroap_synthesis as synthesis
+
+from bench_designs import APF2, CROW2, build_mesh, GHz, fc, c
+
+###############################################################################
+# Simualation Parameters
+size = 201
+fmin = 10 # GHz
+fmax = 21 # GHz
+wl = c/(fc + GHz*np.linspace(fmin, fmax, size))
+num_starts = 8
+max_error = 1e-3 # of the detected power
+max_time = {'lbfgs': 10, 'adam': 30} # s
+
+# free parameters of the designs, by name
+templates = {
+    'APF2': (APF2, {'H1_1': ['coupler', 'kappa'],
+                    'H3_1': ['coupler', 'kappa'],
+                    'V0_2': ['phase_shifter_bar', 'phi'],
+                    'V3_2': ['phase_shifter_bar', '-phi'],
+                    'V1_1': ['phase_shifter_cross', 'beta']}),
+    'CROW2': (CROW2, {'H0_0': ['coupler', 'kappa_ext'],
+                      'H1_0': ['coupler', 'kappa_int'],
+                      'H2_0': ['coupler', 'kappa_ext']}),
+}
+
+print("%8s %8s %10s %12s %12s" % ('design', 'method', 'time [s]', 'loss', 'vs target'))
+for name, (design, free) in templates.items():
+    src_list, det_list = design['src_list'], design['det_list']
+    mesh = build_mesh(design)
+    target = np.abs(solvers.SparseMeshSolver(mesh, src_list, det_list).solve(wl)[:, :, 0])**2
+
+    for method in ['lbfgs', 'adam']:
+        template = dict(design['mesh_dict'], **free)
+        synth = synthesis.FilterSynthesis(build_mesh(design), src_list, det_list, template, target, wl)
+        t0 = time.perf_counter()
+        if method == 'lbfgs':
+            mesh_dict = synth.run(num_starts=num_starts, method='lbfgs', steps=30, seed=0)
+        else:
+            mesh_dict = synth.run(num_starts=num_starts, method='adam', steps=60, lr=0.05,
+                                  refine=30, seed=0)
+        t_synth = time.perf_counter() - t0
+
+        # check the synthesized design with the sparse solver
+        mesh = build_mesh({'mesh_dict': mesh_dict})
+        power = np.abs(solvers.SparseMeshSolver(mesh, src_list, det_list).solve(wl)[:, :, 0])**2
+        error = np.abs(power - target).max()
+        print("%8s %8s %10.3f %12.2e %12.2e" % (name, method, t_synth, synth.loss, error))
+        print("%17s %s" % ('', ', '.join('%s=%.4f' % kv for kv in synth.values.items())))
+        assert error < max_error and t_synth < max_time[method]
+
+print("\nreference: APF2 kappa=%.4f phi=%.4f beta=%.4f, CROW2 kappa_ext=%.4f kappa_int=%.4f"
+      % (APF2['mesh_dict']['H1_1'][1], APF2['mesh_dict']['V0_2'][1], APF2['mesh_dict']['V1_1'][1],
+         CROW2['mesh_dict']['H0_0'][1], CROW2['mesh_dict']['H1_0'][1]))
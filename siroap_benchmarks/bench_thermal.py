@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the thermal crosstalk model (siroap_thermal): the effective
+phases of a batch of random heater configurations from the precomputed
+sparse crosstalk matrix and from the FFT convolution, against a loop over
+the heaters and their neighbours. The short-range kernel uses the default
+cutoff, the full-range kernel has no cutoff.
+
+The effect of the default crosstalk on the APF2 design is shown at the end.
+
+@author: vsaxena
+"""
+
+###############################################################################
+## Imports
+###############################################################################
+import numpy as np
+import sys
+import time
+
+import torch
+import photontorch as pt
+
+# setting path
+sys.path.append('../siroap_libs/')
+
+# Import local library
+import siroap_library as siroap
+import siroap_solvers as solvers
+import siroap_thermal as thermal
+
+from bench_designs import APF2, build_mesh, btu_factory1, GHz, fc
+
+###############################################################################
+mesh_sizes = [4, 8, 16, 32]
+num_configs = 100
+
+
+def loop_perturbation(model, phi):
+    """ reference: X phi with a loop over every heater and its neighbours """
+    X = model.get_matrix()
+    dphi = np.zeros_like(phi)
+    for m in range(model.num_heaters):
+        for n, x in zip(X.indices[X.indptr[m]:X.indptr[m+1]], X.data[X.indptr[m]:X.indptr[m+1]]):
+            dphi[m] += x*phi[n]
+    return dphi
+
+
+print("%8s %8s %8s %10s %12s %12s %12s %10s" % ("kernel", "mesh", "#btus", "couplings",
+      "loop [s]", "sparse [s]", "fft [s]", "max error"))
+for cutoff, name in [(None, 'short'), (np.inf, 'full')]:
+    for N in mesh_sizes:
+        if name == 'full' and N > 16:
+            continue
+        mesh = siroap.SqrMesh_NxM(N, N, btu_factory1)
+        phi = torch.rand(num_configs, 2*len(mesh.components), dtype=torch.float64)*2*np.pi
+        times, results = {}, {}
+        for method in ['sparse', 'fft']:
+            model = thermal.ThermalCrosstalk(mesh, cutoff=cutoff, method=method)
+            model.get_perturbation(phi[:1]) # precompute the kernel
+            t0 = time.perf_counter()
+            results[method] = model.get_perturbation(phi).numpy()
+            times[method] = (time.perf_counter() - t0)/num_configs
+        t0 = time.perf_counter()
+        ref = loop_perturbation(model, phi[0].numpy())
+        t_loop = time.perf_counter() - t0
+        error = max(np.abs(results['sparse'][0] - ref).max(), np.abs(results['fft'] - results['sparse']).max())
+        print("%8s %8s %8i %10i %12.2e %12.2e %12.2e %10.2e" % (name, '%ix%i' % (N, N),
+              len(mesh.components), model.get_matrix().nnz, t_loop, times['sparse'], times['fft'], error))
+        assert error < 1e-10
+
+# crosstalk on the APF2 design
+mesh = build_mesh(APF2)
+f = fc + GHz*np.linspace(10, 21, 201)
+with pt.Environment(f=f, freqdomain=True):
+    solver = solvers.SparseMeshSolver(mesh, APF2['src_list'], APF2['det_list'])
+    det0 = solver.forward()[0, :, :, 0].numpy()
+    mesh.thermal = thermal.ThermalCrosstalk(mesh)
+    det = solver.forward()[0, :, :, 0].numpy()
+print("\nAPF2: max change of the detected power with crosstalk %.3e" % np.abs(det - det0).max())
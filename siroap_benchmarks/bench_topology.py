@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the integer topology table of SqrMesh_NxM: neighbour lookups
+(get_next_btu) and ring phases of all cells, per BTU with get_ring_phase
+and in one pass with get_ring_phase_map.
+
+@author: vsaxena
+"""
+
+###############################################################################
+## Imports
+###############################################################################
+import numpy as np
+import sys
+import time
+
+# setting path
+sys.path.append('../siroap_libs/')
+
+# Import local library
+import siroap_library as siroap
+
+from bench_designs import btu_factory1
+
+
+###############################################################################
+print("%8s %8s %14s %16s %14s %10s" % ('mesh', '#btus', 'next_btu [s]', 'ring_phase [s]',
+                                       'phase_map [s]', 'error'))
+for N in [4, 8, 16]:
+    mesh = siroap.SqrMesh_NxM(N, N, btu_factory1)
+    for k, btu in enumerate(mesh.components.values()):
+        btu.phiU.data.fill_(0.1*k)
+
+    t0 = time.perf_counter()
+    for key in mesh.components.keys():
+        mesh.get_next_btu(key)
+    t_next = time.perf_counter() - t0
+
+    # every cell is the right ring of its left V BTU
+    t0 = time.perf_counter()
+    rings = np.array([[mesh.get_ring_phase("V%i_%i" % (i, j))['right_ring']
+                       for j in range(N)] for i in range(N)])
+    t_ring = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    phase_map = mesh.get_ring_phase_map().detach().numpy()
+    t_map = time.perf_counter() - t0
+
+    print("%8s %8i %14.5f %16.5f %14.5f %10.2e" % ('%ix%i' % (N, N), len(mesh.components),
+                                                   t_next, t_ring, t_map,
+                                                   np.abs(rings - phase_map).max()))
+    np.testing.assert_allclose(phase_map, rings, rtol=0, atol=1e-12)
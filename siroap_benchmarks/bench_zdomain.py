@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the z-domain engine (siroap_zdomain.ZDomainMeshSolver) on the
+2nd order APF design of SqMesh_4x4_APF2_v1.py.
+
+@author: vsaxena
+"""
+
+###############################################################################
+## Imports
+###############################################################################
+import numpy as np
+import sys
+import time
+
+import torch
+import photontorch as pt
+
+# setting path
+sys.path.append('../siroap_libs/')
+
+# Import local library
+import siroap_solvers as solvers
+import siroap_zdomain as zdomain
+
+from bench_designs import APF2, build_mesh, GHz, fc, c
+
+###############################################################################
+# Simualation Parameters
+size = 1001
+fmin = 10 # GHz
+fmax = 21 # GHz
+
+env = pt.Environment(f=fc + GHz*np.linspace(fmin, fmax, size), freqdomain=True)
+pt.set_environment(env)
+
+src_list = APF2['src_list']
+det_list = APF2['det_list']
+mesh = build_mesh(APF2)
+
+###############################################################################
+with torch.no_grad():
+    t0 = time.perf_counter()
+    det_dense = mesh.terminate(src_list, det_list).forward(source=1)
+    print("photontorch, %7i points: %10.4f s" % (size, time.perf_counter() - t0))
+
+t0 = time.perf_counter()
+H_sparse = solvers.SparseMeshSolver(mesh, src_list, det_list).solve()
+print("sparse,      %7i points: %10.4f s" % (size, time.perf_counter() - t0))
+
+t0 = time.perf_counter()
+engine = zdomain.ZDomainMeshSolver(mesh, src_list, det_list).initialize()
+print("z-domain extraction (N: order %i, D: order %i): %10.4f s"
+      % (len(engine.num) - 1, len(engine.den) - 1, time.perf_counter() - t0))
+
+for num_points in [size, 1000000]:
+    wl = c/(fc + GHz*np.linspace(fmin, fmax, num_points))
+    t0 = time.perf_counter()
+    H = engine.solve(wl)
+    print("z-domain,    %7i points: %10.4f s" % (num_points, time.perf_counter() - t0))
+
+print("max error vs sparse solver: %.2e" % np.abs(engine.solve() - H_sparse).max())
+print("max error vs photontorch:   %.2e" % float((engine.forward() - det_dense).abs().max()))
+np.testing.assert_allclose(engine.solve(), H_sparse, rtol=0, atol=1e-8)
+# photontorch simulates in float32
+np.testing.assert_allclose(engine.forward().numpy(), det_dense.numpy(), rtol=0, atol=1e-4)
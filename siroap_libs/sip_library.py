@@ -7,6 +7,7 @@ Created on Fri Jul 30 21:17:26 2021
 """
 import numpy as np
 import torch 
+from functools import partial
 import photontorch as pt 
 
 # Relative
@@ -14,6 +15,58 @@ from photontorch.components.terms import Detector
 from photontorch.components  import Component
 from photontorch.nn.nn import Parameter, Buffer
 
+##############################################################################
+## Environment cache
+##############################################################################
+# Wavelength tensors and dispersion terms only depend on the simulation
+# environment and on the waveguide constants, so they are computed once and
+# shared by all components. The cache is emptied when the environment changes.
+_env_cache = {'env': None, 'entries': {}}
+
+def get_env_cache(env=None):
+    """ dict of cached values bound to env (default: the current environment) """
+    env = pt.current_environment() if env is None else env
+    if _env_cache['env'] is not env:
+        _env_cache['env'] = env
+        _env_cache['entries'] = {}
+    return _env_cache['entries']
+
+
+def get_wavelengths(env=None, device='cpu'):
+    """ wavelengths of the environment as a float64 Tensor[#wavelengths] """
+    env = pt.current_environment() if env is None else env
+    cache = get_env_cache(env)
+    key = ('wl', str(device))
+    if key not in cache:
+        cache[key] = torch.tensor(env.wl, dtype=torch.float64, device=device)
+    return cache[key]
+
+
+def get_phi0(neff, ng, wl0, length, env=None, device='cpu'):
+    """ Dispersive propagation phase 2*pi*neff(wl)*length/wl (mod 2*pi)
+
+    Args:
+        neff, ng, wl0, length (float or array[...]): waveguide constants
+        env (optional, pt.Environment): defaults to the current environment
+        device (str|torch.device): device of the result
+
+    Returns:
+        Tensor[..., #wavelengths] (float64)
+    """
+    env = pt.current_environment() if env is None else env
+    cache = get_env_cache(env)
+    consts = [np.asarray(x.cpu() if torch.is_tensor(x) else x, dtype=np.float64)
+              for x in (neff, ng, wl0, length)]
+    key = ('phi0', str(device)) + tuple((x.shape, x.tobytes()) for x in consts)
+    if key not in cache:
+        wls = get_wavelengths(env, device)
+        neff, ng, wl0, length = (torch.tensor(x, dtype=torch.float64, device=device)[..., None]
+                                 for x in consts)
+        neff = neff - (wls - wl0) * (ng - neff) / wl0
+        cache[key] = (2 * np.pi * neff * length / wls) % (2 * np.pi)
+    return cache[key]
+
+
 ##############################################################################
 ## WAVEGUIDE CLASS
 ##############################################################################
@@ -81,29 +134,11 @@ class Waveguide(pt.Component):
         """
         # during a photontorch simulation, the simulation environment
         # containing all the global simulation parameters will be
-        # available to you as `self.env`:
-        current_simulation_environment = self.env
-
-        # you can use this environment to get information about the
-        # wavelengths used in the simulation:
-        wavelength = current_simulation_environment.wavelength
-
-        # however, this wavelength is stored as a numpy array, while
-        # photontorch expect torch tensors. We need to make a torch
-        # tensor out of this:
-        wavelength = torch.tensor(
-            wavelength, # make this numpy array into a torch tensor
-            dtype=torch.float64, # keep float64 dtype
-            device=self.device, # put it on the current device ('cpu' or 'gpu')
-        )
-
-        # next we implement the dispersion, which will depend on the
-        # wavelength tensor
-        neff = self.neff - (wavelength - self.wl0) * (self.ng - self.neff) / self.wl0
-
-        # we have now calculated an neff for each different wavelength.
-        # let's calculate the phase depending on this neff:
-        phase = (2 * np.pi * neff * self.length / wavelength) % (2 * np.pi)
+        # available to you as `self.env`. The wavelength tensor and the
+        # dispersive phase only depend on this environment and on the
+        # waveguide constants, so they are taken from the shared cache
+        # (see get_phi0) instead of being recomputed for every waveguide:
+        phase = get_phi0(self.neff, self.ng, self.wl0, self.length, self.env, self.device)
 
         # next, we add the phase correction parameter.
         phase = phase + self.phase
@@ -128,11 +163,28 @@ class Waveguide(pt.Component):
         # the last thing to do is to add the S-matrix parameters to the S-matrix:
         S[0, :, 0, 1] = S[0, :, 1, 0] = re
         S[1, :, 0, 1] = S[1, :, 1, 0] = ie
+
+    def get_S_complex(self, dtype=torch.complex128):
+        """ S-matrix of the current environment as a native complex tensor
+
+        Returns:
+            Tensor[#wavelengths, 2, 2] of the given complex dtype
+        """
+        phase = get_phi0(self.neff, self.ng, self.wl0, self.length, self.env, self.device)
+        loss = 10 ** (- (self.length * 100) * self.loss / 20)
+        t = loss * torch.exp(1j * (phase + self.phase))
+        S = torch.zeros(t.shape + (2, 2), dtype=dtype, device=self.device)
+        S[:, 0, 1] = S[:, 1, 0] = t.to(dtype)
+        return S
         
         
 ##############################################################################
 ## DIRECTIONAL COUPLER CLASS
 ##############################################################################
+# port patterns of the transmission and coupling terms
+_DC_THROUGH = torch.tensor([[0, 1, 0, 0], [1, 0, 0, 0], [0, 0, 0, 1], [0, 0, 1, 0]], dtype=torch.float64)
+_DC_CROSS = torch.tensor([[0, 0, 1, 0], [0, 0, 0, 1], [1, 0, 0, 0], [0, 1, 0, 0]], dtype=torch.float64)
+
 class DirectionalCoupler(pt.Component):
     r""" A directional coupler is a component with 4 ports that introduces no delays
 
@@ -189,6 +241,18 @@ class DirectionalCoupler(pt.Component):
         # imag part scattering matrix (coupling):
         S[1, :, 0, 2] = S[1, :, 2, 0] = k # same for all wavelengths
         S[1, :, 1, 3] = S[1, :, 3, 1] = k # same for all wavelengths
+
+    def get_S_complex(self, dtype=torch.complex128):
+        """ S-matrix of the current environment as a native complex tensor
+
+        Returns:
+            Tensor[#wavelengths, 4, 4] of the given complex dtype
+        """
+        t = (1 - self.coupling) ** 0.5
+        k = self.coupling ** 0.5
+        S = t * _DC_THROUGH.to(self.device) + 1j * k * _DC_CROSS.to(self.device)
+        num_wl = len(get_wavelengths(self.env, self.device))
+        return S.to(dtype).expand(num_wl, 4, 4)
         
 ###############################################################################
 ## Ring Resonator with Four Ports
@@ -258,6 +322,7 @@ class BTU(Component):
         loss=0,
         trainable=True,
         name=None,
+        apply_loss=False,
     ):
         """
         Args:
@@ -270,6 +335,10 @@ class BTU(Component):
             loss (float): Entire BTU's loss [dB]
             trainable (bool): whether phi and theta are trainable
             name (optional, str): name of this specific MZI
+            apply_loss (bool): scale the S-matrix by the loss. set_S used to
+                return the lossy S-matrix, which photontorch ignores, so the
+                loss was never part of the simulation. It is off by default
+                to keep the results of the existing designs.
         """
         super(BTU, self).__init__(name=name)
 
@@ -279,11 +348,11 @@ class BTU(Component):
         self.neff = float(neff)
         self.length = float(length)
         self.loss = float(loss)
+        self.apply_loss = bool(apply_loss)
         self.wl0 = float(wl0)
         self.phiU = parameter(torch.tensor(phiU, dtype=torch.float64, device=self.device))
         self.phiL = parameter(torch.tensor(phiL, dtype=torch.float64, device=self.device))
         self.phi_offset = parameter(torch.tensor(phi_offset, dtype=torch.float64, device=self.device))
-        self.phi00 = 0
         
     # def set_port_order(self, port_order):
     #     port_order = torch.tensor([1, 3, 2, 0])
@@ -291,43 +360,223 @@ class BTU(Component):
     def set_delays(self, delays):
         delays[:] = self.ng * self.length / self.env.c
 
+    @property
+    def phi00(self):
+        """ Global (center wavelength) common-mode phase of the BTU arms """
+        return (2 * np.pi * self.neff * self.length / self.wl0) % (2 * np.pi)
+
+    @property
+    def applied_loss(self):
+        """ loss [dB] in the S-matrix, the BTU loss only with apply_loss """
+        return self.loss if self.apply_loss else 0.0
+
     def set_S(self, S):
-        wls = torch.tensor(self.env.wl, dtype=torch.float64, device=self.device)
-        
-        ## Common-mode and differential hases
-        # Always use the self.variable for variables, otherwise the model will
-        # not update with network.initialize()
-        phiA = (self.phiU + self.phiL)/2
-        # Added self.phi_offset/2 by VS on 6/21/24
-        phiD = (self.phiU - self.phiL)/2 + self.phi_offset/2
-        
-        # neff depends on the wavelength:
-        neff = self.neff - (wls - self.wl0) * (self.ng - self.neff) / self.wl0
-        self.phi00 = (2 * np.pi * self.neff * self.length / self.wl0) % (2 * np.pi) # Global Phi0
-        
+        wls = get_wavelengths(self.env, self.device)
+        phi0 = get_phi0(self.neff, self.ng, self.wl0, self.length, self.env, self.device)
+        # Single BTU evaluated with the same kernel the mesh uses for all BTUs
+        S[:] = btu_S_batch(
+            self.phiU, self.phiL, self.phi_offset, wls,
+            self.neff, self.ng, self.wl0, self.length, self.applied_loss, phi0=phi0,
+        )
+        return S
+
+    def get_S_complex(self, dtype=torch.complex128):
+        """ S-matrix of the current environment as a native complex tensor
+
+        Returns:
+            Tensor[#wavelengths, 4, 4] of the given complex dtype
+        """
+        wls = get_wavelengths(self.env, self.device)
+        phi0 = get_phi0(self.neff, self.ng, self.wl0, self.length, self.env, self.device)
+        return btu_S_complex(
+            self.phiU, self.phiL, self.phi_offset, wls,
+            self.neff, self.ng, self.wl0, self.length, self.applied_loss, dtype=dtype, phi0=phi0,
+        )
+
+
+def btu_S_batch(phiU, phiL, phi_offset, wls, neff, ng, wl0, length, loss, dtype=None, phi0=None):
+    """ Vectorized S-matrices for a stack of BTUs
+
+    All BTU arguments broadcast against each other, so a whole mesh (or a batch
+    of meshes) is evaluated in a single pass instead of one BTU.set_S per BTU.
+
+    Args:
+        phiU, phiL, phi_offset (Tensor[..., #btus]): arm phases of the BTUs
+        wls (Tensor[#wavelengths]): simulation wavelengths [m]
+        neff, ng, wl0, length (Tensor[#btus] or float): waveguide parameters
+        loss (Tensor[#btus] or float): Entire BTU's loss [dB]
+        dtype (optional, torch.dtype): dtype of the result, defaults to the
+            torch default dtype (as for the photontorch S-matrices)
+        phi0 (optional, Tensor[#btus, #wavelengths]): precomputed dispersive
+            phase (see get_phi0), computed from the waveguide parameters if None
+
+    Returns:
+        Tensor[2=(real|imag), ..., #btus, #wavelengths, 4, 4]
+    """
+    as_tensor = partial(torch.as_tensor, dtype=torch.float64, device=wls.device)
+    phiU, phiL, phi_offset = as_tensor(phiU), as_tensor(phiL), as_tensor(phi_offset)
+    neff, ng, wl0, length, loss = (as_tensor(x)[..., None] for x in (neff, ng, wl0, length, loss))
+
+    ## Common-mode and differential phases (per BTU)
+    phiA = ((phiU + phiL)/2)[..., None]
+    # Added self.phi_offset/2 by VS on 6/21/24
+    phiD = ((phiU - phiL)/2 + phi_offset/2)[..., None]
+
+    if phi0 is None:
+        # neff depends on the wavelength: (#btus, #wavelengths)
+        neff = neff - (wls - wl0) * (ng - neff) / wl0
         # Wavelength dependent phi0
-        phi0 = (2 * np.pi * neff * self.length / wls) % (2 * np.pi)
-        phiC = phi0 + phiA  # total common-mode phi
-        # cos / sin of phases
-        cos_phiC = torch.cos(phiC).to(torch.get_default_dtype())
-        sin_phiC = torch.sin(phiC).to(torch.get_default_dtype())
-        cos_phiD = torch.cos(phiD).to(torch.get_default_dtype())
-        sin_phiD = torch.sin(phiD).to(torch.get_default_dtype())
-        # scattering matrix
-        S[0, :, 0, 1] = S[0, :, 1, 0] = -sin_phiC * sin_phiD
-        S[1, :, 0, 1] = S[1, :, 1, 0] = cos_phiC * sin_phiD
-        S[0, :, 0, 2] = S[0, :, 2, 0] = -sin_phiC * cos_phiD
-        S[1, :, 0, 2] = S[1, :, 2, 0] = cos_phiC * cos_phiD
-        S[0, :, 3, 1] = S[0, :, 1, 3] = -sin_phiC * cos_phiD
-        S[1, :, 3, 1] = S[1, :, 1, 3] = cos_phiC * cos_phiD
-        S[0, :, 3, 2] = S[0, :, 2, 3] = sin_phiC * sin_phiD
-        S[1, :, 3, 2] = S[1, :, 2, 3] = -cos_phiC * sin_phiD
-        # return scattering matrix
-
-        # add loss
-        #loss = self.loss * self.length * 100 # loss defined per unit length
-        loss = self.loss # Absolute loss in dB for the whole BTU
-        return S * 10 ** (-loss / 20)  # 20 bc loss is defined on power.
+        phi0 = (2 * np.pi * neff * length / wls) % (2 * np.pi)
+    phiC = phi0 + phiA  # total common-mode phi
+
+    # add loss, 20 bc loss is defined on power.
+    # Absolute loss in dB for the whole BTU
+    amp = 10 ** (-loss / 20)
+    cos_phiC = amp * torch.cos(phiC)
+    sin_phiC = amp * torch.sin(phiC)
+    cos_phiD = torch.cos(phiD)
+    sin_phiD = torch.sin(phiD)
+
+    S = torch.zeros((2,) + phiC.shape + (4, 4), dtype=torch.float64, device=wls.device)
+    # scattering matrix
+    S[0, ..., 0, 1] = S[0, ..., 1, 0] = -sin_phiC * sin_phiD
+    S[1, ..., 0, 1] = S[1, ..., 1, 0] = cos_phiC * sin_phiD
+    S[0, ..., 0, 2] = S[0, ..., 2, 0] = -sin_phiC * cos_phiD
+    S[1, ..., 0, 2] = S[1, ..., 2, 0] = cos_phiC * cos_phiD
+    S[0, ..., 3, 1] = S[0, ..., 1, 3] = -sin_phiC * cos_phiD
+    S[1, ..., 3, 1] = S[1, ..., 1, 3] = cos_phiC * cos_phiD
+    S[0, ..., 3, 2] = S[0, ..., 2, 3] = sin_phiC * sin_phiD
+    S[1, ..., 3, 2] = S[1, ..., 2, 3] = -cos_phiC * sin_phiD
+    return S.to(dtype or torch.get_default_dtype())
+
+
+# port patterns of the sin(phiD) and cos(phiD) terms of the BTU S-matrix
+_BTU_SIN = torch.tensor([[0, 1, 0, 0], [1, 0, 0, 0], [0, 0, 0, -1], [0, 0, -1, 0]], dtype=torch.float64)
+_BTU_COS = torch.tensor([[0, 0, 1, 0], [0, 0, 0, 1], [1, 0, 0, 0], [0, 1, 0, 0]], dtype=torch.float64)
+
+def btu_S_complex(phiU, phiL, phi_offset, wls, neff, ng, wl0, length, loss,
+                  dtype=torch.complex128, phi0=None):
+    """ Native complex variant of btu_S_batch
+
+    Every element of the BTU S-matrix is j*exp(j*phiC) times sin(phiD) or
+    +-cos(phiD), so the matrix is built as two broadcast products with
+    constant port patterns instead of eight real/imag element pairs.
+
+    Returns:
+        Tensor[..., #btus, #wavelengths, 4, 4] of the given complex dtype
+    """
+    as_tensor = partial(torch.as_tensor, dtype=torch.float64, device=wls.device)
+    phiU, phiL, phi_offset = as_tensor(phiU), as_tensor(phiL), as_tensor(phi_offset)
+    neff, ng, wl0, length, loss = (as_tensor(x)[..., None] for x in (neff, ng, wl0, length, loss))
+
+    phiA = ((phiU + phiL)/2)[..., None]
+    phiD = ((phiU - phiL)/2 + phi_offset/2)[..., None]
+    if phi0 is None:
+        neff = neff - (wls - wl0) * (ng - neff) / wl0
+        phi0 = (2 * np.pi * neff * length / wls) % (2 * np.pi)
+
+    a = 1j * 10 ** (-loss / 20) * torch.exp(1j * (phi0 + phiA))
+    S = a[..., None, None] * (torch.sin(phiD)[..., None, None] * _BTU_SIN.to(wls.device)
+                              + torch.cos(phiD)[..., None, None] * _BTU_COS.to(wls.device))
+    return S.to(dtype)
+
+def btu_S_imbalanced(phiU, phiL, phi_offset, wls, neff, ng, wl0, length, loss,
+                     split1=0.5, split2=0.5, dtype=torch.complex128, phi0=None):
+    """ Variant of btu_S_complex with imbalanced directional couplers
+
+    The BTU is an MZI of two directional couplers (power coupling split1
+    and split2, 0.5 for the ideal BTU) around the two arms,
+
+        M = C2 diag(exp(j*phiD), exp(-j*phiD)) C1,   C = [[t, j*k], [j*k, t]],
+
+    times the common-mode phase and loss. With split1 = split2 = 0.5 this
+    is btu_S_complex.
+
+    Args:
+        split1, split2 (Tensor[..., #btus] or float): power coupling of the
+            first and second directional coupler
+
+    Returns:
+        Tensor[..., #btus, #wavelengths, 4, 4] of the given complex dtype
+    """
+    as_tensor = partial(torch.as_tensor, dtype=torch.float64, device=wls.device)
+    phiU, phiL, phi_offset = as_tensor(phiU), as_tensor(phiL), as_tensor(phi_offset)
+    neff, ng, wl0, length, loss = (as_tensor(x)[..., None] for x in (neff, ng, wl0, length, loss))
+    k1, k2 = (torch.sqrt(as_tensor(x))[..., None] for x in (split1, split2))
+    t1, t2 = (torch.sqrt(1 - as_tensor(x))[..., None] for x in (split1, split2))
+
+    phiA = ((phiU + phiL)/2)[..., None]
+    phiD = ((phiU - phiL)/2 + phi_offset/2)[..., None]
+    if phi0 is None:
+        neff = neff - (wls - wl0) * (ng - neff) / wl0
+        phi0 = (2 * np.pi * neff * length / wls) % (2 * np.pi)
+
+    a = 10 ** (-loss / 20) * torch.exp(1j * (phi0 + phiA))
+    eU, eL = torch.exp(1j * phiD), torch.exp(-1j * phiD)
+    shape = torch.broadcast_tensors(a, eU, k1, k2)[0].shape
+    S = torch.zeros(shape + (4, 4), dtype=torch.complex128, device=wls.device)
+    # inputs (1, 2) to outputs (0, 3), the reverse direction by reciprocity
+    S[..., 0, 1] = S[..., 1, 0] = a * (t2 * t1 * eU - k2 * k1 * eL)
+    S[..., 0, 2] = S[..., 2, 0] = 1j * a * (t2 * k1 * eU + k2 * t1 * eL)
+    S[..., 3, 1] = S[..., 1, 3] = 1j * a * (k2 * t1 * eU + t2 * k1 * eL)
+    S[..., 3, 2] = S[..., 2, 3] = a * (t2 * t1 * eL - k2 * k1 * eU)
+    return S.to(dtype)
+###############################################################################
+
+###############################################################################
+## BTU characterization
+###############################################################################
+def btu_transfer(btu, phiU, phiL, wl=None, chunk_size=65536):
+    """ Bar and cross transmission of a BTU for a batch of arm phases
+
+    Light enters port 0, the bar output is port 1 and the cross output is
+    port 2 (as in BTU_char). All (phiU, phiL) points are evaluated with
+    btu_S_batch in chunks of chunk_size points, instead of one
+    initialize() and forward() per point.
+
+    Args:
+        btu (BTU): device whose phi_offset, waveguide parameters and
+            applied_loss are used
+        phiU, phiL (array): arm phases, broadcast against each other, e.g.
+            phiU[:, None] and phiL[None, :] for a 2D map
+        wl (optional, float|array): wavelengths [m], defaults to btu.wl0
+        chunk_size (int): number of phase points evaluated together
+
+    Returns:
+        dict of np.ndarray[..., #wavelengths]: 'bar' and 'cross' power
+    """
+    phiU, phiL = np.broadcast_arrays(np.asarray(phiU, dtype=np.float64),
+                                     np.asarray(phiL, dtype=np.float64))
+    wls = torch.tensor(np.atleast_1d(btu.wl0 if wl is None else wl), dtype=torch.float64)
+    bar = np.zeros((phiU.size, len(wls)))
+    cross = np.zeros((phiU.size, len(wls)))
+    with torch.no_grad():
+        phi_offset = btu.phi_offset.detach().cpu().double()
+        for i in range(0, phiU.size, chunk_size):
+            S = btu_S_batch(
+                phiU.ravel()[i:i+chunk_size], phiL.ravel()[i:i+chunk_size], phi_offset, wls,
+                btu.neff, btu.ng, btu.wl0, btu.length, btu.applied_loss, dtype=torch.float64,
+            )
+            power = (S[0]**2 + S[1]**2).numpy()
+            bar[i:i+chunk_size] = power[..., 1, 0]
+            cross[i:i+chunk_size] = power[..., 2, 0]
+    shape = phiU.shape + (len(wls),)
+    return {'bar': bar.reshape(shape), 'cross': cross.reshape(shape)}
+
+
+def extinction_ratio(power, axis=None):
+    """ Extinction ratio [dB] of a transmission curve or map
+
+    Args:
+        power (array): transmitted power, e.g. btu_transfer(...)['bar']
+        axis (optional, int|tuple): axes over which the ratio of the maximum
+            and minimum power is taken, defaults to all axes
+
+    Returns:
+        float or np.ndarray: 10*log10(max/min)
+    """
+    power = np.asarray(power)
+    return dB10(power.max(axis) / power.min(axis))
 ###############################################################################
      
 ###############################################################################
@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Algorithmic calibration of the BTU phase offsets of a SiROAP mesh.
+
+The phase offset phi_offset of every BTU (fabrication variation) is
+estimated from the powers at the monitor taps and outputs of a configured
+mesh, e.g. p10/p29 and p16/p23 of the APF2 design. The measurements come
+from a measurement source, a callable
+
+    power = measure(phiU, phiL)  # (#configs, #btus) -> (#configs, #detectors)
+
+that programs a batch of configurations and reads all detectors. On the
+bench this wraps the DACs and power monitors, SimulatedChip is a stand-in
+with hidden phase offsets built on the mesh solvers.
+
+MeshCalibration fits the offsets with a model of the mesh (the mesh being
+calibrated, with the adjoint Jacobian of siroap_solvers.SparseMeshSolver):
+
+* 'sweep' (coordinate descent): the upper arm phase of a BTU is swept over
+  a period and its offset searched on a grid against the measured sweep.
+  BTUs that change different detectors are swept together in one round,
+  so a round of num_steps measurements calibrates several BTUs at once.
+  The rounds are searched in turn, each refined by a local fit to its own
+  sweep, and then all offsets by a joint fit, reusing the measurements,
+  until the joint fit no longer improves.
+* 'gradient': all observable BTUs are dithered at once in a batch of
+  random probe configurations, measured in one go, and all offsets are
+  fitted together (Levenberg-Marquardt). Fewest measurements, but only
+  for offsets small enough for the local fit.
+
+Only BTUs whose sweep changes some detected power (observable BTUs) can be
+calibrated in a configuration, the others keep their offsets.
+
+The code is copyright of Vishal Saxena, 2022 and permission and license is
+required to reuse this code.
+
+@author: vsaxena
+"""
+import logging
+import time
+import numpy as np
+import torch
+
+# Import local library
+import siroap_solvers as solvers
+
+
+# diagnostics are logged at DEBUG level, e.g. logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+def _get_wavelength(mesh, wl):
+    """ calibration wavelength, defaults to the wl0 of the first BTU """
+    return float(mesh.get_btu_params()['wl0'][0]) if wl is None else float(wl)
+
+##############################################################################
+## Simulated Measurement Source
+##############################################################################
+class SimulatedChip(object):
+    r""" Stand-in measurement source: the mesh with hidden phase offsets
+
+    Counts the number of measured configurations in num_measurements.
+    """
+
+    def __init__(self, mesh, src_list, det_list, phi_offset, wl=None, source=1, noise=0, seed=None):
+        """
+        Args:
+            mesh (SqrMesh_NxM): the (unterminated) mesh, its BTU parameters
+                other than the phases are used
+            src_list (list): edge port indices of the sources
+            det_list (list): edge port indices of the detectors
+            phi_offset (array[#btus]): the hidden phase offsets of the chip
+            wl (optional, float): laser wavelength, defaults to the wl0 of
+                the BTUs
+            source (float|array): field amplitude of each source
+            noise (float): relative rms noise of the detected powers
+            seed (optional, int): seed of the noise
+        """
+        self.solver = solvers.SparseMeshSolver(mesh, src_list, det_list)
+        self.phi_offset = torch.as_tensor(phi_offset, dtype=torch.float64)
+        self.wl = _get_wavelength(mesh, wl)
+        self.source = np.broadcast_to(np.asarray(source, dtype=np.complex128), (len(self.solver.src_list),))
+        self.noise = float(noise)
+        self.rng = np.random.default_rng(seed)
+        self.num_measurements = 0
+
+    def __call__(self, phiU, phiL):
+        """ detected powers np.ndarray[#configs, #detectors] of a batch of configurations """
+        phiU = torch.as_tensor(phiU, dtype=torch.float64)
+        phiL = torch.as_tensor(phiL, dtype=torch.float64)
+        phi_offset = self.phi_offset.expand(phiU.shape)
+        H = self.solver.solve_batch(phiU, phiL, phi_offset, wl=[self.wl])[:, 0]
+        power = np.abs(H @ self.source)**2
+        if self.noise > 0:
+            power = power*(1 + self.noise*self.rng.standard_normal(power.shape))
+        self.num_measurements += len(power)
+        return power
+
+##############################################################################
+## Mesh Calibration
+##############################################################################
+class MeshCalibration(object):
+    r""" Estimate the phi_offset of all observable BTUs from detected powers
+
+    The estimates are written to the phi_offset parameters of the mesh.
+    """
+
+    def __init__(self, mesh, measure, src_list, det_list, wl=None, source=1,
+                 num_steps=8, tol=1e-4, overlap=0.05):
+        """
+        Args:
+            mesh (SqrMesh_NxM): the (unterminated) mesh to calibrate, its
+                phi_offsets are the starting point of the fit
+            measure (callable): measurement source, see SimulatedChip
+            src_list (list): edge port indices of the sources
+            det_list (list): edge port indices of the detectors, in the
+                sorted order of the measured powers
+            wl (optional, float): laser wavelength, defaults to the wl0 of
+                the BTUs
+            source (float|array): field amplitude of each source
+            num_steps (int): measurements per sweep of the upper arm phase
+            tol (float): smallest detected power change [W/W of source] of
+                an observable BTU
+            overlap (float): detectors whose power a BTU changes by more than
+                overlap times its largest change belong to that BTU, BTUs
+                that share detectors are swept in different rounds. None
+                sweeps one BTU at a time (its grid search still uses the
+                detectors it changes by more than 5% of its largest change).
+        """
+        self.mesh = mesh
+        self.measure = measure
+        self.solver = solvers.SparseMeshSolver(mesh, src_list, det_list)
+        self.wl = _get_wavelength(mesh, wl)
+        self.source = np.broadcast_to(np.asarray(source, dtype=np.complex128), (len(self.solver.src_list),))
+        self.theta = 2*np.pi*np.arange(num_steps)/num_steps
+        self.tol = float(tol)
+        self.overlap = overlap
+        self.keys = list(mesh.components.keys())
+
+    def get_power(self, phiU, phiL, phi_offset):
+        """ model powers np.ndarray[#configs, #detectors] of a batch of configurations """
+        phiU, phiL, phi_offset = torch.broadcast_tensors(*[
+            torch.as_tensor(x, dtype=torch.float64) for x in (phiU, phiL, phi_offset)
+        ])
+        H = self.solver.solve_batch(phiU, phiL, phi_offset, wl=[self.wl])[:, 0]
+        return np.abs(H @ self.source)**2
+
+    def get_jacobian(self, phiU, phiL, phi_offset):
+        """ model powers and their derivatives to the phase offsets
+
+        Returns:
+            power (np.ndarray[#configs, #detectors]) and
+            jacobian (np.ndarray[#configs, #detectors, #btus])
+        """
+        phi_offset = torch.as_tensor(phi_offset, dtype=torch.float64).expand(phiU.shape)
+        out = self.solver.get_jacobian(self.source, [self.wl], phiU, phiL, phi_offset)
+        return out['power'][:, 0], out['phi_offset'][:, 0]
+
+    def get_sweeps(self, phiU, phiL, btus):
+        """ configurations sweeping the upper arm phase of btus together
+
+        Returns:
+            phiU, phiL (Tensor[#steps, #btus]): the swept configurations
+        """
+        phiU = phiU.repeat(len(self.theta), 1)
+        phiU[:, btus] += torch.as_tensor(self.theta)[:, None]
+        return phiU, phiL.repeat(len(self.theta), 1)
+
+    def get_schedule(self, phiU, phiL, phi_offset):
+        """ observable BTUs and rounds of BTUs that are swept together
+
+        The sweep of every BTU is simulated on the model to find the
+        detectors it changes.
+
+        Returns:
+            observable (np.ndarray[#btus] (bool)), rounds (list of
+            np.ndarray of mesh indices) and the detector change of every
+            BTU sweep (np.ndarray[#btus, #detectors])
+        """
+        K, S = len(self.keys), len(self.theta)
+        configU = phiU.repeat(K, S, 1)
+        configU[torch.arange(K), :, torch.arange(K)] += torch.as_tensor(self.theta)
+        power = self.get_power(configU.reshape(K*S, K), phiL.expand(K*S, K), phi_offset)
+        change = np.ptp(power.reshape(K, S, -1), axis=1)
+        observable = change.max(1) > self.tol
+
+        # greedy colouring of the BTUs that share detectors, strongest first
+        rounds, used = [], []
+        for k in np.argsort(-change.max(1)):
+            if not observable[k]:
+                continue
+            dets = change[k] > (0 if self.overlap is None else self.overlap*change[k].max())
+            for r in range(len(rounds)):
+                if self.overlap is not None and not (used[r] & dets).any():
+                    rounds[r].append(k)
+                    used[r] |= dets
+                    break
+            else:
+                rounds.append([k])
+                used.append(dets.copy())
+        logger.debug("Calibration: %i observable BTUs in %i rounds" % (observable.sum(), len(rounds)))
+        return observable, [np.array(sorted(r)) for r in rounds], change
+
+    def fit(self, phiU, phiL, data, btus, phi_offset, max_iter=50, tol=1e-6, max_step=np.pi/4):
+        """ Levenberg-Marquardt fit of the offsets of btus to measured powers
+
+        Args:
+            phiU, phiL (Tensor[#configs, #btus]): measured configurations
+            data (np.ndarray[#configs, #detectors]): measured powers
+            btus (np.ndarray): mesh indices of the fitted offsets
+            phi_offset (np.ndarray[#btus]): starting point, the other
+                offsets stay fixed
+            max_iter (int): Levenberg-Marquardt iterations
+            tol (float): converged when no offset changes by more than tol
+            max_step (float): largest change of an offset per iteration
+
+        Returns:
+            phi_offset (np.ndarray[#btus]), the sum of the squared
+            residuals (float) and whether the fit converged (bool)
+        """
+        x = phi_offset.copy()
+        damping, stalled, last_step = 1e-3, 0, np.inf
+        power, jacobian = self.get_jacobian(phiU, phiL, x)
+        cost = ((power - data)**2).sum()
+        for step in range(max_iter):
+            r = (power - data).ravel()
+            J = jacobian[:, :, btus].reshape(len(r), len(btus))
+            JJ, Jr = J.T @ J, J.T @ r
+            scale = np.diag(np.diag(JJ)) + 1e-12*np.eye(len(btus))
+            while damping < 1e6:
+                dx = -np.linalg.solve(JJ + damping*scale, Jr)
+                # the powers are periodic in the offsets, limit the step
+                dx *= min(1, max_step/np.abs(dx).max())
+                trial = x.copy()
+                trial[btus] += dx
+                trial_cost = ((self.get_power(phiU, phiL, trial) - data)**2).sum()
+                if trial_cost <= cost:
+                    break
+                damping *= 10
+            else:
+                # no descent direction left: at a minimum to machine precision
+                return x, cost, True
+            # stop crawling along a flat valley, away from a minimum. Near a
+            # minimum with a nonzero residual (model mismatch), the cost
+            # settles as well but the steps keep shrinking.
+            step_size = np.abs(dx).max()
+            crawling = trial_cost > (1 - 1e-3)*cost and step_size > 0.9*last_step
+            stalled = stalled + 1 if crawling else 0
+            last_step = step_size
+            x, cost = trial, trial_cost
+            damping = max(damping/10, 1e-9)
+            if np.abs(dx).max() < tol:
+                return x, cost, True
+            if stalled == 5:
+                break
+            power, jacobian = self.get_jacobian(phiU, phiL, x)
+        return x, cost, False
+
+    def search(self, phiU, phiL, data, btus, phi_offset, dets, num_points=16):
+        """ grid search of the offsets of btus swept together
+
+        The offsets of all btus are set to the same grid value at a time and
+        every BTU picks the best value on its own detectors, so BTUs that
+        share no detectors are searched together.
+
+        Args:
+            phiU, phiL (Tensor[#steps, #btus]): the measured sweep
+            data (np.ndarray[#steps, #detectors]): measured powers
+            btus (np.ndarray): mesh indices of the swept BTUs
+            phi_offset (np.ndarray[#btus]): current offsets, kept for the
+                BTUs that no grid value fits better
+            dets (np.ndarray[#btus, #detectors] (bool)): detectors of every BTU
+            num_points (int): grid points over [-pi, pi)
+
+        Returns:
+            np.ndarray[#btus]: the new offsets
+        """
+        grid = np.append(2*np.pi*np.arange(num_points)/num_points - np.pi, np.nan)
+        x = np.repeat(phi_offset[None], num_points + 1, 0)
+        x[:num_points, btus] = grid[:num_points, None]
+        C = len(phiU)
+        power = self.get_power(phiU.repeat(num_points + 1, 1), phiL.repeat(num_points + 1, 1),
+                               torch.as_tensor(x).repeat_interleave(C, 0))
+        err = ((power.reshape(num_points + 1, C, -1) - data)**2).sum(1) # (#grid + 1, #detectors)
+        x = phi_offset.copy()
+        for k in btus:
+            best = np.argmin(err[:, dets[k]].sum(1))
+            if best < num_points:
+                x[k] = grid[best]
+        return x
+
+    def run(self, mesh_dict=None, method='sweep', max_sweeps=10, num_probes=None, tol=1e-6, seed=None):
+        """ calibrate the offsets of the observable BTUs
+
+        Both methods end with a joint Levenberg-Marquardt fit of all
+        observable offsets to all measurements, 'sweep' starts it from the
+        refined grid estimates of the sweeps and 'gradient' from the current offsets
+        of the mesh. The BTU S-matrix is periodic in phi_offset with 4*pi
+        (a shift by 2*pi changes its sign), the estimates are returned in
+        (-2*pi, 2*pi]. The sign only matters for BTUs inside a loop, the
+        offsets of the others are found modulo 2*pi.
+
+        Args:
+            mesh_dict (optional, dict): configuration to calibrate in, on top
+                of the current states of the mesh
+            method (str): 'sweep' or 'gradient'
+            max_sweeps (int): coordinate descent passes over the rounds
+            num_probes (optional, int): probe configurations of 'gradient',
+                defaults to twice the number of observable BTUs
+            tol (float): convergence tolerance of the offsets [rad]
+            seed (optional, int): seed of the probe configurations
+
+        Returns:
+            dict: the estimated 'phi_offset' (np.ndarray[#btus]), the
+            'observable' BTUs (keys), the 'rounds' of BTUs swept together,
+            'num_measurements', the coordinate descent 'passes', the rms
+            'residual' of the detected powers, 'converged' and the 'time' [s]
+            spent in the model. Without observable BTUs nothing is measured
+            and the result is not converged.
+        """
+        if method not in ['sweep', 'gradient']:
+            raise ValueError("unknown method '%s'" % method)
+        t0 = time.perf_counter()
+        phiU, phiL = self.mesh.get_config_batch([mesh_dict or {}])
+        phiU, phiL = phiU[0], phiL[0]
+        x = self.mesh.get_btu_params()['phi_offset'].detach().cpu().numpy().astype(np.float64)
+        observable, rounds, change = self.get_schedule(phiU, phiL, x)
+        # the detectors of a BTU, on which its grid search is done, also when
+        # the BTUs are swept one at a time
+        fraction = 0.05 if self.overlap is None else self.overlap
+        dets = change > fraction*change.max(1, keepdims=True)
+        btus = np.where(observable)[0]
+        t_measure, passes = 0, 0
+        if len(btus) == 0:
+            logger.info("Calibration: no BTU changes the detected powers by more than %.1e" % self.tol)
+            return {'phi_offset': x, 'observable': [], 'rounds': [], 'num_measurements': 0,
+                    'passes': 0, 'residual': np.nan, 'converged': False,
+                    'time': time.perf_counter() - t0}
+
+        if method == 'sweep':
+            configs = [self.get_sweeps(phiU, phiL, r) for r in rounds]
+            configU = torch.cat([U for U, _ in configs])
+            configL = torch.cat([L for _, L in configs])
+            t1 = time.perf_counter()
+            power = self.measure(configU, configL)
+            t_measure += time.perf_counter() - t1
+
+            # block coordinate descent: every round on the grid and refined
+            # on its own sweep, then a joint fit, until the fit settles
+            S = len(self.theta)
+            cost, converged = np.inf, False
+            for passes in range(1, max_sweeps + 1):
+                x_grid = x
+                for n, r in enumerate(rounds):
+                    rows = slice(n*S, (n + 1)*S)
+                    x_grid = self.search(configU[rows], configL[rows], power[rows], r, x_grid, dets)
+                    x_grid = self.fit(configU[rows], configL[rows], power[rows], r, x_grid, tol=tol)[0]
+                logger.debug("Calibration pass %i: max offset change %.3e"
+                             % (passes, np.abs(x_grid - x)[btus].max()))
+                x_fit, cost_fit, converged_fit = self.fit(configU, configL, power, btus, x_grid, tol=tol)
+                settled = cost_fit > (1 - 1e-6)*cost
+                if cost_fit < cost:
+                    # keep the best pass, with its convergence
+                    x, cost, converged = x_fit, cost_fit, converged_fit
+                if settled:
+                    break
+            else:
+                converged = False
+        else:
+            rng = np.random.default_rng(seed)
+            num_probes = 2*len(btus) if num_probes is None else num_probes
+            configU = phiU.repeat(num_probes, 1)
+            configU[:, btus] += torch.as_tensor(rng.uniform(0, 2*np.pi, (num_probes, len(btus))))
+            configL = phiL.repeat(num_probes, 1)
+            t1 = time.perf_counter()
+            power = self.measure(configU, configL)
+            t_measure += time.perf_counter() - t1
+            x, cost, converged = self.fit(configU, configL, power, btus, x, tol=tol)
+
+        residual = np.sqrt(cost/power.size)
+        logger.debug("Calibration: rms residual %.3e, converged %s" % (residual, converged))
+        x[btus] = 2*np.angle(np.exp(0.5j*x[btus]))
+        for k in btus:
+            self.mesh.components[self.keys[k]].phi_offset.data.fill_(float(x[k]))
+        return {'phi_offset': x, 'observable': [self.keys[k] for k in btus],
+                'rounds': [[self.keys[k] for k in r] for r in rounds],
+                'num_measurements': len(power), 'passes': passes, 'residual': residual,
+                'converged': converged, 'time': time.perf_counter() - t0 - t_measure}
+###############################################################################
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+DAC heater model of the SiROAP square mesh.
+
+The BTUs of the mesh are driven by phase (phiU, phiL), while the chip is
+programmed with the DAC codes of the arm heaters. HeaterDAC converts
+between the two with a calibration lookup table (LUT) per heater: the
+phase of the heater at a common grid of DAC codes. The LUTs of all
+heaters are interpolated together, in both directions, so a batch of
+mesh_dicts becomes a batch of DAC write vectors in one call and a batch
+of DAC write vectors can be simulated directly.
+
+The DAC write vector holds the codes of the upper arm heaters of all BTUs
+(in network order) followed by those of the lower arms, the heater order
+of siroap_thermal. The default LUT is that of a resistive heater driven
+by a voltage DAC, phase = phase_max*(code/code_max)^2, measured LUTs are
+set with set_lut.
+
+The code is copyright of Vishal Saxena, 2022 and permission and license is
+required to reuse this code.
+
+@author: vsaxena
+"""
+import logging
+import numpy as np
+import torch
+
+
+# diagnostics are logged at DEBUG level, e.g. logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+##############################################################################
+## Heater DAC
+##############################################################################
+class HeaterDAC(object):
+    r""" Per-heater DAC code <-> phase lookup tables of a SqrMesh_NxM
+
+    A heater only heats, so a phase is realized modulo 2*pi above the phase
+    of code 0. Phases beyond the range of a LUT raise a ValueError.
+    """
+
+    def __init__(self, mesh, bits=12, phase_max=2.5*np.pi, num_points=65):
+        """
+        Args:
+            mesh (SqrMesh_NxM): the mesh whose heaters are driven
+            bits (int): resolution of the DACs
+            phase_max (float|array[2*#btus]): phase at the full-scale code of
+                the default LUTs, per heater for spread heater efficiencies
+            num_points (int): number of codes in the default LUTs
+        """
+        self.mesh = mesh
+        self.bits = int(bits)
+        code_max = 2**self.bits - 1
+        codes = np.round(np.linspace(0, code_max, num_points))
+        phase_max = np.broadcast_to(np.asarray(phase_max, dtype=np.float64), (self.num_heaters,))
+        self.set_lut(codes, phase_max[:, None]*(codes/code_max)**2)
+
+    @property
+    def num_heaters(self):
+        """ two heaters (upper and lower arm) per BTU """
+        return 2*len(self.mesh.components)
+
+    @property
+    def channels(self):
+        """ (btu_key, 'phiU'|'phiL') of every entry of the DAC write vector """
+        keys = list(self.mesh.components.keys())
+        return [(key, 'phiU') for key in keys] + [(key, 'phiL') for key in keys]
+
+    def set_lut(self, codes, phases):
+        """ set the calibration LUTs
+
+        Args:
+            codes (array[#points]): increasing DAC codes of the LUTs
+            phases (array[2*#btus, #points]): increasing phase of every
+                heater at these codes
+        """
+        self.codes = torch.as_tensor(codes, dtype=torch.float64)
+        self.phases = torch.as_tensor(phases, dtype=torch.float64).expand(self.num_heaters, -1).contiguous()
+        if (self.codes.diff() <= 0).any() or (self.phases.diff() <= 0).any():
+            raise ValueError("the LUT codes and phases have to be increasing")
+        logger.debug("DAC: %i heaters, %i LUT points" % self.phases.shape)
+
+    def _interpolate(self, x, xp, fp, index):
+        """ linear interpolation of every heater in the LUT interval index
+
+        Args:
+            x (Tensor[#vectors, 2*#btus]): points to interpolate
+            xp, fp (Tensor[2*#btus, #points]): LUTs of the heaters
+            index (Tensor[#vectors, 2*#btus]): upper LUT point of the
+                interval of every point
+        """
+        heater = torch.arange(self.num_heaters)
+        x0, x1 = xp[heater, index - 1], xp[heater, index]
+        f0, f1 = fp[heater, index - 1], fp[heater, index]
+        return f0 + (f1 - f0)*(x - x0)/(x1 - x0)
+
+    def wrap(self, phi):
+        """ phases Tensor[..., 2*#btus] wrapped to the 2*pi above the phase of code 0 """
+        phi0 = self.phases[:, 0]
+        return phi0 + torch.remainder(phi - phi0, 2*np.pi)
+
+    def to_phases(self, codes):
+        """ heater phases of DAC write vectors
+
+        Args:
+            codes (array[..., 2*#btus]): DAC write vectors
+
+        Returns:
+            phiU, phiL (Tensor[..., #btus], float64): heater phases
+        """
+        codes = torch.as_tensor(codes, dtype=torch.float64)
+        shape = codes.shape
+        codes = codes.reshape(-1, self.num_heaters)
+        index = torch.searchsorted(self.codes, codes.contiguous(), right=True).clamp(1, len(self.codes) - 1)
+        lut = self.codes.expand(self.num_heaters, -1)
+        phi = self._interpolate(codes, lut, self.phases, index).reshape(shape)
+        K = len(self.mesh.components)
+        return phi[..., :K], phi[..., K:]
+
+    def to_codes(self, phiU, phiL, wrap=True, tol=1e-9):
+        """ DAC write vectors of heater phases
+
+        Args:
+            phiU, phiL (array[..., #btus]): heater phases
+            wrap (bool): wrap the phases to the 2*pi above the phase of
+                code 0 first. Only without thermal crosstalk, with it the
+                heaters can not be wrapped one by one (see get_codes).
+            tol (float): phases this far outside a LUT are clipped to it
+
+        Returns:
+            np.ndarray[..., 2*#btus] (int64): DAC write vectors
+        """
+        phiU = torch.as_tensor(phiU, dtype=torch.float64)
+        phiL = torch.as_tensor(phiL, dtype=torch.float64)
+        shape = torch.broadcast_tensors(phiU, phiL)[0].shape
+        phi = torch.cat([phiU.expand(shape), phiL.expand(shape)], -1).reshape(-1, self.num_heaters)
+
+        if wrap:
+            phi = self.wrap(phi)
+        outside = (phi < self.phases[:, 0] - tol) | (phi > self.phases[:, -1] + tol)
+        if outside.any():
+            key, arm = self.channels[int(torch.where(outside)[1][0])]
+            raise ValueError("%i heater phases outside the LUT range, e.g. %s of %s"
+                             % (outside.sum(), arm, key))
+        phi = torch.minimum(torch.maximum(phi, self.phases[:, 0]), self.phases[:, -1])
+
+        # the LUTs differ per heater: search with the heaters as batch dimension
+        index = torch.searchsorted(self.phases, phi.T.contiguous(), right=True).T
+        index = index.clamp(1, len(self.codes) - 1)
+        codes = self._interpolate(phi, self.phases, self.codes.expand(self.num_heaters, -1), index)
+        codes = torch.round(codes).clamp(self.codes[0], self.codes[-1])
+        return codes.to(torch.int64).reshape(shape[:-1] + (self.num_heaters,)).numpy()
+
+    def get_codes(self, mesh_dicts, max_iter=10, tol=1e-9):
+        """ DAC write vectors of a batch of mesh configurations
+
+        The states of the mesh_dicts are the effective phases the light
+        should see (as in SqrMesh_NxM.get_compensated_batch). They are
+        wrapped to the 2*pi above the phase of code 0 and, if the mesh has
+        a thermal model, its crosstalk is inverted for the wrapped targets.
+        A heater that would have to cool, because its neighbours already
+        heat it beyond its target, gets its target shifted by 2*pi and the
+        crosstalk is inverted again.
+
+        Args:
+            mesh_dicts (list): one dict of {btu_key: state} per configuration
+            max_iter (int): largest number of 2*pi shifts of a heater
+            tol (float): phases this far outside a LUT are clipped to it
+
+        Returns:
+            np.ndarray[#configs, 2*#btus] (int64)
+        """
+        mesh = self.mesh
+        K = len(mesh.components)
+        params = mesh.get_btu_params()
+        with torch.no_grad():
+            phiU, phiL = mesh.get_effective_phases(params['phiU'].double(), params['phiL'].double())
+        phiU, phiL = mesh.get_config_batch(mesh_dicts, phiU, phiL)
+        target = self.wrap(torch.cat([phiU, phiL], -1))
+        if mesh.thermal is None:
+            return self.to_codes(target[:, :K], target[:, K:], wrap=False, tol=tol)
+
+        for step in range(max_iter):
+            phiU, phiL = mesh.thermal.compensate(target[:, :K], target[:, K:])
+            low = torch.cat([phiU, phiL], -1) < self.phases[:, 0] - tol
+            if not low.any():
+                return self.to_codes(phiU, phiL, wrap=False, tol=tol)
+            logger.debug("DAC: %i heater targets shifted by 2*pi" % low.sum())
+            target = target + 2*np.pi*low
+        raise ValueError("%i heater phases below code 0 after %i shifts by 2*pi" % (low.sum(), max_iter))
+
+    def forward_codes(self, codes, src_list, det_list, source=1):
+        """ detected power of a batch of DAC write vectors
+
+        Args:
+            codes (array[#configs, 2*#btus]): DAC write vectors
+            src_list (list): edge port indices of the sources
+            det_list (list): edge port indices of the detectors
+            source (float|array): field amplitude of each source
+
+        Returns:
+            Tensor[#configs, 1, #wavelengths, #detectors, 1], see
+            SqrMesh_NxM.forward_batch
+        """
+        phiU, phiL = self.to_phases(codes)
+        return self.mesh.forward_batch(phiU, phiL, src_list, det_list, source)
+###############################################################################
@@ -11,10 +11,13 @@ Created on Fri Jul 30 21:17:26 2021
 
 @author: vsaxena
 """
+import logging
 import numpy as np
 import torch 
 import photontorch as pt 
 
+from collections import OrderedDict
+
 # Relative
 from photontorch.components.terms import Source
 from photontorch.components.terms import Detector
@@ -24,9 +27,11 @@ from photontorch.nn.nn import Parameter, Buffer
 
 # Import local library
 import sip_library as sip
+import siroap_solvers as solvers
 
 
-_DEBUG = True
+# diagnostics are logged at DEBUG level, e.g. logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
 
 ##############################################################################
 ## Square Mesh Class
@@ -35,6 +40,38 @@ _DEBUG = True
 state_dict = {'bar': [np.pi, 0.],
              'cross': [0., 0.]}
 
+# Neighbour directions of the topology table (columns of btu_neighbors)
+directions = ['UL', 'UR', 'LL', 'LR']
+
+# Links of V i_j to its neighbours: (V port, neighbour direction, H port)
+_V_LINKS = [(3, 1, 0), (2, 3, 3), (0, 0, 1), (1, 2, 2)]
+
+def get_state_phases(state):
+    """ (phiU, phiL) of a BTU state such as ['coupler', kappa]
+
+    The parameter may also be a Tensor (e.g. of a batch of states), the
+    phases then stay attached to it.
+    """
+    if state[0] == 'bar':
+        phiU = state_dict['bar'][0]
+        phiL = state_dict['bar'][1]
+    elif state[0] == 'cross':
+        phiU = state_dict['cross'][0]
+        phiL = state_dict['cross'][1]
+    elif state[0] == 'coupler':
+        arccos = torch.arccos if torch.is_tensor(state[1]) else np.arccos
+        phiU = 2*arccos(state[1]) # param = kappa
+        phiL = 0
+    elif state[0] == 'phase_shifter_bar':
+        phiU = state_dict['bar'][0] + state[1] # param = theta
+        phiL = state_dict['bar'][1] + state[1]
+    elif state[0] == 'phase_shifter_cross':
+        phiU = state_dict['cross'][0] + state[1] # param = theta
+        phiL = state_dict['cross'][0] + state[1]
+    else:
+        logger.error("Bad arguments to function set_state: %s" % (state,))
+    return phiU, phiL
+
 def _btu_factory():
     return sip.BTU(
         phiU=0,
@@ -50,6 +87,10 @@ def _btu_factory():
 
 class SqrMesh_NxM(pt.Network):
     """ A helper network for SqrMesh_NxN """    
+
+    # optional heater crosstalk model, e.g. siroap_thermal.ThermalCrosstalk
+    thermal = None
+
     def __init__(self,  
             N=2, M=2, btu_factory=_btu_factory, name=None,
             ):
@@ -70,95 +111,375 @@ class SqrMesh_NxM(pt.Network):
         for i in range(self.N):
             for j in range(self.M+1):
                 components["V%i_%i" % (i,j)] = btu_factory()
-                if (_DEBUG): print("V%i_%i created" % (i,j))
 
         for i in range(self.N+1):
             for j in range(self.M):
                 components["H%i_%i" % (i,j)] = btu_factory()
-                if (_DEBUG): print("H%i_%i created" % (i,j))
 
-        if (_DEBUG): print(components)
+        logger.debug("%i BTUs created" % len(components))
 
-        # Define connections between components
-        connections = []
-        
-        # Connect up all the vertical BTUs to the horizontal ones       
-        for i in range(self.N):
-            for j in range(self.M+1):
-                
-                # Connect vertical BTU V(i,j) to the horizontal BTUs top-right and bottom-right
-                if j < self.M :
-                    connections += ["V%i_%i:3:H%i_%i:0" % (i, j, i, j)]
-                    connections += ["V%i_%i:2:H%i_%i:3" % (i, j, (i+1), j)]
-                
-                # Connect vertical BTU V(i,j) to the horizontal BTUs top-left and bottom-left
-                if j>0:
-                    connections += ["V%i_%i:0:H%i_%i:1" % (i, j, i, j-1)]
-                    connections += ["V%i_%i:1:H%i_%i:2" % (i, j, (i+1), j-1)]
-                
-                if (_DEBUG): print("Connections to V%i_%i initialized" % (i,j))
-                        
-        
-        # Connect the optical I/O connections
-        
-        # West Edge connections
-        for i in range(self.N):            
-            connections += ["V%i_%i:0:%i" % (i, 0, 2*i)]
-            connections += ["V%i_%i:1:%i" % (i, 0, 2*i+1)]
-        
-        if (_DEBUG): print("West Edge I/O defined")
-        
-        # South Edge connections    
-        for j in range(self.M):                        
-            connections += ["H%i_%i:0:%i" % (self.N, j, 2*self.N+2*j)]
-            connections += ["H%i_%i:1:%i" % (self.N, j, 2*self.N+2*j+1)]
-        
-        if (_DEBUG): print("South Edge I/O defined")
-                                     
-        # East Edge connections
-        for i in range(self.N):            
-            connections += ["V%i_%i:2:%i" % (self.N-1-i, self.N, 2*(self.N+self.M)+2*i)]
-            connections += ["V%i_%i:3:%i" % (self.N-1-i, self.N, 2*(self.N+self.M)+2*i+1)]            
-
-        if (_DEBUG): print("East Edge I/O defined")
-        
-        # North Edge connections
-        for j in range(self.M):            
-            connections += ["H%i_%i:2:%i" % (0, self.M-1-j, 2*(2*self.N+self.M)+2*j)]
-            connections += ["H%i_%i:3:%i" % (0, self.M-1-j, 2*(2*self.N+self.M)+2*j+1)]
-         
-        if (_DEBUG): print("North Edge I/O defined")
-        
-        if (_DEBUG): print(connections)
-                
-        # initialize network   
+        # The connections between the BTUs and the edge I/O follow from the
+        # topology table and are set as index arrays by _set_buffers, instead
+        # of being parsed from connection strings (see get_connections).
+        keys = list(components.keys())
+        self.set_topology(keys)
+
+        # keep the component order of the connection strings: every V i_j
+        # (row by row) followed by its UR, LR, UL and LL neighbours
+        V = np.where(self.btu_vertical)[0]
+        seq = np.concatenate([V[:, None], self.btu_neighbors[V][:, [1, 3, 0, 2]]], 1).ravel()
+        seq = seq[seq >= 0]
+        used, first = np.unique(seq, return_index=True)
+        order = np.concatenate([used[np.argsort(first)], np.setdiff1d(np.arange(len(keys)), used)])
+        components = OrderedDict((keys[k], components[keys[k]]) for k in order)
+        self.set_topology(list(components.keys()))
+        logger.debug("Topology of the %ix%i mesh defined" % (self.N, self.M))
+
+        # initialize network
         super(SqrMesh_NxM, self).__init__(
-            components, connections, name=name
+            components, name=name
+        )
+
+    def get_connections(self):
+        """ Connection strings of the mesh, in the photontorch format
+
+        The mesh itself is built from index arrays, the strings are only
+        generated on request, e.g. to rebuild the mesh as a plain pt.Network
+        or for pt.Network.graph.
+        """
+        keys = self.btu_keys
+        connections = []
+        for k in np.where(self.btu_vertical)[0]:
+            for p, d, q in _V_LINKS:
+                n = self.btu_neighbors[k, d]
+                if n >= 0:
+                    connections += ["%s:%i:%s:%i" % (keys[k], p, keys[n], q)]
+        connections += ["%s:%i:%i" % (keys[k], p, e) for e, (k, p) in enumerate(self.edge_btu_ports)]
+        return connections
+
+    def graph(self, draw=True):
+        """ pt.Network.graph, with the connection strings generated for it """
+        self.connections = self.get_connections()
+        return super(SqrMesh_NxM, self).graph(draw)
+
+    def _set_buffers(self):
+        """ create the network buffers without parsing connection strings
+
+        Same as pt.Network._set_buffers, with the components in the order
+        given to __init__ and set_C/set_port_order working on the index
+        arrays of the topology table.
+        """
+        components = OrderedDict(
+            (name, comp) for name, comp in self._modules.items() if isinstance(comp, Component)
+        )
+        # the Component constructor runs this before the BTUs are added
+        if not components:
+            return
+        self.components = components
+        for name, comp in self.components.items():
+            comp.name = name
+        Component._set_buffers(self)
+
+    def _get_port_index(self):
+        """ network port index np.ndarray[#btus, 4] of every BTU port """
+        index = []
+        start = 0
+        for comp in self.components.values():
+            free = comp.port_order[comp.free_ports_at[comp.port_order]]
+            index.append(start + free.cpu().numpy())
+            start += comp.num_ports
+        return np.stack(index)
+
+    def set_C(self, C):
+        """ connection matrix of the mesh from the topology table """
+        idx = 0
+        for comp in self.components.values():
+            comp.set_C(C[idx : idx + comp.num_ports, idx : idx + comp.num_ports])
+            idx += comp.num_ports
+
+        index = self._get_port_index()
+        V = np.where(self.btu_vertical)[0]
+        for p, d, q in _V_LINKS:
+            n = self.btu_neighbors[V, d]
+            i = torch.as_tensor(index[V[n >= 0], p], device=C.device)
+            j = torch.as_tensor(index[n[n >= 0], q], device=C.device)
+            C[i, j] = 1.0
+            C[j, i] = 1.0
+
+    def set_port_order(self, port_order):
+        """ port order of the mesh: the edge I/O first, in edge index order """
+        idx = 0
+        for comp in self.components.values():
+            p = comp.num_ports
+            comp.set_port_order(port_order[idx : idx + p])
+            port_order[idx : idx + p] += idx
+            idx += p
+
+        index = self._get_port_index()
+        edge = index[self.edge_btu_ports[:, 0], self.edge_btu_ports[:, 1]]
+        order = np.concatenate([edge, np.setdiff1d(np.arange(self.num_ports), edge)])
+        port_order[:] = port_order.clone()[torch.as_tensor(order, device=port_order.device)]
+
+    def set_topology(self, keys=None):
+        """ Integer topology table of the mesh, built at construction
+
+        Args:
+            keys (optional, list): BTU keys in network (component) order,
+                defaults to the components of the network
+
+        Sets:
+            btu_keys (list): BTU keys in network (component) order
+            btu_index (dict): key -> BTU index
+            btu_grid (np.ndarray[#btus, 2]): (i, j) of every BTU
+            btu_vertical (np.ndarray[#btus]): True for the V BTUs
+            btu_neighbors (np.ndarray[#btus, 4]): index of the neighbour in
+                the UL, UR, LL, LR directions, -1 at the mesh edges
+            cell_btus (np.ndarray[N, M, 4]): top H, right V, bottom H and
+                left V BTU of every cell (ring)
+            edge_btu_ports (np.ndarray[4*(N+M), 2]): (BTU index, port) of
+                every edge I/O
+        """
+        N, M = self.N, self.M
+        self.btu_keys = list(self.components.keys()) if keys is None else list(keys)
+        self.btu_index = {key: k for k, key in enumerate(self.btu_keys)}
+        V = -np.ones((N + 2, M + 3), dtype=np.int64)  # V[i+1, j+1] = V i_j, -1 padded
+        H = -np.ones((N + 3, M + 2), dtype=np.int64)  # H[i+1, j+1] = H i_j, -1 padded
+        V[1:N+1, 1:M+2] = [[self.btu_index["V%i_%i" % (i, j)] for j in range(M+1)] for i in range(N)]
+        H[1:N+2, 1:M+1] = [[self.btu_index["H%i_%i" % (i, j)] for j in range(M)] for i in range(N+1)]
+
+        K = len(self.btu_keys)
+        self.btu_grid = np.zeros((K, 2), dtype=np.int64)
+        self.btu_vertical = np.zeros(K, dtype=bool)
+        self.btu_neighbors = -np.ones((K, 4), dtype=np.int64)
+        i, j = np.meshgrid(np.arange(N), np.arange(M+1), indexing='ij')
+        k = V[i+1, j+1]
+        self.btu_grid[k] = np.stack([i, j], -1)
+        self.btu_vertical[k] = True
+        self.btu_neighbors[k] = np.stack([H[i+1, j], H[i+1, j+1], H[i+2, j], H[i+2, j+1]], -1)
+        i, j = np.meshgrid(np.arange(N+1), np.arange(M), indexing='ij')
+        k = H[i+1, j+1]
+        self.btu_grid[k] = np.stack([i, j], -1)
+        self.btu_neighbors[k] = np.stack([V[i, j+1], V[i, j+2], V[i+1, j+1], V[i+1, j+2]], -1)
+
+        i, j = np.meshgrid(np.arange(N), np.arange(M), indexing='ij')
+        self.cell_btus = np.stack([H[i+1, j+1], V[i+1, j+2], H[i+2, j+1], V[i+1, j+1]], -1)
+
+        # edge I/O in the order of the connections in __init__
+        west = [(V[i+1, 1], p) for i in range(N) for p in (0, 1)]
+        south = [(H[N+1, j+1], p) for j in range(M) for p in (0, 1)]
+        east = [(V[N-i, M+1], p) for i in range(N) for p in (2, 3)]
+        north = [(H[1, M-j], p) for j in range(M) for p in (2, 3)]
+        self.edge_btu_ports = np.array(west + south + east + north, dtype=np.int64)
+
+    def get_port_map(self):
+        """ Port connectivity of the mesh in terms of global port indices
+
+        The global index of port p of the k-th BTU (network component order)
+        is 4*k + p.
+
+        Returns:
+            pairs (np.ndarray[#connections, 2]): internally connected ports
+            edge_ports (np.ndarray[4*(N+M)]): global port of each edge I/O
+        """
+        V = np.where(self.btu_vertical)[0]
+        pairs = []
+        for p, d, q in _V_LINKS:
+            n = self.btu_neighbors[V, d]
+            pairs.append(np.stack([4*V[n >= 0] + p, 4*n[n >= 0] + q], 1))
+        pairs = np.sort(np.concatenate(pairs), 1)
+        pairs = pairs[np.lexsort(pairs.T[::-1])]
+        edge_ports = 4*self.edge_btu_ports[:, 0] + self.edge_btu_ports[:, 1]
+        return pairs, edge_ports
+
+    def get_btu_params(self):
+        """ Stack the parameters of all BTUs in network (component) order
+
+        Returns:
+            dict of Tensor[#btus]: phiU, phiL, phi_offset (still attached to
+            the BTU parameters) and the float constants neff, ng, wl0, length
+            and loss (the applied_loss of the BTUs).
+        """
+        btus = list(self.components.values())
+        params = {}
+        for name in ['phiU', 'phiL', 'phi_offset']:
+            params[name] = torch.stack([getattr(btu, name) for btu in btus])
+        for name in ['neff', 'ng', 'wl0', 'length']:
+            params[name] = torch.tensor(
+                [getattr(btu, name) for btu in btus], dtype=torch.float64, device=self.device
+            )
+        params['loss'] = torch.tensor(
+            [btu.applied_loss for btu in btus], dtype=torch.float64, device=self.device
+        )
+        return params
+
+    def get_effective_phases(self, phiU, phiL):
+        """ arm phases seen by the light, including the thermal crosstalk
+
+        Args:
+            phiU, phiL (Tensor[..., #btus]): heater phases of the BTU arms
+
+        Returns:
+            phiU, phiL: unchanged without a thermal model, else the
+            effective phases of ThermalCrosstalk.apply
+        """
+        if self.thermal is None:
+            return phiU, phiL
+        return self.thermal.apply(phiU, phiL)
+
+    def set_S(self, S):
+        """ Fill the S-matrices of all BTUs in one vectorized pass
+
+        The S-matrices of all BTUs are computed together by sip.btu_S_batch
+        with shape (2, #btus, #wavelengths, 4, 4) and scattered onto the
+        block diagonal of the network S-matrix, instead of calling BTU.set_S
+        once for every BTU in the mesh.
+        """
+        btus = list(self.components.values())
+        if not all(isinstance(btu, sip.BTU) for btu in btus):
+            # general 4-port components from a custom btu_factory
+            return super(SqrMesh_NxM, self).set_S(S)
+
+        env = pt.current_environment()
+        params = self.get_btu_params()
+        phi0 = sip.get_phi0(params['neff'], params['ng'], params['wl0'], params['length'],
+                            env, self.device)
+        phiU, phiL = self.get_effective_phases(params['phiU'], params['phiL'])
+        Sb = sip.btu_S_batch(
+            phiU, phiL, params['phi_offset'], sip.get_wavelengths(env, self.device),
+            params['neff'], params['ng'], params['wl0'], params['length'], params['loss'],
+            phi0=phi0,
         )
-             
+
+        # Block diagonal indices of the BTU ports: (#btus, 4, 4)
+        idx = torch.arange(4*len(btus), device=S.device).view(-1, 4)
+        rows = idx[:, :, None].expand(-1, 4, 4)
+        cols = idx[:, None, :].expand(-1, 4, 4)
+        S[:, :, rows, cols] = Sb.permute(0, 2, 1, 3, 4)
+
     def set_state(self, btu_key, state):
         
-        if state[0] == 'bar':
-            phiU = state_dict['bar'][0]
-            phiL = state_dict['bar'][1]            
-        elif state[0] == 'cross':
-            phiU = state_dict['cross'][0]
-            phiL = state_dict['cross'][1]            
-        elif state[0] == 'coupler':
-            phiU = 2*np.arccos(state[1]) # param = kappa
-            phiL = 0            
-        elif state[0] == 'phase_shifter_bar':
-            phiU = state_dict['bar'][0] + state[1] # param = theta
-            phiL = state_dict['bar'][1] + state[1]            
-        elif state[0] == 'phase_shifter_cross':
-            phiU = state_dict['cross'][0] + state[1] # param = theta
-            phiL = state_dict['cross'][0] + state[1]            
-        else:
-            print("Bad arguments to function set_state")            
-        
+        phiU, phiL = get_state_phases(state)
         self.components[btu_key].phiU.data.fill_(phiU)
         self.components[btu_key].phiL.data.fill_(phiL)
         
+    def get_config_batch(self, mesh_dicts, phiU=None, phiL=None):
+        """ Phases of a batch of mesh configurations
+
+        Args:
+            mesh_dicts (list): one dict of {btu_key: state} per configuration,
+                BTUs that are not in the dict keep their current phases
+            phiU, phiL (optional, Tensor[#btus]): phases of the BTUs that
+                are not in a dict, instead of their current phases
+
+        Returns:
+            phiU, phiL (Tensor[#configs, #btus], float64): in network
+            (component) order, for SparseMeshSolver.solve_batch and forward_batch
+        """
+        params = self.get_btu_params()
+        phiU = params['phiU'] if phiU is None else torch.as_tensor(phiU)
+        phiL = params['phiL'] if phiL is None else torch.as_tensor(phiL)
+        phiU = phiU.detach().double().repeat(len(mesh_dicts), 1)
+        phiL = phiL.detach().double().repeat(len(mesh_dicts), 1)
+        # collect the states first, element-wise tensor writes are slow
+        rows, cols, values = [], [], []
+        for i, mesh_dict in enumerate(mesh_dicts):
+            for key, state in mesh_dict.items():
+                rows.append(i)
+                cols.append(self.btu_index[key])
+                values.append(get_state_phases(state))
+        if values:
+            values = torch.as_tensor(np.array(values, dtype=np.float64), device=phiU.device)
+            phiU[rows, cols], phiL[rows, cols] = values[:, 0], values[:, 1]
+        return phiU, phiL
+
+    def get_compensated_batch(self, mesh_dicts):
+        """ Heater phases that realize a batch of mesh configurations
+
+        The states of the mesh_dicts are the phases the light should see;
+        the thermal crosstalk model (self.thermal) is inverted for all
+        configurations at once with its cached factorization, see
+        siroap_thermal.ThermalCrosstalk.compensate. BTUs that are not in a
+        dict keep their current effective phases.
+
+        Args:
+            mesh_dicts (list): one dict of {btu_key: state} per configuration
+
+        Returns:
+            phiU, phiL (Tensor[#configs, #btus], float64): heater phases, the
+            same as get_config_batch without a thermal model
+        """
+        if self.thermal is None:
+            return self.get_config_batch(mesh_dicts)
+        params = self.get_btu_params()
+        with torch.no_grad():
+            phiU, phiL = self.get_effective_phases(params['phiU'].double(), params['phiL'].double())
+        phiU, phiL = self.get_config_batch(mesh_dicts, phiU, phiL)
+        return self.thermal.compensate(phiU, phiL)
+
+    def set_compensated_state(self, mesh_dict):
+        """ set the heater phases of all BTUs for the effective states of mesh_dict """
+        phiU, phiL = self.get_compensated_batch([mesh_dict])
+        for k, btu in enumerate(self.components.values()):
+            btu.phiU.data.fill_(float(phiU[0, k]))
+            btu.phiL.data.fill_(float(phiL[0, k]))
+
+    def forward_batch(self, phiU, phiL, src_list, det_list, source=1, phi_offset=None):
+        """ Detected power for a batch of mesh configurations
+
+        All configurations are solved together by one reduced and pruned
+        siroap_solvers.ReducedMeshSolver at the wavelengths of the current
+        environment, keeping every BTU that differs from its current state in
+        any configuration. The BTU parameters of the mesh are not changed.
+
+        Args:
+            phiU, phiL (Tensor[#configs, #btus]): BTU phases, see get_config_batch
+            src_list (list): edge port indices of the sources
+            det_list (list): edge port indices of the detectors
+            source (float|array): field amplitude of each source
+            phi_offset (optional, Tensor[#configs, #btus]): defaults to the
+                current phase offsets
+
+        Returns:
+            Tensor[#configs, 1, #wavelengths, #detectors, 1]: for every
+            configuration, the output of the terminated network
+        """
+        # BTUs that differ from their current state in any configuration
+        params = self.get_btu_params()
+        variable = np.zeros(len(self.components), dtype=bool)
+        for name, value in [('phiU', phiU), ('phiL', phiL), ('phi_offset', phi_offset)]:
+            if value is not None:
+                value = torch.as_tensor(value, dtype=torch.float64, device=self.device)
+                variable |= (value != params[name].detach().double()).any(0).cpu().numpy()
+
+        # the other BTUs are collapsed or pruned for the whole batch
+        solver = solvers.ReducedMeshSolver(
+            self, src_list, det_list, prune=True, variable=np.where(variable)[0]
+        )
+        H = solver.solve_batch(phiU, phiL, phi_offset)
+        source = np.broadcast_to(np.asarray(source, dtype=np.complex128), (H.shape[-1],))
+        det = np.abs(H @ source)**2
+        return torch.tensor(det, dtype=torch.get_default_dtype())[:, None, :, :, None]
+
+    def get_edge_S(self, wl=None):
+        """ Complete edge-port S-matrix of the mesh
+
+        All 4*(N+M) edge ports are driven at once: the sparse system of
+        siroap_solvers.SparseMeshSolver is factorized once per wavelength and
+        solved for every edge input as a separate right hand side. Any
+        src_list/det_list combination follows from the result, see
+        siroap_solvers.edge_S_forward.
+
+        Args:
+            wl (optional, np.ndarray): wavelengths, defaults to the current
+                photontorch environment
+
+        Returns:
+            np.ndarray[#wavelengths, 4*(N+M), 4*(N+M)] (complex128): the
+            transmission [wavelength, output edge port, input edge port]
+        """
+        ports = list(range(4*(self.N + self.M)))
+        return solvers.SparseMeshSolver(self, ports, ports).solve(wl)
+        
     def get_state(self, btu_key):
         mystate = {}
         mystate['phiU'] = self.components[btu_key].phiU.double()
@@ -169,90 +490,167 @@ class SqrMesh_NxM(pt.Network):
         mystate['phiC'] = (mystate['phiA'] + self.components[btu_key].phi00) % (2 * np.pi)
         return mystate
     
+    def get_jacobian(self, src_list, det_list, source=1, wl=None):
+        """ Derivatives of the detected power to the phases of all BTUs
+
+        Adjoint sensitivities from one forward and one adjoint sparse solve
+        per wavelength (siroap_solvers.SparseMeshSolver.get_jacobian), for
+        the mesh terminated with src_list and det_list.
+
+        Returns:
+            dict of np.ndarray: 'power' [#wavelengths, #detectors] and
+            'phiU', 'phiL', 'phi_offset' [#wavelengths, #detectors, #btus],
+            with the BTUs in network (component) order
+        """
+        solver = solvers.SparseMeshSolver(self, src_list, det_list)
+        return solver.get_jacobian(source, wl)
+        
     def get_next_btu(self, btu_key):
-        next_btu = {}
-        index_list = btu_key.split('_')    
-        i = int((index_list[0])[1:])
-        j = int(index_list[1])
-        if 'V' in btu_key:
-            next_btu["UL"] = "H%i_%i" % (i, j-1)
-            next_btu["UR"] = "H%i_%i" % (i, j)
-            next_btu["LL"] = "H%i_%i" % (i+1, j-1)
-            next_btu["LR"] = "H%i_%i" % (i+1, j)
-            if j==0:
-                next_btu["UL"] = 'None'
-                next_btu["LL"] = 'None'
-            elif j==self.M:   
-                next_btu["UR"] = 'None'
-                next_btu["LR"] = 'None'                
-                
-        if 'H' in btu_key:
-            next_btu["UL"] = "V%i_%i" % (i-1, j)
-            next_btu["UR"] = "V%i_%i" % (i-1, j+1)
-            next_btu["LL"] = "V%i_%i" % (i, j)
-            next_btu["LR"] = "V%i_%i" % (i, j+1)
-            if i==0:
-                next_btu["UL"] = 'None'
-                next_btu["UR"] = 'None'
-            elif i==self.N:   
-                next_btu["LL"] = 'None'
-                next_btu["LR"] = 'None'
-                
-        return next_btu 
+        """ keys of the neighbours in the UL, UR, LL, LR directions ('None' at the edges) """
+        neighbors = self.btu_neighbors[self.btu_index[btu_key]]
+        return {d: self.btu_keys[n] if n >= 0 else 'None' for d, n in zip(directions, neighbors)}
+
+    def get_common_phases(self):
+        """ common mode phase phiC of all BTUs, Tensor[#btus] (float64) """
+        params = self.get_btu_params()
+        phi00 = (2 * np.pi * params['neff'] * params['length'] / params['wl0']) % (2 * np.pi)
+        phiU, phiL = self.get_effective_phases(params['phiU'].double(), params['phiL'].double())
+        phiA = (phiU + phiL)/2
+        return (phiA + phi00) % (2 * np.pi)
+
+    def get_ring_phase_map(self):
+        """ round-trip phase of every cell (ring) of the mesh
+
+        Returns:
+            Tensor[N, M] (float64): sum of the common mode phases phiC of
+            the four BTUs around cell (i, j), modulo 2*pi
+        """
+        phiC = self.get_common_phases()
+        cells = torch.as_tensor(self.cell_btus, device=phiC.device)
+        return phiC[cells].sum(-1) % (2 * np.pi)
 
-    
     def get_ring_phase(self, btu_key):
+        k = self.btu_index[btu_key]
+        i, j = self.btu_grid[k]
+        if self.btu_vertical[k]:
+            cells = {"left_ring": (i, j-1), "right_ring": (i, j)}
+        else:
+            cells = {"upper_ring": (i-1, j), "lower_ring": (i, j)}
+        phase = self.get_ring_phase_map()
         ring_phase = {}
-        phase = 0
-        path_exists = True
-        
-        if 'V' in btu_key:
-            # Traverse left ring
-            traversal_list = ['UL', 'LL', 'LR']
-            phase, path_exists = self.get_path_phase(btu_key, traversal_list)            
-            if path_exists: 
-                ring_phase["left_ring"] = float(phase % (2 * np.pi))            
-            # Traverse right ring
-            
-            traversal_list = ['UR', 'LR', 'LL']
-            phase, path_exists = self.get_path_phase(btu_key, traversal_list)
-            if path_exists: 
-                ring_phase["right_ring"] = float(phase % (2 * np.pi))
-                    
-        if 'H' in btu_key:
-            # Traverse upper ring
-            traversal_list = ['UL', 'UR', 'LR']
-            phase, path_exists = self.get_path_phase(btu_key, traversal_list)
-            if path_exists:
-                ring_phase["upper_ring"] = float(phase % (2 * np.pi)) 
-        
-            # Traverse lower ring            
-            traversal_list = ['LR', 'LL', 'UL']
-            phase, path_exists = self.get_path_phase(btu_key, traversal_list)
-            if path_exists:
-                ring_phase["lower_ring"] = float(phase % (2 * np.pi)) 
-            
+        for name, (ci, cj) in cells.items():
+            if 0 <= ci < self.N and 0 <= cj < self.M:
+                ring_phase[name] = float(phase[ci, cj])
         return ring_phase
 
 
     def get_path_phase(self, btu_key, traversal_list):
-        key = btu_key                    
-        path_exists = True        
-        net_phase = self.get_state(key)['phiC']
-        print("Traversing path: %s" % (key))
-        for direction in  traversal_list:    
-            key = self.get_next_btu(key)[direction]
-            print("%s" % (key))            
-            if key == 'None':
-                path_exists = False
-            net_phase += self.get_state(key)['phiC']
-        return net_phase, path_exists
+        k = self.btu_index[btu_key]
+        phiC = self.get_common_phases()
+        net_phase = phiC[k]
+        logger.debug("Traversing path: %s" % (btu_key))
+        for direction in traversal_list:
+            k = self.btu_neighbors[k, directions.index(direction)]
+            if k < 0:
+                return net_phase, False
+            logger.debug("%s" % (self.btu_keys[k]))
+            net_phase = net_phase + phiC[k]
+        return net_phase, True
 
         
-    def terminate(self, src_list, det_list):
+    def get_coupling_mask(self, tol=1e-9, variable=None):
+        """ Port-to-port coupling pattern of all BTUs in their current state
+
+        Args:
+            tol (float): S-matrix elements below tol are considered zero
+            variable (optional, array): indices of BTUs whose state may
+                change, these are assumed to couple all ports
+
+        Returns:
+            np.ndarray[#btus, 4, 4] (bool): [k, out, in] is True when input
+            port 'in' of the k-th BTU couples to its output port 'out'.
+        """
+        btus = list(self.components.values())
+        if not all(isinstance(btu, sip.BTU) for btu in btus):
+            return np.ones((len(btus), 4, 4), dtype=bool)
+        params = self.get_btu_params()
+        with torch.no_grad():
+            phiU, phiL = self.get_effective_phases(params['phiU'], params['phiL'])
+            # the magnitudes of the BTU S-matrix do not depend on wavelength
+            S = sip.btu_S_batch(
+                phiU, phiL, params['phi_offset'], params['wl0'][:1],
+                params['neff'], params['ng'], params['wl0'], params['length'], params['loss'],
+                dtype=torch.float64,
+            )[:, :, 0]
+        mask = (S[0]**2 + S[1]**2).sqrt().cpu().numpy() > tol
+        if variable is not None:
+            mask[variable] = True
+        return mask
+
+    def get_active_btus(self, src_list, det_list, tol=1e-9, variable=None):
+        """ Reachability analysis of the BTUs between sources and detectors
+
+        Light is propagated through the connection graph of the mesh with
+        the coupling pattern of the current BTU states. A BTU is active when
+        at least one of its port-to-port paths is reachable from a source and
+        can still reach a detector. All other BTUs do not affect the detected
+        signals and can be pruned.
+
+        Args:
+            src_list (list): edge port indices of the sources
+            det_list (list): edge port indices of the detectors
+            tol (float): S-matrix elements below tol are considered zero
+            variable (optional, array): indices of BTUs whose state may
+                change, these are kept whenever they can be reached
+
+        Returns:
+            np.ndarray[#btus] (bool), in network (component) order
+        """
+        mask = self.get_coupling_mask(tol, variable)  # (#btus, out, in)
+        num_btus = mask.shape[0]
+        pairs, edge_ports = self.get_port_map()
+        partner = -np.ones(4*num_btus, dtype=np.int64)
+        partner[pairs[:, 0]] = pairs[:, 1]
+        partner[pairs[:, 1]] = pairs[:, 0]
+        connected = partner >= 0
+
+        # forward: ports at which light from the sources arrives
+        reach_in = np.zeros(4*num_btus, dtype=bool)
+        reach_in[edge_ports[list(src_list)]] = True
+        while True:
+            reach_out = (mask & reach_in.reshape(-1, 1, 4)).any(2).ravel()
+            new = reach_in.copy()
+            new[connected] |= reach_out[partner[connected]]
+            if (new == reach_in).all():
+                break
+            reach_in = new
+
+        # backward: ports from which outgoing light can reach a detector
+        need_out = np.zeros(4*num_btus, dtype=bool)
+        need_out[edge_ports[list(det_list)]] = True
+        while True:
+            need_in = (mask & need_out.reshape(-1, 4, 1)).any(1).ravel()
+            new = need_out.copy()
+            new[connected] |= need_in[partner[connected]]
+            if (new == need_out).all():
+                break
+            need_out = new
+
+        active = mask & need_out.reshape(-1, 4, 1) & reach_in.reshape(-1, 1, 4)
+        return active.any((1, 2))
+
+    def terminate(self, src_list, det_list, prune=False):
         """ Connect source and detector the the src_list and det_list resp.
             Rest are all terminated.
+
+            With prune=True, only the BTUs found by get_active_btus for the
+            current BTU states (and the BTUs of the sources and detectors)
+            are kept in the terminated network. Set the mesh state before
+            terminating, the pruned BTUs are listed in the .pruned attribute
+            of the returned network.
         """ 
+        if prune:
+            return self._terminate_pruned(src_list, det_list)
         # src_idx = 0
         #det_idx = 0
         # term_idx = 0
@@ -269,8 +667,101 @@ class SqrMesh_NxM(pt.Network):
                 term += [Term(name="t%i" % i)]
                 # term_idx += 1
 
-        if (_DEBUG): print(term)                
+        logger.debug(term)
         ret = super(SqrMesh_NxM, self).terminate(term)
         ret.to(self.device)
         return ret      
-###############################################################################        
\ No newline at end of file
+
+    def _terminate_pruned(self, src_list, det_list):
+        keys = list(self.components.keys())
+        pairs, edge_ports = self.get_port_map()
+        active = self.get_active_btus(src_list, det_list)
+        # keep the BTUs of the sources and detectors for the output layout
+        active[edge_ports[list(src_list) + list(det_list)] // 4] = True
+
+        components = {}
+        connections = []
+        # edge terminations first: the detectors keep the order of terminate()
+        for i in range(0, 4*(self.N+self.M)):
+            k, p = divmod(int(edge_ports[i]), 4)
+            if not active[k]:
+                continue
+            if (i in src_list):
+                name = "s%i" % i
+                components[name] = Source(name=name)
+            elif (i in det_list):
+                name = "p%i" % i
+                components[name] = Detector(name=name)
+            else:
+                name = "t%i" % i
+                components[name] = Term(name=name)
+            connections += ["%s:0:%s:%i" % (name, keys[k], p)]
+
+        for j1, j2 in pairs:
+            (k1, p1), (k2, p2) = divmod(int(j1), 4), divmod(int(j2), 4)
+            if active[k1] and active[k2]:
+                connections += ["%s:%i:%s:%i" % (keys[k1], p1, keys[k2], p2)]
+            elif active[k1] or active[k2]:
+                # ports facing a pruned BTU are terminated
+                k, p = (k1, p1) if active[k1] else (k2, p2)
+                name = "t_%s_%i" % (keys[k], p)
+                components[name] = Term(name=name)
+                connections += ["%s:0:%s:%i" % (name, keys[k], p)]
+
+        for k in np.where(active)[0]:
+            components[keys[k]] = self.components[keys[k]]
+
+        ret = _PrunedMesh(self, components, connections, name=(self.name or "sqrmesh_nxm") + "_pruned")
+        ret.pruned = [key for key, a in zip(keys, active) if not a]
+        logger.debug("Pruned %i of %i BTUs: %s" % (len(ret.pruned), len(keys), ret.pruned))
+        ret.to(self.device)
+        return ret
+
+
+class _PrunedMesh(pt.Network):
+    """ terminated network of the active BTUs of a mesh (SqrMesh_NxM.terminate)
+
+    The BTUs are those of the mesh (base), with a thermal model of the mesh
+    their S-matrices are filled from the effective phases of all its
+    heaters, the pruned BTUs included.
+    """
+
+    def __init__(self, base, components, connections, name=None):
+        super(_PrunedMesh, self).__init__(components, connections, name=name)
+        # a plain reference: assigned as attribute, the mesh would become a
+        # component of the network
+        object.__setattr__(self, 'base', base)
+
+    def set_S(self, S):
+        super(_PrunedMesh, self).set_S(S)
+        if self.base.thermal is None:
+            return
+
+        # network port offset and mesh index of every BTU
+        offsets, btus = [], []
+        idx = 0
+        for name, comp in self.components.items():
+            if name in self.base.btu_index:
+                offsets.append(idx)
+                btus.append(self.base.btu_index[name])
+            idx += comp.num_ports
+
+        env = pt.current_environment()
+        params = self.base.get_btu_params()
+        phiU, phiL = self.base.get_effective_phases(params['phiU'], params['phiL'])
+        params['phiU'], params['phiL'] = phiU, phiL
+        params = {name: value[btus] for name, value in params.items()}
+        phi0 = sip.get_phi0(params['neff'], params['ng'], params['wl0'], params['length'],
+                            env, self.device)
+        Sb = sip.btu_S_batch(
+            params['phiU'], params['phiL'], params['phi_offset'], sip.get_wavelengths(env, self.device),
+            params['neff'], params['ng'], params['wl0'], params['length'], params['loss'],
+            phi0=phi0,
+        )
+
+        # Block diagonal indices of the BTU ports: (#btus, 4, 4)
+        idx = torch.as_tensor(offsets, device=S.device)[:, None] + torch.arange(4, device=S.device)
+        rows = idx[:, :, None].expand(-1, 4, 4)
+        cols = idx[:, None, :].expand(-1, 4, 4)
+        S[:, :, rows, cols] = Sb.permute(0, 2, 1, 3, 4)
+###############################################################################
\ No newline at end of file
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Monte Carlo analysis of fabrication variations of a SiROAP mesh.
+
+Every sample of the chip draws, per BTU, a phase offset (phi_offset), an
+excess loss and the power coupling of its two directional couplers (the
+coupler imbalance, sip.btu_S_imbalanced), around the nominal parameters
+of the mesh. The samples are solved together: the BTU S-matrices of a
+chunk of samples are stacked along the wavelength axis and solved as one
+batch, as in solve_batch of the solvers. The chunks bound the memory of
+the stacked S-matrices.
+
+By default the batch is solved by the dense siroap_solvers.ComplexMeshSolver
+on the system of the configuration, pruned and reduced to its coupling
+BTUs. The chain weights of the collapsed BTUs are taken from the S-matrices
+of every sample, so their variations are kept, only the light that they
+leak out of their passthrough path is lost (as in the inactive BTUs).
+With reduce=False the full system is solved by SparseMeshSolver.
+
+The detected spectra of all samples are reduced to filter figures, the
+passband ripple, the insertion loss and the stopband rejection, whose
+distributions give the yield of a mesh configuration.
+
+The code is copyright of Vishal Saxena, 2022 and permission and license is
+required to reuse this code.
+
+@author: vsaxena
+"""
+import logging
+import numpy as np
+import torch
+
+from scipy.constants import c
+
+# Import local library
+import sip_library as sip
+import siroap_solvers as solvers
+
+
+# diagnostics are logged at DEBUG level, e.g. logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+def get_band(f, band):
+    """ mask of the frequencies in a band
+
+    Args:
+        f (np.ndarray[#wavelengths]): frequencies [Hz]
+        band: (f_min, f_max) [Hz] or a list of such ranges
+
+    Returns:
+        np.ndarray[#wavelengths] (bool)
+    """
+    band = np.atleast_2d(np.asarray(band, dtype=np.float64))
+    return ((f[:, None] >= band[:, 0]) & (f[:, None] <= band[:, 1])).any(1)
+
+##############################################################################
+## Monte Carlo Analysis
+##############################################################################
+class MonteCarloAnalysis(object):
+    r""" Batched Monte Carlo of the BTU variations of a SqrMesh_NxM
+
+    The mesh itself is not changed, its BTU parameters are the nominal
+    values of the samples.
+    """
+
+    def __init__(self, mesh, src_list, det_list, sigma_phi=0.1, sigma_loss=0.05,
+                 sigma_split=0.02, max_points=2**14, seed=None, reduce=True):
+        """
+        Args:
+            mesh (SqrMesh_NxM): the (unterminated) mesh
+            src_list (list): edge port indices of the sources
+            det_list (list): edge port indices of the detectors
+            sigma_phi (float): rms phase offset [rad]
+            sigma_loss (float): rms excess loss of a BTU [dB], the loss
+                does not go below 0 dB
+            sigma_split (float): rms deviation of the power coupling of
+                each directional coupler from 0.5
+            max_points (int): samples times wavelengths solved together,
+                bounds the memory of the stacked S-matrices
+            seed (optional, int): seed of the samples
+            reduce (bool): solve the pruned and reduced system of the
+                configuration densely, else the full sparse system
+        """
+        self.mesh = mesh
+        self.reduce = reduce
+        self.solver = self.get_solver(src_list, det_list)
+        self.sigma_phi = float(sigma_phi)
+        self.sigma_loss = float(sigma_loss)
+        self.sigma_split = float(sigma_split)
+        self.max_points = int(max_points)
+        self.rng = np.random.default_rng(seed)
+
+    @property
+    def detector_names(self):
+        """ names of the detectors, as in the terminated network """
+        return self.solver.detector_names
+
+    def get_solver(self, src_list, det_list, mesh_dict=None):
+        """ solver of a configuration, on top of the current states of the
+        mesh, which are restored afterwards """
+        if not self.reduce:
+            return solvers.SparseMeshSolver(self.mesh, src_list, det_list)
+        btus = list(self.mesh.components.values())
+        phases = [(btu.phiU.detach().clone(), btu.phiL.detach().clone()) for btu in btus]
+        try:
+            for key, state in (mesh_dict or {}).items():
+                self.mesh.set_state(key, state)
+            return solvers.ComplexMeshSolver(self.mesh, src_list, det_list, prune=True, reduce=True)
+        finally:
+            with torch.no_grad():
+                for btu, (phiU, phiL) in zip(btus, phases):
+                    btu.phiU.copy_(phiU)
+                    btu.phiL.copy_(phiL)
+
+    def draw(self, num_samples):
+        """ random BTU parameters of num_samples chips
+
+        Returns:
+            dict of np.ndarray[#samples, #btus]: 'phi_offset', 'loss' [dB],
+            'split1' and 'split2'
+        """
+        params = self.mesh.get_btu_params()
+        shape = (num_samples, len(self.mesh.components))
+        phi_offset = params['phi_offset'].detach().cpu().numpy()
+        loss = params['loss'].cpu().numpy()
+        return {
+            'phi_offset': phi_offset + self.sigma_phi*self.rng.standard_normal(shape),
+            'loss': np.maximum(loss + self.sigma_loss*self.rng.standard_normal(shape), 0),
+            'split1': np.clip(0.5 + self.sigma_split*self.rng.standard_normal(shape), 0, 1),
+            'split2': np.clip(0.5 + self.sigma_split*self.rng.standard_normal(shape), 0, 1),
+        }
+
+    def get_S(self, phiU, phiL, samples, wl, btus=None):
+        """ BTU S-matrices of a chunk of samples
+
+        Args:
+            phiU, phiL (Tensor[#btus]): heater phases of the configuration
+            samples (dict of np.ndarray[#samples, #btus]): see draw
+            wl (np.ndarray[#wavelengths]): wavelengths [m]
+            btus (optional, np.ndarray): mesh indices of the BTUs to compute,
+                defaults to all of them
+
+        Returns:
+            np.ndarray[#samples, #btus, #wavelengths, 4, 4] (complex128), in
+            the order of btus
+        """
+        params = self.mesh.get_btu_params()
+        wls = torch.tensor(wl, dtype=torch.float64)
+        phiU, phiL = self.mesh.get_effective_phases(phiU, phiL)
+        k = slice(None) if btus is None else torch.as_tensor(btus, dtype=torch.int64)
+        with torch.no_grad():
+            S = sip.btu_S_imbalanced(
+                phiU[k], phiL[k], torch.as_tensor(samples['phi_offset'])[:, k], wls,
+                params['neff'][k], params['ng'][k], params['wl0'][k], params['length'][k],
+                torch.as_tensor(samples['loss'])[:, k],
+                torch.as_tensor(samples['split1'])[:, k], torch.as_tensor(samples['split2'])[:, k],
+            )
+        return S.numpy()
+
+    def solve(self, samples, mesh_dict=None, wl=None):
+        """ complex transmission of every sample
+
+        Args:
+            samples (dict of np.ndarray[#samples, #btus]): see draw
+            mesh_dict (optional, dict): configuration, on top of the current
+                states of the mesh
+            wl (optional, np.ndarray): wavelengths, defaults to the current
+                photontorch environment
+
+        Returns:
+            np.ndarray[#samples, #wavelengths, #detectors, #sources] (complex128)
+        """
+        wl = solvers.get_wavelengths(wl)
+        phiU, phiL = self.mesh.get_config_batch([mesh_dict or {}])
+        num_samples, num_btus = samples['phi_offset'].shape
+        solver = self.solver
+        if mesh_dict and self.reduce:
+            solver = self.get_solver(self.solver.src_list, self.solver.det_list, mesh_dict)
+        out = np.zeros((num_samples, len(wl), len(self.solver.det_list), len(self.solver.src_list)),
+                       dtype=np.complex128)
+        # only the BTUs that enter the solve, the others stay zero
+        btus = solver.used_btus if self.reduce else np.arange(num_btus)
+        step = max(1, self.max_points // len(wl))
+        for i in range(0, num_samples, step):
+            chunk = {name: x[i:i+step] for name, x in samples.items()}
+            Su = self.get_S(phiU[0], phiL[0], chunk, wl, btus)
+            n = Su.shape[0]
+            S = np.zeros((num_btus, n*len(wl), 4, 4), dtype=np.complex128)
+            S[btus] = np.moveaxis(Su, 0, 1).reshape(len(btus), n*len(wl), 4, 4)
+            out[i:i+n] = solver.solve_S(S).reshape(n, len(wl), *out.shape[2:])
+        logger.debug("Monte Carlo: %i samples, %i wavelengths" % (num_samples, len(wl)))
+        return out
+
+    def get_figures(self, power, f, passband, stopband=None):
+        """ filter figures of detected spectra
+
+        Args:
+            power (np.ndarray[..., #wavelengths, #detectors]): detected power
+            f (np.ndarray[#wavelengths]): frequencies [Hz]
+            passband, stopband: (f_min, f_max) [Hz] or a list of such ranges
+
+        Returns:
+            dict of np.ndarray[..., #detectors] [dB]: passband 'ripple',
+            'insertion_loss' and the 'rejection' of the stopband (the
+            lowest passband power over the highest stopband power)
+        """
+        power = 10*np.log10(np.maximum(power, 1e-30))
+        passband = power[..., get_band(f, passband), :]
+        figures = {
+            'ripple': passband.max(-2) - passband.min(-2),
+            'insertion_loss': -passband.max(-2),
+        }
+        if stopband is not None:
+            figures['rejection'] = passband.min(-2) - power[..., get_band(f, stopband), :].max(-2)
+        return figures
+
+    def run(self, num_samples=1000, mesh_dict=None, passband=None, stopband=None, source=1, wl=None):
+        """ Monte Carlo of a mesh configuration
+
+        Args:
+            num_samples (int): number of chips
+            mesh_dict (optional, dict): configuration, on top of the current
+                states of the mesh
+            passband, stopband (optional): (f_min, f_max) [Hz] or a list of
+                such ranges, for the filter figures
+            source (float|array): field amplitude of each source
+            wl (optional, np.ndarray): wavelengths, defaults to the current
+                photontorch environment
+
+        Returns:
+            dict: the 'samples' (see draw), the detected 'power'
+            [#samples, #wavelengths, #detectors], the frequencies 'f' and,
+            with a passband, the filter figures of every sample (see
+            get_figures) and of the 'nominal' mesh
+        """
+        wl = solvers.get_wavelengths(wl)
+        f = c/wl
+        samples = self.draw(num_samples)
+        source = np.broadcast_to(np.asarray(source, dtype=np.complex128), (len(self.solver.src_list),))
+        power = np.abs(self.solve(samples, mesh_dict, wl) @ source)**2
+        result = {'samples': samples, 'power': power, 'f': f}
+        if passband is not None:
+            params = self.mesh.get_btu_params()
+            nominal = {'phi_offset': params['phi_offset'].detach().cpu().numpy()[None],
+                       'loss': params['loss'].cpu().numpy()[None],
+                       'split1': np.full((1, len(self.mesh.components)), 0.5),
+                       'split2': np.full((1, len(self.mesh.components)), 0.5)}
+            nominal = np.abs(self.solve(nominal, mesh_dict, wl) @ source)**2
+            result.update(self.get_figures(power, f, passband, stopband))
+            result['nominal'] = {name: x[0] for name, x in self.get_figures(nominal, f, passband, stopband).items()}
+        return result
+
+    @staticmethod
+    def get_statistics(values, percentiles=(5, 50, 95)):
+        """ distribution of a filter figure over the samples
+
+        Args:
+            values (np.ndarray[#samples, ...]): e.g. result['ripple']
+            percentiles (tuple): percentiles to report
+
+        Returns:
+            dict: 'mean', 'std' and 'p5', 'p50', ... over the samples
+        """
+        stats = {'mean': values.mean(0), 'std': values.std(0)}
+        for p in percentiles:
+            stats['p%g' % p] = np.percentile(values, p, axis=0)
+        return stats
+###############################################################################
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Closed-form ring filter analysis of SiROAP mesh configurations.
+
+A cell of the square mesh is bounded by four BTUs (Hi_j on top, Hi+1_j at
+the bottom, Vi_j and Vi_j+1 on the sides). The bar route of every BTU keeps
+light inside the cell, so a cell whose four BTUs all pass light in the bar
+route is a ring, and its BTUs with a nonzero cross route are the couplers
+of that ring, to a bus or to a neighbouring ring (CROW). This is the loop
+that SqrMesh_NxM.get_ring_phase walks.
+
+RingAnalyzer finds these rings in the current BTU states and evaluates
+the ring filters analytically. For light entering a ring through coupler
+u (bus input i, ring ports r, bus output o), with R the product of the
+responses of the other BTUs along the ring,
+
+    through = S_u[o, i] + S_u[o, r] R S_u[r, i] / (1 - S_u[r, r] R)
+
+which is the all-pass ring filter. A BTU that couples the ring to a
+further ring enters R with the through response of that ring, so a CROW
+is a continued fraction of all-pass responses, and the light leaving a
+ring through its other couplers gives the drop responses. The buses
+between the ring filters are followed along their routes from the sources
+to the detectors. Loops that are not single-cell rings (e.g. a ring
+through several cells) are not supported, use the mesh solvers for those.
+
+The code is copyright of Vishal Saxena, 2022 and permission and license is
+required to reuse this code.
+
+@author: vsaxena
+"""
+import logging
+import numpy as np
+import torch
+
+from scipy.constants import c
+
+# Import local library
+import sip_library as sip
+import siroap_solvers as solvers
+
+
+# diagnostics are logged at DEBUG level, e.g. logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# output port of the bar and cross route of every BTU input port
+_BAR = sip._BTU_SIN.abs().argmax(0).numpy()
+_CROSS = sip._BTU_COS.abs().argmax(0).numpy()
+
+##############################################################################
+## Ring Analyzer
+##############################################################################
+class RingAnalyzer(object):
+    r""" Analytical ring/CROW/APF response of a configured SqrMesh_NxM
+
+    The rings are found by initialize() from the current BTU states, call it
+    again after changing the state of the mesh. solve() and forward() have
+    the interface of the solvers in siroap_solvers.
+    """
+
+    def __init__(self, mesh, src_list, det_list, tol=1e-9, tap=0.1):
+        """
+        Args:
+            mesh (SqrMesh_NxM): the (unterminated) mesh to analyze
+            src_list (list): edge port indices of the sources
+            det_list (list): edge port indices of the detectors
+            tol (float): S-matrix elements below tol are considered zero
+            tap (float): bus couplers with a smaller kappa are counted as
+                monitor taps when classifying the structures
+        """
+        self.mesh = mesh
+        self.tol = float(tol)
+        self.tap = float(tap)
+        # same ordering as the terminated photontorch network
+        self.src_list = sorted(src_list)
+        self.det_list = sorted(det_list)
+        self.initialize()
+
+    @property
+    def detector_names(self):
+        """ names of the detectors, as in the terminated network """
+        return ["p%i" % i for i in self.det_list]
+
+    def initialize(self):
+        """ find the rings and their couplers in the current BTU states """
+        pairs, edge_ports = self.mesh.get_port_map()
+        P = 4*len(self.mesh.components)
+        self.partner = -np.ones(P, dtype=np.int64)
+        self.partner[pairs[:, 0]] = pairs[:, 1]
+        self.partner[pairs[:, 1]] = pairs[:, 0]
+        self.edge_ports = edge_ports
+        self.edge_index = -np.ones(P, dtype=np.int64)
+        self.edge_index[edge_ports] = np.arange(len(edge_ports))
+        self.mask = self.mesh.get_coupling_mask(self.tol)  # (#btus, out, in)
+
+        # bar cycles of the cells whose four BTUs all pass the bar route;
+        # ring_of maps the BTU output into the ring to (ring, hops of the
+        # direction that starts at that output)
+        self.rings = []
+        self.ring_of = {}
+        visited = np.zeros(P, dtype=bool)
+        for start in range(P):
+            if visited[start]:
+                continue
+            hops, port = [], start
+            while not visited[port]:
+                visited[port] = True
+                k, i = divmod(port, 4)
+                hops.append((k, i, _BAR[i]))
+                port = self.partner[4*k + _BAR[i]]
+                if port < 0:
+                    break
+            if port != start or not all(self.mask[k, o, i] for k, i, o in hops):
+                continue
+            btus = frozenset(k for k, _, _ in hops)
+            ring = next((r for r, b in enumerate(self.rings) if b == btus), len(self.rings))
+            if ring == len(self.rings):
+                self.rings.append(btus)
+            for n, (k, i, o) in enumerate(hops):
+                self.ring_of[(k, o)] = (ring, hops[n+1:] + hops[:n+1])
+        logger.debug("Found %i rings" % len(self.rings))
+        return self
+
+    def _is_coupler(self, k, i):
+        """ True if the input port i of BTU k couples into a ring """
+        return (k, _CROSS[i]) in self.ring_of and self.mask[k, _CROSS[i], i]
+
+    def _ring_response(self, S, u, i, visited):
+        """ response of the ring(s) behind coupler u for light at its input i
+
+        Args:
+            S (np.ndarray[#btus, #wavelengths, 4, 4]): BTU S-matrices
+            u, i (int): BTU and local input port on the bus side
+            visited (tuple): rings on the way to this coupler
+
+        Returns:
+            through (np.ndarray[#wavelengths]): to the bus output of u
+            exits (list): (global output port, transmission) of the light
+                leaving the rings through their other couplers
+        """
+        o_bus, o_ring = _BAR[i], _CROSS[i]
+        ring, hops = self.ring_of[(u, o_ring)]
+        if ring in visited:
+            raise ValueError("the rings form a loop, use the mesh solvers")
+        visited = visited + (ring,)
+        i_ring = hops[-1][1]
+
+        # response of every BTU along the ring, further rings as all-pass
+        responses = []
+        for k, h_in, h_out in hops[:-1]:
+            if self._is_coupler(k, h_in):
+                responses.append(('ring',) + self._ring_response(S, k, h_in, visited))
+            else:
+                responses.append(('btu', S[k, :, h_out, h_in], None))
+        R = np.prod([r[1] for r in responses], axis=0) if responses else 1
+        den = 1 - S[u, :, o_ring, i_ring]*R
+        through = S[u, :, o_bus, i] + S[u, :, o_bus, i_ring]*R*S[u, :, o_ring, i]/den
+
+        # light circulating in the ring, leaving at the other couplers
+        field = S[u, :, o_ring, i]/den
+        exits = []
+        for (k, h_in, h_out), (kind, response, ring_exits) in zip(hops[:-1], responses):
+            if kind == 'ring':
+                exits += [(port, field*t) for port, t in ring_exits]
+            elif self.mask[k, _CROSS[h_in], h_in]:
+                exits.append((4*k + _CROSS[h_in], field*S[k, :, _CROSS[h_in], h_in]))
+            field = field*response
+        return through, exits
+
+    def _propagate(self, S, port, field, out, path):
+        """ follow the light leaving the global output port to the edge ports """
+        if self.partner[port] < 0:
+            out[self.edge_index[port]] += field
+        else:
+            self._enter(S, self.partner[port], field, out, path)
+
+    def _enter(self, S, port, field, out, path):
+        """ route the light arriving at the global input port """
+        if port in path:
+            raise ValueError("the buses form a loop, use the mesh solvers")
+        path = path | {port}
+        k, i = divmod(port, 4)
+        if self._is_coupler(k, i):
+            through, exits = self._ring_response(S, k, i, ())
+            self._propagate(S, 4*k + _BAR[i], field*through, out, path)
+            for p, t in exits:
+                self._propagate(S, p, field*t, out, path)
+        else:
+            for o in np.where(self.mask[k, :, i])[0]:
+                self._propagate(S, 4*k + o, field*S[k, :, o, i], out, path)
+
+    def get_rings(self, wl=None):
+        """ equivalent parameters of every ring
+
+        Args:
+            wl (optional, float): wavelength of the round-trip phase,
+                defaults to the wl0 of the BTUs
+
+        Returns:
+            list of dict: per ring the 'cell' (i, j), its 'btus' in the
+            order of circulation, the field coupling 'kappa' of every
+            coupler, the round-trip 'loss' [dB] and 'phase' [rad], the
+            group 'delay' [s] and the 'fsr' [Hz]
+        """
+        keys = list(self.mesh.components.keys())
+        params = {k: v.detach().cpu().numpy() for k, v in self.mesh.get_btu_params().items()}
+        wl = params['wl0'][0] if wl is None else wl
+        S = solvers.get_btu_S(self.mesh, [wl])[:, 0]
+        amp = 10**(-params['loss']/20)
+        hops_of = {ring: hops for ring, hops in self.ring_of.values()}
+
+        rings = []
+        for ring, btus in enumerate(self.rings):
+            hops = hops_of[ring]
+            # the top H BTU is at the grid position of the cell
+            i, j = min(tuple(int(x) for x in self.mesh.btu_grid[k])
+                       for k in btus if not self.mesh.btu_vertical[k])
+            round_trip = np.prod([S[k, o, h] for k, h, o in hops])
+            delay = float(sum(params['ng'][k]*params['length'][k] for k in btus)/c)
+            rings.append({
+                'cell': (i, j),
+                'btus': [keys[k] for k, _, _ in hops],
+                'kappa': {keys[k]: float(np.abs(S[k, _CROSS[h], h])/amp[k])
+                          for k, h, _ in hops if self.mask[k, _CROSS[h], h]},
+                'loss': float(sum(params['loss'][k] for k in btus)),
+                'phase': float(np.angle(round_trip) % (2*np.pi)),
+                'delay': delay,
+                'fsr': 1/delay,
+            })
+        return rings
+
+    def get_structures(self):
+        """ ring filters formed by the coupled rings
+
+        Returns:
+            list of dict: the 'kind' ('APF', 'add-drop' or 'CROW'), the
+            'rings' (cells) and the 'bus' couplers of every group of coupled
+            rings, monitor taps (kappa < tap) are listed as 'taps'
+        """
+        rings = self.get_rings()
+        keys = list(self.mesh.components.keys())
+        index = {key: r for r, ring in enumerate(rings) for key in ring['btus']}
+        # rings sharing a coupler belong to the same filter
+        group = list(range(len(rings)))
+        def find(r):
+            while group[r] != r:
+                r = group[r]
+            return r
+        for key, r in index.items():
+            for s, ring in enumerate(rings):
+                if s != r and key in ring['kappa'] and key in rings[r]['kappa']:
+                    group[find(s)] = find(r)
+
+        structures = []
+        for root in sorted(set(find(r) for r in range(len(rings)))):
+            members = [r for r in range(len(rings)) if find(r) == root]
+            bus, taps = [], []
+            for r in members:
+                for key, kappa in rings[r]['kappa'].items():
+                    if all(key not in rings[s]['btus'] for s in members if s != r):
+                        (bus if kappa >= self.tap else taps).append(key)
+            kind = 'CROW' if len(members) > 1 else ('APF' if len(bus) < 2 else 'add-drop')
+            structures.append({'kind': kind, 'rings': [rings[r]['cell'] for r in members],
+                               'bus': bus, 'taps': taps})
+        logger.debug("Ring filters: %s" % ', '.join(s['kind'] for s in structures))
+        return structures
+
+    def solve(self, wl=None):
+        """ complex transmission from every source to every detector
+
+        Args:
+            wl (optional, np.ndarray): wavelengths, defaults to the current
+                photontorch environment
+
+        Returns:
+            np.ndarray[#wavelengths, #detectors, #sources] (complex128)
+        """
+        wl = solvers.get_wavelengths(wl)
+        S = solvers.get_btu_S(self.mesh, wl)
+        out = np.zeros((len(wl), len(self.det_list), len(self.src_list)), dtype=np.complex128)
+        for n, e in enumerate(self.src_list):
+            edge = np.zeros((len(self.edge_ports), len(wl)), dtype=np.complex128)
+            self._enter(S, self.edge_ports[e], np.ones(len(wl)), edge, set())
+            out[:, :, n] = edge[self.det_list].T
+        return out
+
+    def forward(self, source=1, wl=None):
+        """ detected power, in the layout of the terminated photontorch network
+
+        Args:
+            source (float|array): field amplitude of each source
+            wl (optional, np.ndarray): wavelengths, defaults to the current
+                photontorch environment
+
+        Returns:
+            Tensor[1, #wavelengths, #detectors, 1]
+        """
+        H = self.solve(wl)
+        source = np.broadcast_to(np.asarray(source, dtype=np.complex128), (H.shape[2],))
+        det = np.abs(H @ source)**2
+        return torch.tensor(det, dtype=torch.get_default_dtype())[None, :, :, None]
+###############################################################################
@@ -0,0 +1,1051 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Alternative frequency-domain solver backends for the SiROAP square mesh.
+
+The photontorch network solve works with dense (#ports x #ports) matrices
+for every wavelength, which does not scale to large meshes. The solvers in
+this module work directly on the BTU S-matrices and the port connectivity
+of a SqrMesh_NxM instead.
+
+The code is copyright of Vishal Saxena, 2022 and permission and license is
+required to reuse this code.
+
+@author: vsaxena
+"""
+import logging
+import numpy as np
+import torch
+import photontorch as pt
+
+import scipy.sparse as sparse
+import scipy.sparse.linalg as splinalg
+
+# Import local library
+import sip_library as sip
+
+
+# diagnostics are logged at DEBUG level, e.g. logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+##############################################################################
+## Helper functions
+##############################################################################
+def get_wavelengths(wl=None):
+    """ wavelengths to solve for, defaults to the current environment """
+    if wl is None:
+        wl = pt.current_environment().wl
+    return np.atleast_1d(np.asarray(wl, dtype=np.float64))
+
+
+def get_btu_S(mesh, wl, phiU=None, phiL=None, phi_offset=None):
+    """ complex S-matrices of all BTUs in the mesh
+
+    Args:
+        mesh (SqrMesh_NxM): the (unterminated) mesh
+        wl (np.ndarray[#wavelengths]): wavelengths [m]
+        phiU, phiL, phi_offset (optional, array[..., #btus]): phases to use
+            instead of the BTU parameters, e.g. for a batch of configurations
+
+    Returns:
+        np.ndarray[..., #btus, #wavelengths, 4, 4] (complex128)
+    """
+    params = mesh.get_btu_params()
+    device = params['neff'].device
+    wls = torch.tensor(wl, dtype=torch.float64, device=device)
+    phases = {}
+    for name, value in [('phiU', phiU), ('phiL', phiL), ('phi_offset', phi_offset)]:
+        value = params[name] if value is None else value
+        phases[name] = torch.as_tensor(value, dtype=torch.float64, device=device)
+    with torch.no_grad():
+        phases['phiU'], phases['phiL'] = mesh.get_effective_phases(phases['phiU'], phases['phiL'])
+        S = sip.btu_S_batch(
+            phases['phiU'], phases['phiL'], phases['phi_offset'], wls,
+            params['neff'], params['ng'], params['wl0'], params['length'], params['loss'],
+            dtype=torch.float64,
+        ).cpu().numpy()
+    return S[0] + 1j*S[1]
+
+
+def edge_S_forward(S, src_list, det_list, source=1):
+    """ detected power of a src_list/det_list combination from an edge S-matrix
+
+    Args:
+        S (np.ndarray[#wavelengths, #edge ports, #edge ports]): edge-port
+            S-matrix, see SqrMesh_NxM.get_edge_S
+        src_list (list): edge port indices of the sources
+        det_list (list): edge port indices of the detectors
+        source (float|array): field amplitude of each source
+
+    Returns:
+        Tensor[1, #wavelengths, #detectors, 1], in the layout of the
+        terminated photontorch network
+    """
+    # same ordering as the terminated photontorch network
+    H = S[:, sorted(det_list)][:, :, sorted(src_list)]
+    source = np.broadcast_to(np.asarray(source, dtype=np.complex128), (H.shape[2],))
+    det = np.abs(H @ source)**2
+    return torch.tensor(det, dtype=torch.get_default_dtype())[None, :, :, None]
+
+
+##############################################################################
+## Sparse Direct Solver
+##############################################################################
+class SparseMeshSolver(object):
+    r""" Sparse direct frequency-domain solver for a SqrMesh_NxM
+
+    With b the waves leaving the BTU ports, S the block diagonal BTU
+    S-matrix, G the internal connection matrix and x the waves injected at
+    the edge ports, the mesh obeys
+
+        b = S (G b + x)   =>   (I - S G) b = S x
+
+    Every BTU couples only 4 ports, so (I - S G) has at most 5 nonzeros per
+    column. It is assembled as a scipy.sparse matrix and LU factorized for
+    every wavelength (in chunks of wavelengths). Edge ports that are neither
+    a source nor a detector are terminated, exactly as in
+    SqrMesh_NxM.terminate.
+
+    The solved system is described by the BTUs it contains and by links
+    between their ports. Each link carries the weight of a chain of BTU
+    hops (an empty chain has weight 1), so that reduced descriptions of the
+    mesh (see ReducedMeshSolver) are solved in exactly the same way:
+
+        links:      a[dst] = t[chain] * b[src]   (between solved BTU ports)
+        sources:    a[port] = t[chain] * x[source]
+        detectors:  y[detector] = t[chain] * b[port]
+        direct:     y[detector] = t[chain] * x[source]
+    """
+
+    tol = 1e-9 # S-matrix elements below tol are considered zero
+
+    def __init__(self, mesh, src_list, det_list, chunk_size=None, prune=False, variable=None):
+        """
+        Args:
+            mesh (SqrMesh_NxM): the (unterminated) mesh to solve
+            src_list (list): edge port indices of the sources
+            det_list (list): edge port indices of the detectors
+            chunk_size (optional, int): number of wavelengths factorized
+                together, by default chosen from the number of ports
+            prune (bool): leave out the BTUs that SqrMesh_NxM.get_active_btus
+                finds inactive for the current BTU states. Call initialize()
+                again after changing the state of the mesh.
+            variable (optional, array): mesh indices of BTUs whose state may
+                change without calling initialize() again, e.g. in solve_batch.
+                Pruning and reduction assume that they couple all ports.
+        """
+        self.mesh = mesh
+        self.prune = prune
+        self.variable = np.zeros(len(mesh.components), dtype=bool)
+        if variable is not None:
+            self.variable[np.asarray(variable, dtype=np.int64)] = True
+        if mesh.thermal is not None:
+            # the heaters of variable BTUs also change their neighbours
+            self.variable = mesh.thermal.get_coupled(self.variable)
+        # same ordering as the terminated photontorch network
+        self.src_list = sorted(src_list)
+        self.det_list = sorted(det_list)
+        self._chunk_size = chunk_size
+        self.initialize()
+
+    @property
+    def detector_names(self):
+        """ names of the detectors, as in the terminated network """
+        return ["p%i" % i for i in self.det_list]
+
+    @property
+    def num_btus(self):
+        """ number of BTUs in the solved system """
+        return len(self.btus)
+
+    @property
+    def used_btus(self):
+        """ mesh indices of the BTUs whose S-matrices enter solve_S: the
+        solved BTUs and the hops of the chains """
+        return np.union1d(self.btus, self._hops[:, 0])
+
+    def get_active(self):
+        """ BTUs that take part in the solve (all of them without pruning) """
+        if self.prune:
+            active = self.mesh.get_active_btus(
+                self.src_list, self.det_list, self.tol, np.where(self.variable)[0]
+            )
+        else:
+            active = np.ones(len(self.mesh.components), dtype=bool)
+        if self.prune: logger.debug("Pruned %i of %i BTUs" % ((~active).sum(), len(active)))
+        return active
+
+    def initialize(self):
+        """ build the sparse system from the mesh connectivity """
+        pairs, edge_ports = self.mesh.get_port_map()
+        active = self.get_active()
+        btus = np.where(active)[0]
+        local = -np.ones(4*len(active), dtype=np.int64)
+        local[(4*btus[:, None] + np.arange(4)).ravel()] = np.arange(4*len(btus))
+
+        pairs = local[pairs[active[pairs[:, 0]//4] & active[pairs[:, 1]//4]]]
+        src = np.where(active[edge_ports[self.src_list]//4])[0]
+        det = np.where(active[edge_ports[self.det_list]//4])[0]
+        self.set_system(
+            btus=btus,
+            links=np.concatenate([pairs, pairs[:, ::-1]]),
+            sources=np.stack([local[edge_ports[self.src_list]][src], src], 1),
+            detectors=np.stack([local[edge_ports[self.det_list]][det], det], 1),
+            chains=[],
+        )
+        return self
+
+    def set_system(self, btus, links, sources, detectors, chains, direct=None):
+        """ set the description of the solved system
+
+        Ports are numbered 4*i + p for port p of the i-th solved BTU. The
+        last column of links, sources, detectors and direct holds the chain
+        index (-1 or missing for a connection without hops).
+
+        Args:
+            btus (np.ndarray[#btus]): mesh (component) index of the solved BTUs
+            links (np.ndarray[#links, 2 or 3]): (dst, src[, chain])
+            sources (np.ndarray[#entries, 2 or 3]): (port, source[, chain])
+            detectors (np.ndarray[#entries, 2 or 3]): (port, detector[, chain])
+            chains (list): per chain a list of hops (btu, out_port, in_port),
+                with btu the mesh index and the ports local to that BTU
+            direct (optional, np.ndarray[#entries, 3]): (detector, source, chain)
+        """
+        def with_chain(x):
+            x = np.asarray(x, dtype=np.int64)
+            if x.ndim == 2 and x.shape[1] == 2:
+                x = np.concatenate([x, -np.ones((len(x), 1), dtype=np.int64)], 1)
+            return x.reshape(-1, 3)
+
+        self.btus = np.asarray(btus, dtype=np.int64)
+        self.num_ports = 4*len(self.btus)
+        self.links = with_chain(links)
+        self.sources = with_chain(sources)
+        self.detectors = with_chain(detectors)
+        self.direct = with_chain(np.zeros((0, 3)) if direct is None else direct)
+
+        # hops of all chains, stored contiguously (chain index num_chains is
+        # the empty chain, referenced by -1)
+        self.num_chains = len(chains)
+        lengths = np.array([len(c) for c in chains], dtype=np.int64)
+        self._chain_starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+        self._chain_nonempty = lengths > 0
+        hops = [hop for c in chains for hop in c]
+        self._hops = np.array(hops, dtype=np.int64).reshape(-1, 3)
+
+        # chunking only pays off while the SuperLU overhead dominates
+        chunk_size = self._chunk_size
+        if chunk_size is None:
+            chunk_size = max(1, 8192 // max(self.num_ports, 1))
+        self.chunk_size = int(chunk_size)
+
+        # Sparsity pattern of S G: a[dst] = t*b[src] puts t times column dst
+        # of S in column src, nonzero only in the 4 rows of the BTU of dst.
+        dst, src = self.links[:, 0], self.links[:, 1]
+        self._sg_cols = np.repeat(src, 4)
+        self._sg_rows = (4*(dst//4)[:, None] + np.arange(4)).ravel()
+
+        # Full pattern of I - S G in CSC order, duplicates are summed
+        P = self.num_ports
+        rows = np.concatenate([np.arange(P), self._sg_rows])
+        cols = np.concatenate([np.arange(P), self._sg_cols])
+        keys, inverse = np.unique(cols*P + rows, return_inverse=True)
+        self._csc_indices = keys % P
+        self._csc_indptr = np.concatenate(
+            [[0], np.cumsum(np.bincount(keys // P, minlength=P))]
+        )
+        self._csc_sum = sparse.csr_matrix(
+            (np.ones(len(rows)), (inverse.ravel(), np.arange(len(rows)))),
+            shape=(len(keys), len(rows)),
+        )
+
+    def get_chain_weights(self, S):
+        """ transmission of every chain of hops
+
+        Args:
+            S (np.ndarray[#mesh btus, #wavelengths, 4, 4]): BTU S-matrices
+
+        Returns:
+            np.ndarray[#chains + 1, #wavelengths], the last row (index -1)
+            is the empty chain.
+        """
+        t = np.ones((self.num_chains + 1, S.shape[1]), dtype=np.complex128)
+        if len(self._hops):
+            hops = S[self._hops[:, 0], :, self._hops[:, 1], self._hops[:, 2]]
+            t[:-1][self._chain_nonempty] = np.multiply.reduceat(
+                hops, self._chain_starts[self._chain_nonempty], axis=0
+            )
+        return t
+
+    def assemble(self, S):
+        """ sparse system for the given BTU S-matrices
+
+        Args:
+            S (np.ndarray[#mesh btus, #wavelengths, 4, 4]): BTU S-matrices
+                of all BTUs in the mesh
+
+        Returns:
+            data (np.ndarray[#wavelengths, nnz]): values of I - S G in CSC order
+            rhs (np.ndarray[#wavelengths, #ports, #sources]): S x
+            t (np.ndarray[#chains + 1, #wavelengths]): chain weights
+        """
+        num_wl = S.shape[1]
+        t = self.get_chain_weights(S)
+        Sb = S[self.btus]
+
+        # t * S[:, dst] for all pattern entries, (#wavelengths, nnz(S G))
+        dst = np.repeat(self.links[:, 0], 4)
+        SG = Sb[dst//4, :, np.tile(np.arange(4), len(self.links)), dst % 4].T
+        SG = SG * np.repeat(t[self.links[:, 2]].T, 4, axis=1)
+        entries = np.concatenate([np.ones((num_wl, self.num_ports)), -SG], 1)
+        data = (self._csc_sum @ entries.T).T
+
+        # right hand side S x: t * column port of S for each source entry
+        rhs = np.zeros((num_wl, self.num_ports, len(self.src_list)), dtype=np.complex128)
+        for port, i, chain in self.sources:
+            rhs[:, 4*(port//4):4*(port//4)+4, i] += t[chain][:, None] * Sb[port//4, :, :, port % 4]
+        return data, rhs, t
+
+    def factorize(self, data):
+        """ sparse LU factorization for a chunk of wavelengths
+
+        The systems of the different wavelengths are independent, so they
+        are factorized together as one block diagonal matrix, which avoids
+        the Python overhead of one factorization per wavelength.
+
+        Args:
+            data (np.ndarray[#wavelengths, nnz]): values from assemble
+
+        Returns:
+            scipy.sparse.linalg.SuperLU
+        """
+        c, nnz = data.shape
+        P = self.num_ports
+        indices = (self._csc_indices + P*np.arange(c)[:, None]).ravel()
+        indptr = np.concatenate(
+            [(self._csc_indptr[:-1] + nnz*np.arange(c)[:, None]).ravel(), [c*nnz]]
+        )
+        A = sparse.csc_matrix((data.ravel(), indices, indptr), shape=(c*P, c*P))
+        return splinalg.splu(A)
+
+    def readout(self, b, t):
+        """ detector fields from the solved outgoing waves
+
+        Args:
+            b (np.ndarray[#wavelengths, #ports, #sources]): outgoing waves
+            t (np.ndarray[#chains + 1, #wavelengths]): chain weights
+
+        Returns:
+            np.ndarray[#wavelengths, #detectors, #sources]
+        """
+        out = np.zeros((b.shape[0], len(self.det_list), len(self.src_list)), dtype=np.complex128)
+        for port, i, chain in self.detectors:
+            out[:, i, :] += t[chain][:, None] * b[:, port, :]
+        for i, j, chain in self.direct:
+            out[:, i, j] += t[chain]
+        return out
+
+    def solve_S(self, S):
+        """ complex transmission for given BTU S-matrices
+
+        Args:
+            S (np.ndarray[#mesh btus, #wavelengths, 4, 4]): BTU S-matrices
+                of all BTUs in the mesh, factorized in chunks of chunk_size
+
+        Returns:
+            np.ndarray[#wavelengths, #detectors, #sources] (complex128)
+        """
+        out = np.zeros((S.shape[1], len(self.det_list), len(self.src_list)), dtype=np.complex128)
+        for w in range(0, S.shape[1], self.chunk_size):
+            data, rhs, t = self.assemble(S[:, w:w+self.chunk_size])
+            c = data.shape[0]
+            if self.num_ports > 0:
+                b = self.factorize(data).solve(rhs.reshape(c*self.num_ports, -1))
+                b = b.reshape(c, self.num_ports, -1)
+            else:
+                b = rhs
+            out[w:w+c] = self.readout(b, t)
+        return out
+
+    def solve(self, wl=None):
+        """ complex transmission from every source to every detector
+
+        Args:
+            wl (optional, np.ndarray): wavelengths, defaults to the current
+                photontorch environment
+
+        Returns:
+            np.ndarray[#wavelengths, #detectors, #sources] (complex128)
+        """
+        wl = get_wavelengths(wl)
+        out = np.zeros((len(wl), len(self.det_list), len(self.src_list)), dtype=np.complex128)
+        for w in range(0, len(wl), self.chunk_size):
+            S = get_btu_S(self.mesh, wl[w:w+self.chunk_size])
+            out[w:w+S.shape[1]] = self.solve_S(S)
+        logger.debug("Sparse solve: %i ports, %i wavelengths" % (self.num_ports, len(wl)))
+        return out
+
+    def solve_batch(self, phiU, phiL, phi_offset=None, wl=None):
+        """ complex transmission for a batch of BTU configurations
+
+        The configurations are stacked along the wavelength axis, so the
+        whole batch is solved with the same chunked factorizations as a
+        single long sweep. Pruned and reduced systems are only valid for the
+        BTU states they were built for, so the BTUs that change within the
+        batch have to be declared as variable.
+
+        Args:
+            phiU, phiL (array[#configs, #mesh btus]): BTU phases, see
+                SqrMesh_NxM.get_config_batch
+            phi_offset (optional, array[#configs, #mesh btus]): defaults to
+                the current phase offsets
+            wl (optional, np.ndarray): wavelengths, defaults to the current
+                photontorch environment
+
+        Returns:
+            np.ndarray[#configs, #wavelengths, #detectors, #sources] (complex128)
+        """
+        wl = get_wavelengths(wl)
+        phiU = torch.as_tensor(phiU, dtype=torch.float64)
+        phiL = torch.as_tensor(phiL, dtype=torch.float64)
+        if phi_offset is not None:
+            phi_offset = torch.as_tensor(phi_offset, dtype=torch.float64)
+        num_configs, num_btus = phiU.shape
+
+        # BTUs whose coupling pattern the system was built for
+        fixed = ~self.variable
+        if not self.prune:
+            fixed[self.btus] = False
+        mask = self.mesh.get_coupling_mask(self.tol)[fixed]
+
+        out = np.zeros((num_configs, len(wl), len(self.det_list), len(self.src_list)), dtype=np.complex128)
+        step = max(1, self.chunk_size // len(wl))
+        for i in range(0, num_configs, step):
+            S = get_btu_S(
+                self.mesh, wl, phiU[i:i+step], phiL[i:i+step],
+                None if phi_offset is None else phi_offset[i:i+step],
+            )
+            if ((np.abs(S[:, fixed, 0]) > self.tol) != mask).any():
+                raise ValueError("BTUs outside the solved system change state within the batch, "
+                                 "declare them as variable")
+            c = S.shape[0]
+            S = np.moveaxis(S, 0, 1).reshape(num_btus, c*len(wl), 4, 4)
+            out[i:i+c] = self.solve_S(S).reshape(c, len(wl), len(self.det_list), -1)
+        logger.debug("Batch solve: %i configurations, %i wavelengths" % (num_configs, len(wl)))
+        return out
+
+    def get_jacobian(self, source=1, wl=None, phiU=None, phiL=None, phi_offset=None):
+        r""" Adjoint sensitivities of the detected power to all BTU phases
+
+        With a = G b + x the waves entering the BTU ports, a change dS of the
+        BTU S-matrices changes the detector fields by
+
+            dy = R A^-1 dS a = L^T dS a,   A^T L = R^T,
+
+        so one forward solve (b) and one adjoint solve (L, with the
+        transpose of the same factorization) give the derivatives for all
+        BTUs at once. dS/dphiC = j S and dS/dphiD is the S-matrix with
+        phi_offset + pi, so phiU, phiL and phi_offset follow from these two.
+        A batch of configurations is stacked along the wavelength axis, as
+        in solve_batch.
+
+        Args:
+            source (float|array): field amplitude of each source
+            wl (optional, np.ndarray): wavelengths, defaults to the current
+                photontorch environment
+            phiU, phiL, phi_offset (optional, array[#mesh btus] or
+                array[#configs, #mesh btus]): phases to use instead of the
+                BTU parameters
+
+        Returns:
+            dict of np.ndarray: 'power' [#wavelengths, #detectors] and the
+            derivatives 'phiU', 'phiL', 'phi_offset' [#wavelengths,
+            #detectors, #mesh btus] of the detected power, with a leading
+            #configs axis for a batch of configurations
+        """
+        num_btus = len(self.mesh.components)
+        if self.num_btus < num_btus or self.num_chains > 0:
+            raise ValueError("get_jacobian needs the full mesh, without pruning or reduction")
+        wl = get_wavelengths(wl)
+        source = np.broadcast_to(np.asarray(source, dtype=np.complex128), (len(self.src_list),))
+        params = self.mesh.get_btu_params()
+        phases = {}
+        for name, value in [('phiU', phiU), ('phiL', phiL), ('phi_offset', phi_offset)]:
+            phases[name] = params[name].detach() if value is None else torch.as_tensor(value, dtype=torch.float64)
+        batch = max(x.dim() for x in phases.values()) > 1
+        phases = dict(zip(phases, torch.broadcast_tensors(*[x.reshape(-1, num_btus) for x in phases.values()])))
+        num_configs = phases['phiU'].shape[0]
+        P, D = self.num_ports, len(self.det_list)
+
+        # detector selection R^T, the same for every wavelength of a chunk
+        RT = np.zeros((P, D), dtype=np.complex128)
+        RT[self.detectors[:, 0], self.detectors[:, 1]] = 1
+
+        out = {name: np.zeros((num_configs, len(wl), D, num_btus)) for name in ['phiU', 'phiL', 'phi_offset']}
+        out['power'] = np.zeros((num_configs, len(wl), D))
+        step = max(1, self.chunk_size // len(wl))
+        for i in range(0, num_configs, step):
+            for w in range(0, len(wl), self.chunk_size):
+                chunk = {name: x[i:i+step] for name, x in phases.items()}
+                S = get_btu_S(self.mesh, wl[w:w+self.chunk_size], **chunk)
+                SD = get_btu_S(self.mesh, wl[w:w+self.chunk_size], chunk['phiU'], chunk['phiL'],
+                               chunk['phi_offset'] + np.pi)
+                shape = S.shape[0], S.shape[2]
+                S = np.moveaxis(S, 0, 1).reshape(num_btus, -1, 4, 4)
+                SD = np.moveaxis(SD, 0, 1).reshape(num_btus, -1, 4, 4)
+                data, rhs, t = self.assemble(S)
+                c = data.shape[0]
+                lu = self.factorize(data)
+
+                b = lu.solve((rhs @ source).ravel()).reshape(c, P)
+                L = lu.solve(np.tile(RT, (c, 1)), trans='T').reshape(c, P, D)
+                y = self.readout(b[:, :, None], t)[:, :, 0]
+
+                # waves entering the BTU ports
+                a = np.zeros((c, P), dtype=np.complex128)
+                a[:, self.links[:, 0]] = b[:, self.links[:, 1]]
+                a[:, self.sources[:, 0]] += source[self.sources[:, 1]]
+
+                L = L.reshape(c, num_btus, 4, D)
+                a = a.reshape(c, num_btus, 4)
+                dC = 1j*np.einsum('wkod,kwoi,wki->wdk', L, S, a)
+                dD = np.einsum('wkod,kwoi,wki->wdk', L, SD, a)
+                # dP = 2 Re(conj(y) dy)
+                yc = np.conj(y)[:, :, None]
+                rows = slice(i, i + shape[0]), slice(w, w + shape[1])
+                out['phiU'][rows] = np.real(yc * (dC + dD)).reshape(shape + (D, num_btus))
+                out['phiL'][rows] = np.real(yc * (dC - dD)).reshape(shape + (D, num_btus))
+                out['phi_offset'][rows] = np.real(yc * dD).reshape(shape + (D, num_btus))
+                out['power'][rows] = (np.abs(y)**2).reshape(shape + (D,))
+        if self.mesh.thermal is not None:
+            # to the heater phases, through the crosstalk model
+            dU, dL = self.mesh.thermal.backward(phases['phiU'][:, None, None], phases['phiL'][:, None, None],
+                                                out['phiU'], out['phiL'])
+            out['phiU'], out['phiL'] = dU.numpy(), dL.numpy()
+        if not batch:
+            out = {name: x[0] for name, x in out.items()}
+        return out
+
+    def forward(self, source=1, wl=None):
+        """ detected power, in the layout of the terminated photontorch network
+
+        Args:
+            source (float|array): field amplitude of each source
+            wl (optional, np.ndarray): wavelengths, defaults to the current
+                photontorch environment
+
+        Returns:
+            Tensor[1, #wavelengths, #detectors, 1]
+        """
+        H = self.solve(wl)
+        source = np.broadcast_to(np.asarray(source, dtype=np.complex128), (H.shape[2],))
+        det = np.abs(H @ source)**2
+        return torch.tensor(det, dtype=torch.get_default_dtype())[None, :, :, None]
+
+
+##############################################################################
+## Reduced Solver: cross/bar passthrough collapsing
+##############################################################################
+class ReducedMeshSolver(SparseMeshSolver):
+    r""" Sparse solver on the mesh reduced to its coupling BTUs
+
+    BTUs in a pure cross or bar state (including phase_shifter_*) route every
+    input port to exactly one output port. initialize() detects them from
+    the current BTU states and collapses every chain of such passthrough
+    BTUs into one weighted link, so only the BTUs that act as couplers
+    remain in the solved system. The reduction depends on the BTU states:
+    call initialize() again after changing the state of the mesh.
+    """
+
+    def __init__(self, mesh, src_list, det_list, chunk_size=None, prune=False, tol=1e-9,
+                 variable=None):
+        """
+        Args:
+            mesh (SqrMesh_NxM): the (unterminated) mesh to solve
+            src_list (list): edge port indices of the sources
+            det_list (list): edge port indices of the detectors
+            chunk_size (optional, int): number of wavelengths factorized
+                together, by default chosen from the number of ports
+            prune (bool): also leave out the inactive BTUs (see SparseMeshSolver)
+            tol (float): S-matrix elements below tol are considered zero
+            variable (optional, array): mesh indices of BTUs that are never
+                collapsed or pruned (see SparseMeshSolver)
+        """
+        self.tol = float(tol)
+        super(ReducedMeshSolver, self).__init__(mesh, src_list, det_list, chunk_size, prune, variable)
+
+    def get_passthrough(self):
+        """ passthrough map of the BTUs in the current state
+
+        Returns:
+            np.ndarray[#mesh btus, 4]: for passthrough BTUs the output port of
+            every input port, -1 for the BTUs that couple.
+        """
+        mag = self.mesh.get_coupling_mask(self.tol, np.where(self.variable)[0])  # (#btus, out, in)
+        routing = (mag.sum(1) == 1).all(1) & (mag.sum(2) == 1).all(1)
+        through = np.where(routing[:, None], mag.argmax(1), -1)
+        return through
+
+    def initialize(self):
+        """ detect the passthrough BTUs and collapse their chains """
+        pairs, edge_ports = self.mesh.get_port_map()
+        num_btus = len(self.mesh.components)
+        P = 4*num_btus
+        partner = -np.ones(P, dtype=np.int64)
+        partner[pairs[:, 0]] = pairs[:, 1]
+        partner[pairs[:, 1]] = pairs[:, 0]
+        edge_index = -np.ones(P, dtype=np.int64)
+        edge_index[edge_ports] = np.arange(len(edge_ports))
+
+        through = self.get_passthrough()
+        active = self.get_active()
+        btus = np.where((through[:, 0] < 0) & active)[0]
+        local = -np.ones(num_btus, dtype=np.int64)
+        local[btus] = np.arange(len(btus))
+        src_index = {e: i for i, e in enumerate(self.src_list)}
+        det_index = {e: i for i, e in enumerate(self.det_list)}
+        chains = []
+
+        def enter(port, hops):
+            """ follow a wave arriving at global port until it reaches a
+            solved BTU port, leaves the mesh at an edge port or is lost in
+            a pruned BTU """
+            while True:
+                k = port // 4
+                if local[k] >= 0:
+                    return ('port', 4*local[k] + port % 4)
+                if not active[k]:
+                    return ('lost', -1)
+                out = through[k, port % 4]
+                hops.append((k, out, port % 4))
+                port = 4*k + out
+                if partner[port] < 0:
+                    return ('edge', edge_index[port])
+                port = partner[port]
+
+        def add_chain(hops):
+            if not hops:
+                return -1
+            chains.append(hops)
+            return len(chains) - 1
+
+        links, sources, detectors, direct = [], [], [], []
+        # waves leaving the solved BTUs
+        for k in btus:
+            for p in range(4):
+                port = 4*k + p
+                hops = []
+                if partner[port] < 0:
+                    kind, end = ('edge', edge_index[port])
+                else:
+                    kind, end = enter(partner[port], hops)
+                if kind == 'port':
+                    links.append((end, 4*local[k] + p, add_chain(hops)))
+                elif end in det_index:
+                    detectors.append((4*local[k] + p, det_index[end], add_chain(hops)))
+
+        # waves injected by the sources
+        for e, i in src_index.items():
+            hops = []
+            kind, end = enter(edge_ports[e], hops)
+            if kind == 'port':
+                sources.append((end, i, add_chain(hops)))
+            elif end in det_index:
+                direct.append((det_index[end], i, add_chain(hops)))
+
+        self.set_system(
+            btus=btus,
+            links=np.array(links, dtype=np.int64).reshape(-1, 3),
+            sources=np.array(sources, dtype=np.int64).reshape(-1, 3),
+            detectors=np.array(detectors, dtype=np.int64).reshape(-1, 3),
+            chains=chains,
+            direct=np.array(direct, dtype=np.int64).reshape(-1, 3),
+        )
+        logger.debug("Reduced mesh: %i of %i BTUs, %i chains"
+                     % (len(btus), num_btus, len(chains)))
+        return self
+
+
+##############################################################################
+## Complex Solver: native complex torch tensors
+##############################################################################
+class ComplexMeshSolver(ReducedMeshSolver):
+    r""" Dense solver on native complex torch tensors
+
+    Solves the same system (I - S G) b = S x as SparseMeshSolver, but keeps
+    the BTU S-matrices (sip.btu_S_complex) and the system as complex tensors
+    end-to-end and solves it with the batched complex LAPACK solve of
+    torch.linalg.solve. The detected power returned by forward() stays
+    attached to the BTU parameters, so it can be used for gradient-based
+    tuning. The dense system limits this solver to moderate mesh sizes.
+
+    With reduce=True the system is the reduced one of ReducedMeshSolver.
+    The chain weights of the collapsed BTUs are constants, so only the BTUs
+    kept in the system (e.g. declared variable) stay differentiable.
+    """
+
+    def __init__(self, mesh, src_list, det_list, chunk_size=None, prune=False,
+                 dtype=torch.complex128, reduce=False, tol=1e-9, variable=None):
+        """
+        Args:
+            mesh (SqrMesh_NxM): the (unterminated) mesh to solve
+            src_list (list): edge port indices of the sources
+            det_list (list): edge port indices of the detectors
+            chunk_size (optional, int): number of wavelengths solved
+                together, by default chosen to bound the dense system size
+            prune (bool): leave out the inactive BTUs (see SparseMeshSolver)
+            dtype (torch.dtype): complex64 or complex128
+            reduce (bool): collapse the passthrough BTUs (see ReducedMeshSolver)
+            tol (float): S-matrix elements below tol are considered zero
+            variable (optional, array): mesh indices of BTUs that are never
+                collapsed or pruned (see SparseMeshSolver)
+        """
+        self.dtype = dtype
+        self.reduce = reduce
+        super(ComplexMeshSolver, self).__init__(
+            mesh, src_list, det_list, chunk_size, prune, tol, variable
+        )
+
+    def initialize(self):
+        """ build the (reduced) system from the mesh connectivity """
+        if self.reduce:
+            return ReducedMeshSolver.initialize(self)
+        return SparseMeshSolver.initialize(self)
+
+    def set_system(self, *args, **kwargs):
+        super(ComplexMeshSolver, self).set_system(*args, **kwargs)
+        if self._chunk_size is None:
+            # about 2**22 complex elements per dense system chunk
+            self.chunk_size = max(1, 2**22 // max(self.num_ports, 1)**2)
+        self._index = {
+            name: torch.as_tensor(x, dtype=torch.int64, device=self.mesh.device)
+            for name, x in [('det_port', self.detectors[:, 0]), ('det', self.detectors[:, 1]),
+                            ('det_chain', self.detectors[:, 2]),
+                            ('direct', self.direct[:, 0]*len(self.src_list) + self.direct[:, 1]),
+                            ('direct_chain', self.direct[:, 2])]
+        }
+
+        # nonzero entries of S G and S x, as in assemble: (entry of the
+        # flattened system, entry of the flattened BTU S-matrices, chain)
+        r = np.arange(4)
+        dst, src = self.links[:, :1], self.links[:, 1:2]
+        sources = self.sources[:, :1]
+        for name, entry, element, chain in [
+            ('sg', (4*(dst//4) + r)*self.num_ports + src, 16*(dst//4) + 4*r + dst % 4,
+             self.links[:, 2:] + 0*r),
+            ('rhs', (4*(sources//4) + r)*len(self.src_list) + self.sources[:, 1:2],
+             16*(sources//4) + 4*r + sources % 4, self.sources[:, 2:] + 0*r),
+        ]:
+            for key, x in [('entry', entry), ('S', element), ('chain', chain)]:
+                self._index['%s_%s' % (name, key)] = torch.as_tensor(
+                    x.ravel(), dtype=torch.int64, device=self.mesh.device
+                )
+
+    def get_btu_S(self, wls, phiU=None, phiL=None, phi_offset=None):
+        """ complex S-matrices of the solved BTUs
+
+        Args:
+            wls (Tensor[#wavelengths]): wavelengths [m]
+            phiU, phiL, phi_offset (optional, Tensor[..., #mesh btus]): phases
+                to use instead of the BTU parameters
+
+        Returns:
+            Tensor[..., #btus, #wavelengths, 4, 4] of the solver dtype
+        """
+        params = self.mesh.get_btu_params()
+        btus = torch.as_tensor(self.btus, dtype=torch.int64, device=wls.device)
+        phases = [params[name] if value is None else torch.as_tensor(value, device=wls.device)
+                  for name, value in [('phiU', phiU), ('phiL', phiL), ('phi_offset', phi_offset)]]
+        phases[0], phases[1] = self.mesh.get_effective_phases(phases[0], phases[1])
+        return sip.btu_S_complex(
+            *[value[..., btus] for value in phases], wls,
+            *[params[name][btus] for name in ['neff', 'ng', 'wl0', 'length', 'loss']],
+            dtype=self.dtype,
+        )
+
+    def solve_system(self, Sb, t):
+        """ dense solve of the system of a chunk of wavelengths
+
+        Args:
+            Sb (Tensor[..., c, 16*#btus]): flattened S-matrices of the solved
+                BTUs, for c wavelengths (or samples times wavelengths)
+            t (Tensor[c, #chains + 1]): chain weights, see get_chain_weights
+
+        Returns:
+            Tensor[..., c, #detectors, #sources] of the solver dtype
+        """
+        idx = self._index
+        P = self.num_ports
+        D, I = len(self.det_list), len(self.src_list)
+        c = Sb.shape[-2]
+
+        # a[dst] = t*b[src]: only the nonzero entries of S G are gathered,
+        # t times column dst of S is column src of S G
+        A = torch.zeros(Sb.shape[:-1] + (P*P,), dtype=self.dtype, device=Sb.device)
+        A.index_add_(A.dim() - 1, idx['sg_entry'], -Sb[..., idx['sg_S']] * t[:, idx['sg_chain']])
+        A = A.view(Sb.shape[:-1] + (P, P))
+        A.diagonal(0, -2, -1).add_(1)
+        rhs = torch.zeros(Sb.shape[:-1] + (P*I,), dtype=self.dtype, device=Sb.device)
+        rhs.index_add_(rhs.dim() - 1, idx['rhs_entry'], Sb[..., idx['rhs_S']] * t[:, idx['rhs_chain']])
+        rhs = rhs.view(Sb.shape[:-1] + (P, I))
+        b = torch.linalg.solve(A, rhs) if P > 0 else rhs
+
+        y = torch.zeros(b.shape[:-2] + (D, I), dtype=self.dtype, device=Sb.device)
+        y = y.index_add(
+            b.dim() - 2, idx['det'], b[..., idx['det_port'], :] * t[:, idx['det_chain'], None]
+        )
+        direct = torch.zeros((c, D*I), dtype=self.dtype, device=Sb.device)
+        direct = direct.index_add(1, idx['direct'], t[:, idx['direct_chain']])
+        return y + direct.view(c, D, I)
+
+    def solve_S(self, S):
+        """ complex transmission for given BTU S-matrices, as in
+        SparseMeshSolver.solve_S but with the dense batched solve
+
+        Args:
+            S (np.ndarray[#mesh btus, #wavelengths, 4, 4]): BTU S-matrices
+                of all BTUs in the mesh, solved in chunks of chunk_size
+
+        Returns:
+            np.ndarray[#wavelengths, #detectors, #sources] (complex128)
+        """
+        out = np.zeros((S.shape[1], len(self.det_list), len(self.src_list)), dtype=np.complex128)
+        with torch.no_grad():
+            for w in range(0, S.shape[1], self.chunk_size):
+                Sw = S[:, w:w+self.chunk_size]
+                c = Sw.shape[1]
+                t = torch.as_tensor(self.get_chain_weights(Sw).T, dtype=self.dtype, device=self.mesh.device)
+                Sb = torch.as_tensor(Sw[self.btus], dtype=self.dtype, device=self.mesh.device)
+                Sb = Sb.transpose(0, 1).reshape(c, 16*len(self.btus))
+                out[w:w+c] = self.solve_system(Sb, t).cpu().numpy()
+        return out
+
+    def solve_tensor(self, wl=None, phiU=None, phiL=None, phi_offset=None):
+        """ complex transmission, attached to the BTU parameters
+
+        Args:
+            wl (optional, np.ndarray): wavelengths, defaults to the current
+                photontorch environment
+            phiU, phiL, phi_offset (optional, Tensor[..., #mesh btus]): phases
+                to use instead of the BTU parameters, e.g. a batch of
+                configurations. As in solve_batch, BTUs that are pruned or
+                collapsed have to keep their state.
+
+        Returns:
+            Tensor[..., #wavelengths, #detectors, #sources] of the solver dtype
+        """
+        wl = get_wavelengths(wl)
+        wls = torch.tensor(wl, dtype=torch.float64, device=self.mesh.device)
+
+        # configurations are solved together with the wavelengths of a chunk
+        given = [torch.as_tensor(x) for x in (phiU, phiL, phi_offset) if x is not None]
+        batch = torch.broadcast_tensors(*given)[0].shape[:-1] if given else ()
+        step = max(1, self.chunk_size // max(int(np.prod(batch)), 1))
+
+        out = []
+        for w in range(0, len(wls), step):
+            Sb = self.get_btu_S(wls[w:w+step], phiU, phiL, phi_offset)  # (..., #btus, c, 4, 4)
+            c = Sb.shape[-3]
+            Sb = Sb.transpose(-4, -3).reshape(Sb.shape[:-4] + (c, 16*Sb.shape[-4]))  # (..., c, 16*#btus)
+
+            # chain weights of the collapsed BTUs, in their current state
+            t = np.ones((1, c))
+            if self.num_chains > 0:
+                t = self.get_chain_weights(get_btu_S(self.mesh, wl[w:w+step]))
+            t = torch.as_tensor(t.T, dtype=self.dtype, device=wls.device)  # (c, #chains + 1)
+            out.append(self.solve_system(Sb, t))
+        logger.debug("Complex solve: %i ports, %i wavelengths" % (self.num_ports, len(wls)))
+        return torch.cat(out, -3)
+
+    def solve(self, wl=None):
+        """ complex transmission from every source to every detector
+
+        Returns:
+            np.ndarray[#wavelengths, #detectors, #sources] (complex128)
+        """
+        with torch.no_grad():
+            return self.solve_tensor(wl).cpu().numpy().astype(np.complex128)
+
+    def forward(self, source=1, wl=None):
+        """ detected power, attached to the BTU parameters
+
+        Args:
+            source (float|array): field amplitude of each source
+            wl (optional, np.ndarray): wavelengths, defaults to the current
+                photontorch environment
+
+        Returns:
+            Tensor[1, #wavelengths, #detectors, 1]
+        """
+        H = self.solve_tensor(wl)
+        source = torch.as_tensor(source, dtype=H.dtype, device=H.device).expand(H.shape[2])
+        det = ((H @ source).abs()**2).to(torch.get_default_dtype())
+        return det[None, :, :, None]
+
+
+##############################################################################
+## Incremental Solver: low-rank updates for single BTU changes
+##############################################################################
+class IncrementalMeshSolver(SparseMeshSolver):
+    r""" Mesh solver with low-rank re-solves after single BTU changes
+
+    The system I - S G is factorized once for a fixed set of wavelengths
+    (the baseline A0). A BTU only touches the 4 rows of its own ports, so
+    after changing the BTUs k1, k2, ... the system is
+
+        A = A0 + U C V,   U = [E_k1, E_k2, ...], C = -diag(dS_k), V = U^T G
+
+    and is solved with the Woodbury identity
+
+        A^-1 y = A0^-1 y - X C (I + V X C)^-1 V A0^-1 y,   X = A0^-1 U.
+
+    The 4 columns of X for a BTU cost one triangular solve with the cached
+    factors, the first time that BTU changes; repeated changes of the same
+    BTU (e.g. coordinate descent) only rebuild the small capacitance
+    matrix. The baseline is refactorized once more than max_updates
+    different BTUs have changed.
+
+    Typical use::
+
+        solver = IncrementalMeshSolver(mesh, src_list, det_list)
+        solver.set_state('H1_1', ['coupler', 0.3])  # or mesh.set_state + update
+        H = solver.solve()
+    """
+
+    def __init__(self, mesh, src_list, det_list, wl=None, chunk_size=None, max_updates=16):
+        """
+        Args:
+            mesh (SqrMesh_NxM): the (unterminated) mesh to solve
+            src_list (list): edge port indices of the sources
+            det_list (list): edge port indices of the detectors
+            wl (optional, np.ndarray): wavelengths of the cached solution,
+                defaults to the current photontorch environment
+            chunk_size (optional, int): wavelengths per factorization
+            max_updates (int): number of changed BTUs before refactorizing
+        """
+        self.wl = get_wavelengths(wl)
+        self.max_updates = int(max_updates)
+        super(IncrementalMeshSolver, self).__init__(mesh, src_list, det_list, chunk_size=chunk_size)
+
+    def initialize(self):
+        """ build the system and factorize the current state """
+        super(IncrementalMeshSolver, self).initialize()
+
+        # ports feeding the BTU ports through the connections (-1 for edges)
+        pairs, _ = self.mesh.get_port_map()
+        self.partner = -np.ones(self.num_ports, dtype=np.int64)
+        self.partner[pairs[:, 0]] = pairs[:, 1]
+        self.partner[pairs[:, 1]] = pairs[:, 0]
+        return self.refresh()
+
+    def _solve_base(self, y):
+        """ A0^-1 y for y of shape (#wavelengths, #ports, #columns) """
+        x = np.empty_like(y)
+        for sl, lu in self._lu:
+            c = sl.stop - sl.start
+            x[sl] = lu.solve(y[sl].reshape(c*self.num_ports, -1)).reshape(c, self.num_ports, -1)
+        return x
+
+    def refresh(self):
+        """ factorize the current mesh state as the new baseline """
+        self.S0 = get_btu_S(self.mesh, self.wl)
+        self.S = self.S0.copy()
+        data, self._rhs0, self._t = self.assemble(self.S0)
+        self._lu = []
+        for w in range(0, len(self.wl), self.chunk_size):
+            sl = slice(w, min(w + self.chunk_size, len(self.wl)))
+            self._lu.append((sl, self.factorize(data[sl])))
+        self._b0 = self._solve_base(self._rhs0)
+
+        self.updated = [] # changed BTUs, in the column order of X
+        self._X = np.zeros((len(self.wl), self.num_ports, 0), dtype=np.complex128)
+        self._b = self._b0
+        logger.debug("Incremental solver: factorized %i ports, %i wavelengths"
+                     % (self.num_ports, len(self.wl)))
+        return self
+
+    def update(self, btu_key):
+        """ apply the low-rank correction for a changed BTU
+
+        Args:
+            btu_key (str): key of the BTU whose parameters changed
+        """
+        k = self.mesh.btu_index[btu_key]
+        changed = [k]
+        if self.mesh.thermal is not None:
+            # the heater of the BTU also changes its thermal neighbours
+            selected = np.zeros(len(self.mesh.btu_keys), dtype=bool)
+            selected[k] = True
+            changed = list(np.where(self.mesh.thermal.get_coupled(selected))[0])
+        new = [c for c in changed if c not in self.updated]
+        if new and len(self.updated) + len(new) > self.max_updates:
+            self.refresh()
+            return
+
+        wls = torch.tensor(self.wl, dtype=torch.float64)
+        with torch.no_grad():
+            if self.mesh.thermal is None:
+                btu = self.mesh.components[btu_key]
+                S_k = sip.btu_S_batch(
+                    btu.phiU, btu.phiL, btu.phi_offset, wls,
+                    btu.neff, btu.ng, btu.wl0, btu.length, btu.applied_loss, dtype=torch.float64,
+                ).cpu().numpy()[:, None]
+            else:
+                params = self.mesh.get_btu_params()
+                phiU, phiL = self.mesh.get_effective_phases(params['phiU'], params['phiL'])
+                S_k = sip.btu_S_batch(
+                    phiU[changed], phiL[changed], params['phi_offset'][changed], wls,
+                    *[params[name][changed] for name in ['neff', 'ng', 'wl0', 'length', 'loss']],
+                    dtype=torch.float64,
+                ).cpu().numpy()
+        self.S[changed] = S_k[0] + 1j*S_k[1]
+        if new:
+            self.updated += new
+            E = np.zeros((len(self.wl), self.num_ports, 4*len(new)), dtype=np.complex128)
+            for n, c in enumerate(new):
+                E[:, 4*c + np.arange(4), 4*n + np.arange(4)] = 1
+            self._X = np.concatenate([self._X, self._solve_base(E)], 2)
+
+        rows = (4*np.array(self.updated)[:, None] + np.arange(4)).ravel()
+        partner = self.partner[rows]
+        connected = (partner >= 0)[None, :, None]
+        partner = np.maximum(partner, 0)
+
+        # A0^-1 rhs: the source terms only change in the rows of the updated
+        # BTUs, the correction holds as long as any of them feeds a source
+        b = self._b0
+        if np.isin(self.updated, self.btus[self.sources[:, 0]//4]).any():
+            _, rhs, self._t = self.assemble(self.S)
+            b = b + self._X @ (rhs - self._rhs0)[:, rows]
+
+        # block diagonal C = -dS of the changed BTUs
+        m = len(self.updated)
+        dS = self.S[self.updated] - self.S0[self.updated] # (m, #wavelengths, 4, 4)
+        C = np.zeros((len(self.wl), 4*m, 4*m), dtype=np.complex128)
+        for i in range(m):
+            C[:, 4*i:4*i+4, 4*i:4*i+4] = -dS[i]
+
+        XC = self._X @ C
+        cap = np.eye(4*m) + np.where(connected, XC[:, partner], 0)
+        Vb = np.where(connected, b[:, partner], 0)
+        self._b = b - XC @ np.linalg.solve(cap, Vb)
+
+    def set_state(self, btu_key, state):
+        """ SqrMesh_NxM.set_state followed by the low-rank update """
+        self.mesh.set_state(btu_key, state)
+        self.update(btu_key)
+
+    def solve(self, wl=None):
+        """ complex transmission from every source to every detector
+
+        Args:
+            wl (optional, np.ndarray): must be None or equal to the
+                wavelengths of the cached solution
+
+        Returns:
+            np.ndarray[#wavelengths, #detectors, #sources] (complex128)
+        """
+        if wl is not None and not np.array_equal(get_wavelengths(wl), self.wl):
+            raise ValueError("IncrementalMeshSolver only solves at its cached wavelengths")
+        return self.readout(self._b, self._t)
+###############################################################################
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Frequency-chunked streaming sweeps of the SiROAP mesh.
+
+The photontorch network materializes its S and C matrices for all
+wavelengths of the environment at once, so the memory of a single
+pt.Environment(f=...) sweep grows linearly with the number of points. The
+functions in this module split the frequency axis in chunks, simulate one
+chunk per environment and hand the detector powers back chunk by chunk, so
+the peak memory only depends on the chunk size.
+
+The simulated model is either the terminated mesh (pt.Network) or one of the
+solvers of siroap_solvers / siroap_zdomain, anything with a
+forward(source=...) that simulates the current environment.
+
+adaptive_sweep starts from a coarse grid and only refines it where the
+response bends, around the resonances, and returns a non-uniform sweep.
+
+parallel_sweep distributes the frequency chunks and/or a list of mesh
+configurations over a pool of worker processes, each holding its own model.
+
+The code is copyright of Vishal Saxena, 2022 and permission and license is
+required to reuse this code.
+
+@author: vsaxena
+"""
+import logging
+import multiprocessing
+import numpy as np
+import os
+import torch
+import photontorch as pt
+
+from concurrent.futures import ProcessPoolExecutor
+from photontorch.components.terms import Detector
+
+# Import local library
+import siroap_library as siroap
+
+
+# diagnostics are logged at DEBUG level, e.g. logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+##############################################################################
+## Helper functions
+##############################################################################
+def get_detector_names(model):
+    """ names of the detectors, in the column order of the sweep results """
+    if isinstance(model, pt.Network):
+        return [name for name, comp in model.components.items() if isinstance(comp, Detector)]
+    return list(model.detector_names)
+
+
+def apply_config(model, mesh_dict):
+    """ set_state of every BTU in mesh_dict on the mesh inside the model """
+    for module in getattr(model, 'mesh', model).modules():
+        if isinstance(module, siroap.SqrMesh_NxM):
+            for key, state in mesh_dict.items():
+                module.set_state(key, state)
+            return
+    raise ValueError("model does not contain a SqrMesh_NxM")
+
+
+def _simulate(model, f_chunk, source, initialize=False):
+    """ detected power np.ndarray[#chunk, #detectors] at the frequencies f_chunk """
+    with torch.no_grad(), pt.Environment(f=f_chunk, freqdomain=True):
+        if initialize:
+            model.initialize()
+        det = model.forward(source=source)
+    return det.detach().cpu().numpy()[0, :, :, 0]
+
+
+##############################################################################
+## Streaming sweeps
+##############################################################################
+def sweep(model, f, chunk_size=1000, source=1):
+    """ Generator of the detected power, one frequency chunk at a time
+
+    Args:
+        model (pt.Network|solver): terminated mesh or mesh solver
+        f (np.ndarray): [1/s] frequencies of the full sweep
+        chunk_size (int): number of frequencies simulated together
+        source (float|array): source amplitude, as in model.forward
+
+    Yields:
+        f_chunk (np.ndarray[#chunk]): frequencies of the chunk
+        det (np.ndarray[#chunk, #detectors]): detected power
+    """
+    f = np.atleast_1d(np.asarray(f, dtype=np.float64))
+    for start in range(0, len(f), chunk_size):
+        f_chunk = f[start:start + chunk_size]
+        det = _simulate(model, f_chunk, source)
+        logger.debug("Sweep: %i of %i points" % (start + len(f_chunk), len(f)))
+        yield f_chunk, det
+
+
+def sweep_to_file(model, f, filename, chunk_size=1000, source=1):
+    """ Stream a sweep straight to a .npy file
+
+    The detected power is written chunk by chunk into a memory-mapped .npy
+    file of shape (#frequencies, #detectors), so that sweeps which do not fit
+    into memory can be run and later be read back with np.load(filename,
+    mmap_mode='r').
+
+    Args:
+        model (pt.Network|solver): terminated mesh or mesh solver
+        f (np.ndarray): [1/s] frequencies of the full sweep
+        filename (str): path of the .npy file
+        chunk_size (int): number of frequencies simulated together
+        source (float|array): source amplitude, as in model.forward
+
+    Returns:
+        list: detector names, in the column order of the file
+    """
+    f = np.atleast_1d(np.asarray(f, dtype=np.float64))
+    out = None
+    start = 0
+    for f_chunk, det in sweep(model, f, chunk_size, source):
+        if out is None:
+            out = np.lib.format.open_memmap(
+                filename, mode='w+', dtype=det.dtype, shape=(len(f), det.shape[1])
+            )
+        out[start:start + len(f_chunk)] = det
+        out.flush()
+        start += len(f_chunk)
+    del out
+    return get_detector_names(model)
+
+
+##############################################################################
+## Adaptive sweeps
+##############################################################################
+def adaptive_sweep(model, fmin, fmax, tol=0.1, num_initial=33, max_points=1001,
+                   min_step=None, floor=-100, source=1):
+    """ Sweep that refines the frequency grid only around the resonances
+
+    Starting from a coarse uniform grid, every interval is bisected and its
+    midpoint simulated; the interval is kept (and its halves checked again)
+    where the power at the midpoint differs from the linear interpolation
+    (in dB) of its end points by more than tol, i.e. where the response
+    bends or turns faster than the grid resolves. An interval has to pass
+    twice, for itself and for its halves: around a notch the errors of the
+    two halves can cancel at the midpoint. The midpoints of a round are
+    simulated together in one environment.
+
+    The coarse grid has to resolve the presence of every resonance: a
+    resonance much narrower than the initial spacing can be missed.
+
+    Only the detected powers are refined on, the models give no phase. The
+    resonances of the APF2 and CROW designs are seen in magnitude: those of
+    the CROWs at their drop and through ports, those of the all-pass rings
+    (flat magnitude, all in the phase) at their monitor taps, which are
+    detectors of the sweep. A design whose resonances are only seen in
+    phase needs a detector that sees them in power, e.g. a monitor tap.
+
+    Args:
+        model (pt.Network|solver): terminated mesh or mesh solver
+        fmin, fmax (float): [1/s] frequency range
+        tol (float): [dB] largest deviation of a midpoint from the linear
+            interpolation of the detected power
+        num_initial (int): points of the initial uniform grid
+        max_points (int): largest number of simulated points, at least
+            num_initial. When it binds, the intervals with the largest
+            deviation in the last round are refined first.
+        min_step (optional, float): [1/s] intervals are not bisected below
+            this width, defaults to (fmax - fmin)*1e-5
+        floor (float): [dB] smaller powers are compared at the floor
+        source (float|array): source amplitude, as in model.forward
+
+    Returns:
+        f (np.ndarray[#points]): non-uniform, increasing frequencies
+        det (np.ndarray[#points, #detectors]): detected power
+    """
+    if num_initial < 2 or num_initial > max_points:
+        raise ValueError("num_initial (%i) has to be in [2, max_points (%i)]" % (num_initial, max_points))
+    min_step = (fmax - fmin)*1e-5 if min_step is None else min_step
+    f = np.linspace(fmin, fmax, num_initial)
+    det = _simulate(model, f, source)
+    dB = lambda power: 10*np.log10(np.maximum(power, 10**(floor/10)))
+    active = np.ones(len(f) - 1, dtype=bool)
+    # intervals whose parent passed once, they are checked to confirm it
+    confirm = np.zeros(len(f) - 1, dtype=bool)
+    # deviation at the midpoint each interval was split off from, the
+    # intervals with the largest ones are refined first when max_points binds
+    priority = None
+    while True:
+        active &= np.diff(f) > 2*min_step
+        left = np.where(active)[0]
+        budget = max(0, max_points - len(f))
+        if len(left) > budget:
+            if priority is None: # initial grid, spread over the band
+                left = left[np.linspace(0, len(left) - 1, budget).round().astype(np.int64)]
+            else:
+                left = np.sort(left[np.argsort(-priority[left], kind='stable')[:budget]])
+        if len(left) == 0:
+            break
+        f_mid = (f[left] + f[left + 1])/2
+        det_mid = _simulate(model, f_mid, source)
+        error = np.abs(dB(det_mid) - (dB(det[left]) + dB(det[left + 1]))/2).max(1)
+
+        # insert the midpoints, the halves of the failed intervals stay
+        # active, as those of the intervals that passed for the first time
+        failed = np.zeros(len(f) + len(left), dtype=bool)
+        passed = np.zeros(len(f) + len(left), dtype=bool)
+        failed[len(f):] = error > tol
+        passed[len(f):] = (error <= tol) & ~confirm[left]
+        score = np.zeros(len(f) + len(left))
+        score[len(f):] = error
+        f = np.concatenate([f, f_mid])
+        det = np.concatenate([det, det_mid])
+        order = np.argsort(f, kind='stable')
+        f, det, failed, passed, score = f[order], det[order], failed[order], passed[order], score[order]
+        # every active interval is a half of an interval of this round
+        priority = np.maximum(score[:-1], score[1:])
+        active = failed[:-1] | failed[1:] | passed[:-1] | passed[1:]
+        confirm = active & ~(failed[:-1] | failed[1:])
+        logger.debug("Adaptive sweep: %i points, %i intervals to refine" % (len(f), active.sum()))
+    return f, det
+
+
+##############################################################################
+## Parallel sweeps
+##############################################################################
+# model of the worker process, built once by _init_worker
+_worker = {}
+
+# thread limits of the BLAS/OpenMP libraries, read when they are loaded
+_THREAD_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+def _init_worker(build_model, num_threads):
+    torch.set_num_threads(num_threads)
+    model = build_model()
+    _worker['model'] = model
+    # reference state of the mesh, restored before every configuration
+    state = getattr(model, 'mesh', model).state_dict()
+    _worker['state'] = {k: v.clone() for k, v in state.items()}
+
+
+def _run_task(task):
+    mesh_dict, f_chunk, source = task
+    model = _worker['model']
+    if mesh_dict is not None:
+        # strict=False: the network adds its simulation buffers on initialize
+        getattr(model, 'mesh', model).load_state_dict(_worker['state'], strict=False)
+        apply_config(model, mesh_dict)
+    return _simulate(model, f_chunk, source, initialize=mesh_dict is not None)
+
+
+def parallel_sweep(build_model, f, configs=None, num_workers=None, chunk_size=None,
+                   source=1, num_threads=1):
+    """ Sweep over frequencies and mesh configurations on a process pool
+
+    Every worker builds its own model once with build_model() and limits
+    torch and the BLAS/OpenMP libraries (used by the scipy and numpy
+    solvers) to num_threads threads, so that the workers do not
+    oversubscribe the cores. The BLAS libraries only read their limits
+    when they are loaded, so the workers are spawned (not forked) with the
+    limits in their environment. The tasks (configuration x frequency
+    chunk) are distributed over the pool and merged back in order.
+
+    Args:
+        build_model (callable): picklable (module level) function without
+            arguments that returns the model, e.g. a terminated SqrMesh_NxM
+            or a solver
+        f (np.ndarray): [1/s] frequencies of the sweep
+        configs (optional, list): mesh_dicts applied with set_state on top
+            of the state of the freshly built model
+        num_workers (optional, int): number of processes, defaults to the
+            number of cores. With 1, the sweep runs in this process.
+        chunk_size (optional, int): number of frequencies per task, by
+            default the frequencies are split evenly over the workers
+        source (float|array): source amplitude, as in model.forward
+        num_threads (int): torch and BLAS threads per worker
+
+    Returns:
+        np.ndarray[#frequencies, #detectors], or
+        np.ndarray[#configs, #frequencies, #detectors] with configs
+    """
+    f = np.atleast_1d(np.asarray(f, dtype=np.float64))
+    num_workers = num_workers or os.cpu_count()
+    if chunk_size is None:
+        chunk_size = int(np.ceil(len(f) / num_workers))
+    chunks = [f[i:i + chunk_size] for i in range(0, len(f), chunk_size)]
+    tasks = [(mesh_dict, f_chunk, source)
+             for mesh_dict in (configs if configs is not None else [None])
+             for f_chunk in chunks]
+    logger.debug("Parallel sweep: %i tasks on %i workers" % (len(tasks), num_workers))
+
+    if num_workers == 1:
+        _init_worker(build_model, torch.get_num_threads())
+        results = [_run_task(task) for task in tasks]
+        _worker.clear()
+    else:
+        environ = {name: os.environ.get(name) for name in _THREAD_VARIABLES}
+        os.environ.update({name: str(num_threads) for name in _THREAD_VARIABLES})
+        try:
+            with ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=_init_worker,
+                                     initargs=(build_model, num_threads)) as pool:
+                results = list(pool.map(_run_task, tasks))
+        finally:
+            for name, value in environ.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+
+    out = np.stack([np.concatenate(results[i:i + len(chunks)])
+                    for i in range(0, len(results), len(chunks))])
+    return out if configs is not None else out[0]
+###############################################################################
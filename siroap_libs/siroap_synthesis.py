@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Gradient-based filter synthesis on the SiROAP square mesh.
+
+The filter designs of siroap_designs/ are mesh_dicts whose coupling
+coefficients and phases were found by hand. FilterSynthesis takes a
+template of such a mesh_dict in which the free parameters are given by
+name instead of by value,
+
+    {'H1_1': ['coupler', 'kappa'],
+     'H3_1': ['coupler', 'kappa'],          # tied to H1_1
+     'V0_2': ['phase_shifter_bar', 'phi'],
+     'V3_2': ['phase_shifter_bar', '-phi'], # tied, with opposite sign
+     'H2_0': ['coupler', np.sqrt(0.5)],     # fixed
+     ...}
+
+and fits the named parameters to a target response over a band. The
+response of a batch of starting points is computed at once with the
+reduced, differentiable siroap_solvers.ComplexMeshSolver and the starts
+are optimized together, with a batched L-BFGS or with torch Adam. The
+result is a plain mesh_dict for SqrMesh_NxM.set_state.
+
+The code is copyright of Vishal Saxena, 2022 and permission and license is
+required to reuse this code.
+
+@author: vsaxena
+"""
+import logging
+import numpy as np
+import torch
+
+# Import local library
+import siroap_library as siroap
+import siroap_solvers as solvers
+
+
+# diagnostics are logged at DEBUG level, e.g. logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# couplers are kept in [_KAPPA_EPS, 1 - _KAPPA_EPS], where the gradient of the
+# arccos of get_state_phases stays finite
+_KAPPA_EPS = 1e-6
+
+##############################################################################
+## Helper functions
+##############################################################################
+def minimize_lbfgs(fun, x, max_iter=100, history=10, tolerance_grad=1e-12,
+                   tolerance_change=1e-15, max_ls=25):
+    """ L-BFGS on independent problems, all evaluated together
+
+    Every row of x is a separate problem with its own curvature history and
+    its own backtracking (Armijo) line search, but each iteration evaluates
+    all rows in one call of fun. Rows that converged keep their value.
+
+    Args:
+        fun (callable): x -> (Tensor[#rows] losses, Tensor[#rows, #variables]
+            their gradients)
+        x (Tensor[#rows, #variables]): starting points
+        max_iter (int): maximum number of iterations
+        history (int): number of curvature pairs kept per row
+        tolerance_grad (float): a row converged when its largest gradient
+            element is below tolerance_grad
+        tolerance_change (float): or when its step is below tolerance_change
+        max_ls (int): maximum number of step halvings of the line search
+
+    Returns:
+        Tensor[#rows, #variables]: the minimizers
+    """
+    x = x.detach().clone()
+    f, g = fun(x)
+    active = g.abs().amax(1) > tolerance_grad
+    pairs = []  # (s, y, rho) of the last iterations, zero for skipped rows
+    gamma = torch.ones_like(f)
+    for it in range(max_iter):
+        if not active.any():
+            break
+        # two-loop recursion, row-wise
+        q, alpha = g.clone(), []
+        for s, y, rho in reversed(pairs):
+            a = rho*(s*q).sum(1)
+            q -= a[:, None]*y
+            alpha.append(a)
+        d = gamma[:, None]*q
+        for (s, y, rho), a in zip(pairs, reversed(alpha)):
+            d += s*(a - rho*(y*d).sum(1))[:, None]
+        d = -d
+        slope = (g*d).sum(1)
+        ascent = slope >= 0
+        d[ascent], slope[ascent] = -g[ascent], -(g[ascent]**2).sum(1)
+
+        # backtracking of the rows that do not decrease enough
+        step = torch.ones_like(f) if it > 0 else torch.clamp(1/g.abs().sum(1), max=1)
+        todo = active.clone()
+        x_new, f_new, g_new = x.clone(), f.clone(), g.clone()
+        for ls in range(max_ls):
+            rows = torch.where(todo)[0]
+            trial = x[rows] + step[rows, None]*d[rows]
+            f_trial, g_trial = fun(trial)
+            accept = f_trial <= f[rows] + 1e-4*step[rows]*slope[rows]
+            rows = rows[accept]
+            x_new[rows], f_new[rows], g_new[rows] = trial[accept], f_trial[accept], g_trial[accept]
+            todo[rows] = False
+            if not todo.any():
+                break
+            step[todo] /= 2
+        moved = active & ~todo
+
+        # curvature pairs, skipped where they are not positive
+        s, y = x_new - x, g_new - g
+        sy = (s*y).sum(1)
+        update = moved & (sy > 1e-10*(s*s).sum(1).sqrt()*(y*y).sum(1).sqrt())
+        rho = torch.where(update, 1/torch.where(update, sy, 1), 0)
+        pairs.append((s*update[:, None], y*update[:, None], rho))
+        pairs = pairs[-history:]
+        gamma = torch.where(update, sy/torch.where(update, (y*y).sum(1), 1), gamma)
+
+        # a failed line search ends the row as well
+        small = (s.abs().amax(1) <= tolerance_change) | (g_new.abs().amax(1) <= tolerance_grad)
+        active &= moved & ~small
+        x, f, g = x_new, f_new, g_new
+        if it % 10 == 0: logger.debug("Iteration %i: best loss %.3e, %i active"
+                                      % (it, f.min().item(), active.sum().item()))
+    return x
+
+
+##############################################################################
+## Filter Synthesis
+##############################################################################
+class FilterSynthesis(object):
+    r""" Fit the named parameters of a mesh_dict template to a target response
+
+    Couplers are parametrized as kappa = eps + (1 - 2 eps)(1 + sin(z))/2,
+    which keeps kappa in [eps, 1 - eps] without constraints and away from
+    the infinite slope of the arccos at 0 and 1, phase shifters by their
+    phase theta.
+
+    A real target is a detected power, fitted by least squares. A complex
+    target is a field (magnitude and phase): its error is taken after the
+    best common phase per detector, since the absolute phase of the
+    response is arbitrary,
+
+        err = sum_w weight*(|y|^2 + |T|^2) - 2 |sum_w weight*conj(T) y|
+    """
+
+    def __init__(self, mesh, src_list, det_list, template, target, wl=None, weight=None,
+                 source=1, dtype=torch.complex128):
+        """
+        Args:
+            mesh (SqrMesh_NxM): the (unterminated) mesh, the fixed states of
+                the template are applied to it
+            src_list (list): edge port indices of the sources
+            det_list (list): edge port indices of the detectors
+            template (dict): mesh_dict with parameter names (str, optionally
+                with a leading '-') in place of the free values
+            target (np.ndarray[#wavelengths, #detectors]): detected power
+                (real) or field (complex), detectors in sorted order
+            wl (optional, np.ndarray): wavelengths of the band, defaults to
+                the current photontorch environment
+            weight (optional, np.ndarray[#wavelengths, #detectors]): weight
+                of every target point, e.g. to emphasize the stop band
+            source (float|array): field amplitude of each source
+            dtype (torch.dtype): complex dtype of the solve
+        """
+        self.mesh = mesh
+        self.template = dict(template)
+        self.wl = solvers.get_wavelengths(wl)
+        keys = list(mesh.components.keys())
+
+        # free BTUs: (mesh index, state, name, sign), the others are set
+        self.free = []
+        self.kinds = {}
+        for key, state in self.template.items():
+            if len(state) < 2 or not isinstance(state[1], str):
+                mesh.set_state(key, state)
+                continue
+            name, sign = state[1].lstrip('-'), -1 if state[1].startswith('-') else 1
+            kind = 'coupler' if state[0] == 'coupler' else 'phase'
+            if state[0] not in ['coupler', 'phase_shifter_bar', 'phase_shifter_cross']:
+                raise ValueError("BTU %s: state '%s' has no free parameter" % (key, state[0]))
+            if kind == 'coupler' and sign < 0:
+                raise ValueError("BTU %s: only phases can be negated" % key)
+            if self.kinds.setdefault(name, kind) != kind:
+                raise ValueError("parameter '%s' is used for couplers and phases" % name)
+            self.free.append((keys.index(key), state[0], name, sign))
+        self.names = sorted(self.kinds)
+
+        self.solver = solvers.ComplexMeshSolver(
+            mesh, src_list, det_list, prune=True, dtype=dtype, reduce=True,
+            variable=[k for k, _, _, _ in self.free],
+        )
+        self.source = torch.as_tensor(source, dtype=dtype).expand(len(self.solver.src_list))
+        self.target = torch.as_tensor(target)
+        self.weight = torch.ones(self.target.shape, dtype=torch.float64) if weight is None \
+            else torch.as_tensor(weight, dtype=torch.float64).expand(self.target.shape)
+        logger.debug("Synthesis: %i free parameters on %i BTUs, %i ports solved"
+                     % (len(self.names), len(self.free), self.solver.num_ports))
+
+    def get_values(self, x):
+        """ kappa or theta of every parameter from the optimization variables
+
+        Args:
+            x (dict): name -> Tensor[#starts]
+
+        Returns:
+            dict: name -> Tensor[#starts]
+        """
+        scale = 1 - 2*_KAPPA_EPS
+        return {name: _KAPPA_EPS + scale*(1 + torch.sin(x[name]))/2 if self.kinds[name] == 'coupler'
+                else x[name] for name in self.names}
+
+    def get_variables(self, values):
+        """ inverse of get_values, couplers are clipped to its range """
+        scale = 1 - 2*_KAPPA_EPS
+        kappa = lambda v: (torch.clamp(v, _KAPPA_EPS, 1 - _KAPPA_EPS) - _KAPPA_EPS)/scale
+        return {name: torch.arcsin(2*kappa(values[name]) - 1) if self.kinds[name] == 'coupler'
+                else values[name] for name in self.names}
+
+    def get_phases(self, values):
+        """ phiU, phiL Tensor[#starts, #mesh btus] for the parameter values """
+        params = self.mesh.get_btu_params()
+        num_starts = len(values[self.names[0]]) if self.names else 1
+        phiU = params['phiU'].detach().double().repeat(num_starts, 1)
+        phiL = params['phiL'].detach().double().repeat(num_starts, 1)
+        for k, state, name, sign in self.free:
+            phiU[:, k], phiL[:, k] = siroap.get_state_phases([state, sign*values[name]])
+        return phiU, phiL
+
+    def get_response(self, values):
+        """ detector fields Tensor[#starts, #wavelengths, #detectors] """
+        phiU, phiL = self.get_phases(values)
+        return self.solver.solve_tensor(self.wl, phiU, phiL) @ self.source
+
+    def get_loss(self, values):
+        """ weighted error to the target, Tensor[#starts] """
+        y = self.get_response(values)
+        if not torch.is_complex(self.target):
+            return (self.weight * (y.abs()**2 - self.target)**2).mean((1, 2))
+        overlap = (self.weight * self.target.conj() * y).sum(1).abs()
+        err = (self.weight * (y.abs()**2 + self.target.abs()**2)).sum(1) - 2*overlap
+        return err.sum(1) / self.target.numel()
+
+    def get_loss_grad(self, z):
+        """ losses Tensor[#starts] and their gradients Tensor[#starts,
+        #parameters] for the optimization variables z Tensor[#starts,
+        #parameters], in the order of self.names """
+        z = z.detach().requires_grad_()
+        with torch.enable_grad():
+            loss = self.get_loss(self.get_values(dict(zip(self.names, z.T))))
+            grad, = torch.autograd.grad(loss.sum(), z)
+        return loss.detach(), grad
+
+    def run(self, num_starts=8, method='lbfgs', steps=100, lr=0.05, refine=20, init=None,
+            seed=None):
+        """ optimize the starting points
+
+        All starts are evaluated together in every step. Adam works
+        element-wise, so it runs on the sum of their losses, and the starts
+        are then refined by L-BFGS: Adam alone crawls along the flat valleys
+        of the loss. L-BFGS keeps a curvature history and a line search per
+        start (see minimize_lbfgs).
+
+        Args:
+            num_starts (int): number of starting points
+            method (str): 'lbfgs' or 'adam'
+            steps (int): L-BFGS iterations or Adam steps
+            lr (float): step size of Adam
+            refine (int): L-BFGS iterations after the Adam steps
+            init (optional, dict): name -> kappa or theta of the first start,
+                the other starts are random
+            seed (optional, int): seed of the random starts
+
+        Returns:
+            dict: mesh_dict of the best start, see get_mesh_dict
+        """
+        if method not in ['lbfgs', 'adam']:
+            raise ValueError("unknown method '%s'" % method)
+        generator = torch.Generator()
+        if seed is not None:
+            generator.manual_seed(seed)
+        values = {}
+        for name in self.names:
+            rand = torch.rand(num_starts, dtype=torch.float64, generator=generator)
+            values[name] = rand if self.kinds[name] == 'coupler' else np.pi*(2*rand - 1)
+            if init is not None and name in init:
+                values[name][0] = init[name]
+        x = self.get_variables(values)
+        z = torch.stack([x[name] for name in self.names], 1)
+
+        if method == 'adam':
+            z.requires_grad_()
+            optimizer = torch.optim.Adam([z], lr=lr)
+            with torch.enable_grad():
+                for step in range(steps):
+                    optimizer.zero_grad()
+                    loss = self.get_loss(self.get_values(dict(zip(self.names, z.T)))).sum()
+                    loss.backward()
+                    optimizer.step()
+                    if step % 10 == 0: logger.debug("Step %i: loss %.3e" % (step, loss.item()))
+            z, steps = z.detach(), refine
+        z = minimize_lbfgs(self.get_loss_grad, z, max_iter=steps)
+        x = dict(zip(self.names, z.T))
+
+        with torch.no_grad():
+            values = {name: v.detach() for name, v in self.get_values(x).items()}
+            self.losses = self.get_loss(values).numpy()
+        best = int(np.argmin(self.losses))
+        self.loss = float(self.losses[best])
+        self.values = {name: float(values[name][best]) for name in self.names}
+        logger.debug("Synthesis: best loss %.3e of %i starts" % (self.loss, num_starts))
+        return self.get_mesh_dict(self.values)
+
+    def get_mesh_dict(self, values):
+        """ the template with the parameter names replaced by their values """
+        mesh_dict = {}
+        for key, state in self.template.items():
+            if len(state) > 1 and isinstance(state[1], str):
+                sign = -1 if state[1].startswith('-') else 1
+                state = [state[0], sign*values[state[1].lstrip('-')]]
+            mesh_dict[key] = list(state)
+        return mesh_dict
+###############################################################################
@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Thermal crosstalk model of the SiROAP square mesh.
+
+Every BTU has a heater on its upper (phiU) and lower (phiL) arm. The heat
+of a heater also shifts the phase of the arms around it, so the phase that
+the light sees in an arm is
+
+    phi_eff = phi + X phi
+
+with phi the vector of the heater phases of all arms (the phase each heater
+would give without crosstalk, proportional to its dissipated power) and X
+the coupling between the heaters, X[m, n] = kernel(|r_m - r_n|) for the
+distance between the heater positions on the physical V/H grid of the mesh.
+
+The heaters are placed at the centres of the BTU arms: a V i_j BTU at
+(x, y) = pitch*(j, i + 1/2), an H i_j BTU at pitch*(j + 1/2, i), with the
+arms arm_spacing apart (the upper arm of a V BTU on its east side, of an H
+BTU on its north side, the sides of ports 2 and 3). X is precomputed once,
+either as a sparse matrix of the heater pairs within the cutoff distance
+or, for long-range kernels on large meshes, as FFT kernels of the four
+heater sublattices (V/H, upper/lower arm), which are regular grids. The
+effective phases of all BTUs then follow from one matrix-vector product
+(or one batched FFT convolution) per configuration.
+
+The model is attached to a mesh with
+
+    mesh.thermal = ThermalCrosstalk(mesh)
+
+after which the photontorch network, the solvers of siroap_solvers and the
+analyzers built on them see the effective phases; the BTU parameters (and
+mesh_dicts, set_state, ...) remain the heater phases.
+
+The controller inverts the crosstalk: compensate() returns the heater
+phases that give the desired effective phases, from the sparse LU
+factorization of I + X. The factorization is cached with the kernels and
+reused for every batch of configurations until the geometry (pitch, arm
+spacing, kernel, ...) of the model changes. For a nonlinear heater model,
+where a heater spreads heat(phi) instead of phi,
+
+    phi_eff = phi + X heat(phi),
+
+the linear solution is refined by the chord iteration
+
+    phi <- phi + (I + X)^-1 (phi_target - phi_eff(phi))
+
+with the same factorization. Long-range kernels (method 'fft') are solved
+matrix-free with conjugate gradients instead.
+
+The code is copyright of Vishal Saxena, 2022 and permission and license is
+required to reuse this code.
+
+@author: vsaxena
+"""
+import logging
+import numpy as np
+import torch
+
+import scipy.sparse as sparse
+import scipy.sparse.linalg as splinalg
+from scipy.spatial import cKDTree
+
+
+# diagnostics are logged at DEBUG level, e.g. logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+##############################################################################
+## Thermal Crosstalk
+##############################################################################
+class ThermalCrosstalk(object):
+    r""" Distance-based heater crosstalk on the V/H grid of a SqrMesh_NxM
+
+    The default kernel is an exponential decay of the phase shift with the
+    distance from the heater, strength*exp(-d/decay), set to zero beyond
+    cutoff. The kernel is symmetric, so X is symmetric as well.
+    """
+
+    def __init__(self, mesh, pitch=None, arm_spacing=30e-6, strength=0.1, decay=100e-6,
+                 cutoff=None, kernel=None, method='auto', heat=None):
+        """
+        Args:
+            mesh (SqrMesh_NxM): the mesh whose heaters couple
+            pitch (optional, float): side of a mesh cell [m], defaults to
+                the longest BTU
+            arm_spacing (float): distance between the arms of a BTU [m]
+            strength (float): relative phase shift at zero distance
+            decay (float): decay length of the phase shift [m]
+            cutoff (optional, float): no coupling beyond this distance [m],
+                defaults to 1.5*pitch, np.inf for a full-range kernel
+            kernel (optional, callable): relative phase shift as a function
+                of the distance (np.ndarray), replaces strength and decay
+            method (str): 'sparse', 'fft' or 'auto', which uses the FFT
+                convolution when a heater couples to more than about 64
+                others
+            heat (optional, callable): heat spread by a heater as a function
+                of its phase (Tensor -> Tensor, in units of phase), for a
+                nonlinear heater model. None for the linear model.
+        """
+        self.mesh = mesh
+        params = mesh.get_btu_params()
+        self.pitch = float(params['length'].max()) if pitch is None else float(pitch)
+        self.arm_spacing = float(arm_spacing)
+        self.strength = float(strength)
+        self.decay = float(decay)
+        self.cutoff = 1.5*self.pitch if cutoff is None else float(cutoff)
+        self.kernel = kernel if kernel is not None else self.exp_kernel
+        if method == 'auto':
+            # about 4 heaters per cell area
+            method = 'fft' if 4*np.pi*(self.cutoff/self.pitch)**2 > 64 else 'sparse'
+        if method not in ['sparse', 'fft']:
+            raise ValueError("unknown method '%s'" % method)
+        self.method = method
+        self.heat = heat
+        self._cache = {}
+        logger.debug("Thermal crosstalk: %s, %i heaters" % (self.method, 2*len(mesh.components)))
+
+    @property
+    def num_heaters(self):
+        """ two heaters (upper and lower arm) per BTU """
+        return 2*len(self.mesh.components)
+
+    def get_geometry(self):
+        """ parameters that define X, the cached kernels depend on these """
+        return (self.mesh.N, self.mesh.M, self.pitch, self.arm_spacing, self.strength,
+                self.decay, self.cutoff, self.kernel, self.method)
+
+    def _get_cache(self):
+        """ cache of the kernels and factorization, cleared when the geometry changes """
+        geometry = self.get_geometry()
+        if self._cache.get('geometry') != geometry:
+            if self._cache: logger.debug("Thermal crosstalk: geometry changed, cache cleared")
+            self._cache = {'geometry': geometry}
+        return self._cache
+
+    def exp_kernel(self, d):
+        """ strength*exp(-d/decay) """
+        return self.strength*np.exp(-d/self.decay)
+
+    def get_offsets(self):
+        """ position of the four heater sublattices in their cell
+
+        Returns:
+            np.ndarray[4, 2]: (x, y) in units of the pitch of the V upper,
+            V lower, H upper and H lower arm heaters of the BTUs at (i, j)=(0, 0)
+        """
+        a = self.arm_spacing/2/self.pitch
+        return np.array([[a, 0.5], [-a, 0.5], [0.5, -a], [0.5, a]])
+
+    def get_positions(self):
+        """ heater positions np.ndarray[2*#btus, 2] (x, y) [m]
+
+        The heaters are ordered as the phases in apply: the upper arms of all
+        BTUs (in network order) followed by their lower arms.
+        """
+        sub = self.get_sublattice()
+        grid = np.concatenate([self.mesh.btu_grid, self.mesh.btu_grid])
+        return self.pitch*(grid[:, ::-1] + self.get_offsets()[sub])
+
+    def get_sublattice(self):
+        """ sublattice index (0-3, see get_offsets) of every heater """
+        horizontal = 2*(~self.mesh.btu_vertical).astype(np.int64)
+        return np.concatenate([horizontal, horizontal + 1])
+
+    def get_matrix(self):
+        """ crosstalk matrix X (scipy.sparse.csr_matrix[2*#btus, 2*#btus])
+
+        Built once from the heater pairs within the cutoff distance.
+        """
+        cache = self._get_cache()
+        if 'matrix' not in cache:
+            pos = self.get_positions()
+            pairs = cKDTree(pos).query_pairs(self.cutoff, output_type='ndarray')
+            d = np.linalg.norm(pos[pairs[:, 0]] - pos[pairs[:, 1]], axis=1)
+            data = np.asarray(self.kernel(d), dtype=np.float64)
+            rows = np.concatenate([pairs[:, 0], pairs[:, 1]])
+            cols = np.concatenate([pairs[:, 1], pairs[:, 0]])
+            X = sparse.csr_matrix((np.concatenate([data, data]), (rows, cols)),
+                                  shape=(self.num_heaters, self.num_heaters))
+            X.eliminate_zeros()
+            cache['matrix'] = X
+            logger.debug("Thermal crosstalk: %i couplings" % X.nnz)
+        return cache['matrix']
+
+    def _get_sparse_tensor(self):
+        """ X as a torch sparse tensor, for differentiable products """
+        cache = self._get_cache()
+        if 'tensor' not in cache:
+            X = self.get_matrix().tocoo()
+            cache['tensor'] = torch.sparse_coo_tensor(
+                np.vstack([X.row, X.col]), X.data, X.shape, dtype=torch.float64,
+                check_invariants=False,
+            ).coalesce()
+        return cache['tensor']
+
+    def _get_fft_kernels(self):
+        """ rFFT of the coupling between the heater sublattices
+
+        Returns:
+            Tensor[4, 4, 2*(N+1), M+2] (complex128): the kernel from
+            sublattice t to s, as a function of the grid offset (di, dj)
+        """
+        cache = self._get_cache()
+        if 'fft' not in cache:
+            N, M = self.mesh.N + 1, self.mesh.M + 1
+            # grid offsets in the circular layout of the zero padded grids
+            di = np.arange(2*N)
+            di = np.where(di < N, di, di - 2*N)
+            dj = np.arange(2*M)
+            dj = np.where(dj < M, dj, dj - 2*M)
+            off = self.get_offsets()
+            ker = np.zeros((4, 4, 2*N, 2*M))
+            for s in range(4):
+                for t in range(4):
+                    dx = dj[None, :] + off[s, 0] - off[t, 0]
+                    dy = di[:, None] + off[s, 1] - off[t, 1]
+                    d = self.pitch*np.hypot(dx, dy)
+                    valid = (d <= self.cutoff) & (np.abs(di)[:, None] < N) & (np.abs(dj)[None, :] < M)
+                    if s == t:
+                        valid[0, 0] = False
+                    ker[s, t][valid] = self.kernel(d[valid])
+            cache['fft'] = torch.fft.rfft2(torch.tensor(ker))
+        return cache['fft']
+
+    def _get_grid_index(self):
+        """ flat index of every heater in the stacked sublattice grids """
+        N, M = self.mesh.N + 1, self.mesh.M + 1
+        grid = np.concatenate([self.mesh.btu_grid, self.mesh.btu_grid])
+        return torch.as_tensor(self.get_sublattice()*N*M + grid[:, 0]*M + grid[:, 1])
+
+    def get_perturbation(self, phi):
+        """ phase shift X phi caused by the heater phases phi
+
+        Args:
+            phi (Tensor[..., 2*#btus]): heater phases, upper arms first
+
+        Returns:
+            Tensor[..., 2*#btus] (float64), attached to phi
+        """
+        phi = torch.as_tensor(phi, dtype=torch.float64)
+        shape = phi.shape
+        phi = phi.reshape(-1, self.num_heaters)
+        if self.method == 'sparse':
+            dphi = torch.sparse.mm(self._get_sparse_tensor(), phi.T).T
+        else:
+            N, M = self.mesh.N + 1, self.mesh.M + 1
+            index = self._get_grid_index()
+            grid = phi.new_zeros(phi.shape[0], 4*N*M)
+            grid[:, index] = phi
+            F = torch.fft.rfft2(grid.view(-1, 4, N, M), s=(2*N, 2*M))
+            F = torch.einsum('stuv,btuv->bsuv', self._get_fft_kernels(), F)
+            dphi = torch.fft.irfft2(F, s=(2*N, 2*M))[..., :N, :M].reshape(-1, 4*N*M)[:, index]
+        return dphi.reshape(shape)
+
+    def apply(self, phiU, phiL):
+        """ effective arm phases of all BTUs, including the crosstalk
+
+        Args:
+            phiU, phiL (Tensor[..., #btus]): heater phases of the upper and
+                lower arms, in network (component) order
+
+        Returns:
+            phiU, phiL (Tensor[..., #btus], float64): attached to the inputs
+        """
+        phiU = torch.as_tensor(phiU, dtype=torch.float64)
+        phiL = torch.as_tensor(phiL, dtype=torch.float64)
+        shape = torch.broadcast_tensors(phiU, phiL)[0].shape
+        K = len(self.mesh.components)
+        phi = torch.cat([phiU.expand(shape), phiL.expand(shape)], -1)
+        dphi = self.get_perturbation(phi if self.heat is None else self.heat(phi))
+        return phiU + dphi[..., :K], phiL + dphi[..., K:]
+
+    def backward(self, phiU, phiL, gradU, gradL):
+        """ gradients to the heater phases from those to the effective phases
+
+        Args:
+            phiU, phiL (Tensor[#btus]): heater phases the gradients are taken at
+            gradU, gradL (Tensor[..., #btus]): gradients to the effective
+                phases, e.g. of several detectors and wavelengths
+
+        Returns:
+            gradU, gradL (Tensor[..., #btus], float64)
+        """
+        gradU = torch.as_tensor(gradU, dtype=torch.float64)
+        gradL = torch.as_tensor(gradL, dtype=torch.float64)
+        with torch.enable_grad():
+            # one vector-Jacobian product per row of the gradients
+            phiU = torch.as_tensor(phiU, dtype=torch.float64).detach().expand(gradU.shape).clone()
+            phiL = torch.as_tensor(phiL, dtype=torch.float64).detach().expand(gradL.shape).clone()
+            phiU.requires_grad_()
+            phiL.requires_grad_()
+            effU, effL = self.apply(phiU, phiL)
+            return torch.autograd.grad([effU, effL], [phiU, phiL], [gradU, gradL])
+
+    def get_factorization(self):
+        """ sparse LU factorization (scipy.sparse.linalg.SuperLU) of I + X
+
+        Computed once and cached until the geometry changes.
+        """
+        cache = self._get_cache()
+        if 'lu' not in cache:
+            A = sparse.identity(self.num_heaters, format='csc') + self.get_matrix()
+            cache['lu'] = splinalg.splu(A.tocsc())
+            logger.debug("Thermal crosstalk: factorized %i heaters" % self.num_heaters)
+        return cache['lu']
+
+    def _solve_linear(self, rhs, tol):
+        """ (I + X)^-1 rhs for rhs of shape (2*#btus, #columns) """
+        if self.method == 'sparse':
+            return self.get_factorization().solve(rhs)
+        # matrix-free with the FFT convolution, I + X is symmetric
+        A = splinalg.LinearOperator(
+            (self.num_heaters, self.num_heaters), dtype=np.float64,
+            matvec=lambda x: x.ravel() + self.get_perturbation(torch.as_tensor(x.ravel())).numpy(),
+        )
+        out = np.zeros_like(rhs)
+        for n in range(rhs.shape[1]):
+            out[:, n], info = splinalg.cg(A, rhs[:, n], x0=rhs[:, n], rtol=0, atol=tol)
+            if info != 0:
+                raise ValueError("conjugate gradients did not converge, is I + X positive definite?")
+        return out
+
+    def compensate(self, phiU, phiL, tol=1e-10, max_iter=50):
+        """ heater phases that give the target effective phases
+
+        Args:
+            phiU, phiL (Tensor[..., #btus]): target effective phases of the
+                upper and lower arms, e.g. of a batch of configurations
+            tol (float): largest phase error of the nonlinear iteration
+                (and of the conjugate gradients)
+            max_iter (int): iterations of the nonlinear heater model
+
+        Returns:
+            phiU, phiL (Tensor[..., #btus], float64): heater phases. These
+            may be negative, a target can be shifted by 2*pi when the
+            heaters only heat.
+        """
+        phiU = torch.as_tensor(phiU, dtype=torch.float64)
+        phiL = torch.as_tensor(phiL, dtype=torch.float64)
+        shape = torch.broadcast_tensors(phiU, phiL)[0].shape
+        K = len(self.mesh.components)
+        target = torch.cat([phiU.expand(shape), phiL.expand(shape)], -1).reshape(-1, 2*K)
+        target = target.detach().cpu().numpy()
+
+        phi = self._solve_linear(target.T, tol).T
+        if self.heat is not None:
+            for step in range(max_iter):
+                effU, effL = self.apply(torch.as_tensor(phi[:, :K]), torch.as_tensor(phi[:, K:]))
+                error = target - torch.cat([effU, effL], -1).numpy()
+                logger.debug("Compensation step %i: error %.3e" % (step, np.abs(error).max()))
+                if np.abs(error).max() < tol:
+                    break
+                phi = phi + self._solve_linear(error.T, tol).T
+            else:
+                raise ValueError("compensation did not converge in %i iterations" % max_iter)
+        phi = torch.as_tensor(phi).reshape(shape[:-1] + (2*K,))
+        return phi[..., :K], phi[..., K:]
+
+    def get_coupled(self, btus):
+        """ BTUs whose effective phases depend on the heaters of btus
+
+        Args:
+            btus (np.ndarray[#btus] (bool)): selected BTUs
+
+        Returns:
+            np.ndarray[#btus] (bool): the selected BTUs and their thermal
+            neighbours
+        """
+        btus = np.asarray(btus, dtype=bool)
+        if not np.isfinite(self.cutoff):
+            return np.full(len(btus), btus.any())
+        hit = np.abs(self.get_matrix()) @ np.concatenate([btus, btus]).astype(np.float64) > 0
+        return btus | hit[:len(btus)] | hit[len(btus):]
+###############################################################################
@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Z-domain (unit-delay) description of the SiROAP square mesh.
+
+With the dispersion model of sip.BTU, the common-mode phase of a BTU,
+
+    phi0(f) = 2*pi*ng*length*f/c - 2*pi*length*(ng - neff)/wl0,
+
+is linear in frequency. When all BTUs share neff, ng and wl0 and their
+lengths are integer multiples of a unit length, the S-matrix of BTU k is
+u**n_k * T_k with u = exp(1j*phi0_unit(f)) the unit delay (z^-1) and T_k
+independent of frequency. Every port-to-port response of the mesh is then
+a rational polynomial N(u)/D(u).
+
+The resonances of the mesh follow from the poles of N(u)/D(u) without a
+sweep: the system matrix I - S(u) G is a matrix polynomial in u, and its
+poles are the inverse eigenvalues of the block companion matrix of that
+polynomial (the round trips of the loops of the mesh). A pole u_p maps to
+one resonance per period c/(ng*length) of the response, at the real part
+of the complex frequency where u = u_p, with a linewidth (FWHM) given by
+its distance from the unit circle. Meshes without commensurate delays are
+handled by a rational (AAA) fit of a sampled response instead.
+
+The code is copyright of Vishal Saxena, 2022 and permission and license is
+required to reuse this code.
+
+@author: vsaxena
+"""
+import logging
+import numpy as np
+import torch
+
+from scipy import linalg
+from scipy import sparse
+from scipy.constants import c
+
+# Import local library
+import siroap_solvers as solvers
+
+
+# diagnostics are logged at DEBUG level, e.g. logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+##############################################################################
+## Helper functions
+##############################################################################
+def _perm_sign(perm):
+    """ sign of a permutation given as an index array """
+    perm = np.asarray(perm)
+    visited = np.zeros(len(perm), dtype=bool)
+    num_cycles = 0
+    for i in range(len(perm)):
+        if not visited[i]:
+            num_cycles += 1
+            while not visited[i]:
+                visited[i] = True
+                i = perm[i]
+    return 1 - 2*((len(perm) - num_cycles) % 2)
+
+
+def _trim(coeffs, tol):
+    """ remove the negligible highest order coefficients (axis 0) """
+    mag = np.abs(coeffs).reshape(coeffs.shape[0], -1).max(1)
+    nonzero = np.where(mag > tol*mag.max())[0]
+    return coeffs[:nonzero[-1] + 1] if len(nonzero) else coeffs[:1]
+
+
+def _aaa(z, F, tol=1e-9, max_terms=100):
+    """ set-valued AAA rational approximation with a common denominator
+
+    Args:
+        z (np.ndarray[#samples]): sample points
+        F (np.ndarray[#samples, #functions]): sampled functions
+        tol (float): relative tolerance of the approximation
+        max_terms (int): largest number of support points
+
+    Returns:
+        poles (np.ndarray[#poles]), residues (np.ndarray[#poles, #functions])
+    """
+    mask = np.ones(len(z), dtype=bool)
+    R = np.broadcast_to(F.mean(0), F.shape)
+    for m in range(1, min(max_terms, len(z) - 1) + 1):
+        j = np.argmax(np.where(mask[:, None], np.abs(F - R), -1).max(1))
+        mask[j] = False
+        zj, fj = z[~mask], F[~mask]
+        C = 1/(z[mask, None] - zj[None, :])
+        A = np.concatenate([(F[mask, k, None] - fj[None, :, k])*C for k in range(F.shape[1])])
+        w = np.linalg.svd(A, full_matrices=False)[2][-1].conj()
+        R = F.copy()
+        R[mask] = (C @ (w[:, None]*fj)) / (C @ w)[:, None]
+        if np.abs(F - R).max() <= tol*np.abs(F).max():
+            break
+
+    # poles: roots of the barycentric denominator, a generalized eigenproblem
+    E = np.zeros((m + 1, m + 1), dtype=np.complex128)
+    E[0, 1:], E[1:, 0], E[1:, 1:] = w, 1, np.diag(zj)
+    B = np.eye(m + 1)
+    B[0, 0] = 0
+    poles = linalg.eigvals(E, B)
+    poles = poles[np.isfinite(poles)]
+    Cp = 1/(poles[:, None] - zj[None, :])
+    residues = (Cp @ (w[:, None]*fj)) / (-(Cp**2) @ w)[:, None]
+    return poles, residues
+
+
+##############################################################################
+## Z-domain Solver
+##############################################################################
+class ZDomainMeshSolver(object):
+    r""" Rational transfer-function engine for meshes with commensurate delays
+
+    The numerator and denominator polynomials of the transmission from every
+    source to every detector are extracted once by initialize(): H(u) and
+    D(u) = det(I - S(u) G) are sampled on the circle |u| = radius with the
+    sparse direct solver and N(u) = H(u) D(u) and D(u) are recovered by FFT.
+    The loops of a passive mesh only resonate on or outside the unit circle,
+    so inside it the system is never singular, even for lossless meshes. After
+    that, any frequency grid is evaluated with polyval only. By default the
+    mesh is first reduced to its coupling BTUs (siroap_solvers.ReducedMeshSolver).
+
+    get_poles() and get_zeros() give the poles and zeros in u directly,
+    get_resonances() the resonance frequencies, linewidths and extinctions.
+
+    If the BTU delays are not commensurate, all calls fall back to the
+    sparse solver.
+    """
+
+    radius = 1 - 1e-3 # radius of the sampling circle of initialize
+
+    def __init__(self, mesh, src_list, det_list, tol=1e-12, reduce=True):
+        """
+        Args:
+            mesh (SqrMesh_NxM): the (unterminated) mesh to solve
+            src_list (list): edge port indices of the sources
+            det_list (list): edge port indices of the detectors
+            tol (float): relative tolerance to trim the polynomial coefficients
+            reduce (bool): collapse the passthrough BTUs before the extraction
+        """
+        self.mesh = mesh
+        self.tol = float(tol)
+        solver = solvers.ReducedMeshSolver if reduce else solvers.SparseMeshSolver
+        self.sparse_solver = solver(mesh, src_list, det_list, chunk_size=1)
+        self.num = None
+        self.den = None
+        self.unit_delay = None
+        self.initialized = False
+
+    @property
+    def src_list(self):
+        return self.sparse_solver.src_list
+
+    @property
+    def det_list(self):
+        return self.sparse_solver.det_list
+
+    @property
+    def detector_names(self):
+        return self.sparse_solver.detector_names
+
+    def get_unit_delay(self):
+        """ unit delay parameters of the mesh
+
+        Returns:
+            dict with the delay multiple 'n' (np.ndarray[#btus]) of every BTU
+            and the unit 'length', 'neff', 'ng' and 'wl0', or None when the
+            BTU delays are not commensurate.
+        """
+        params = {k: v.detach().cpu().numpy() for k, v in self.mesh.get_btu_params().items()}
+        for name in ['neff', 'ng', 'wl0']:
+            if not np.allclose(params[name], params[name][0], rtol=1e-12, atol=0):
+                return None
+        length = params['length'].min()
+        n = params['length']/length
+        if not np.allclose(n, np.round(n), rtol=0, atol=1e-9):
+            return None
+        return {'n': np.round(n).astype(np.int64), 'length': length,
+                'neff': params['neff'][0], 'ng': params['ng'][0], 'wl0': params['wl0'][0]}
+
+    def get_u(self, wl):
+        """ unit delay u = exp(1j*phi0_unit) at the wavelengths wl """
+        d = self.unit_delay
+        neff = d['neff'] - (wl - d['wl0']) * (d['ng'] - d['neff']) / d['wl0']
+        return np.exp(1j * 2 * np.pi * neff * d['length'] / wl)
+
+    def initialize(self):
+        """ extract the numerator and denominator polynomials in u
+
+        Returns:
+            self, with num (np.ndarray[#coeffs, #detectors, #sources]) and
+            den (np.ndarray[#coeffs]) in ascending powers of u.
+        """
+        self.unit_delay = self.get_unit_delay()
+        self.initialized = True
+        if self.unit_delay is None:
+            logger.debug("BTU delays not commensurate, using the sparse solver")
+            self.num = self.den = None
+            return self
+
+        n = self.unit_delay['n']
+        sp = self.sparse_solver.initialize()
+
+        # frequency independent part of the BTU S-matrices: S_k = u**n_k T_k
+        wl = np.array([self.unit_delay['wl0']])
+        T = solvers.get_btu_S(self.mesh, wl)[:, 0] / self.get_u(wl)[0]**n[:, None, None]
+
+        num_samples = self.get_num_samples()
+        u = self.radius * np.exp(2j * np.pi * np.arange(num_samples) / num_samples)
+
+        S = u[None, :, None, None]**n[:, None, None, None] * T[:, None]
+        data, rhs, t = sp.assemble(S)
+
+        H = np.zeros((num_samples, len(sp.det_list), len(sp.src_list)), dtype=np.complex128)
+        logdet = np.zeros(num_samples, dtype=np.complex128)
+        for l in range(num_samples):
+            b = rhs[l:l+1]
+            if sp.num_ports > 0:
+                lu = sp.factorize(data[l:l+1])
+                b = lu.solve(rhs[l])[None]
+                sign = _perm_sign(lu.perm_r) * _perm_sign(lu.perm_c)
+                logdet[l] = np.sum(np.log(lu.U.diagonal().astype(np.complex128))) + np.log(sign + 0j)
+            H[l] = sp.readout(b, t[:, l:l+1])[0]
+
+        # a common scale factor cancels in N/D and keeps D(u) finite
+        D = np.exp(logdet - logdet.real.max())
+        # the FFT gives the coefficients of u**k times radius**k
+        scale = self.radius**-np.arange(num_samples)
+        self.den = _trim(np.fft.fft(D)/num_samples * scale, self.tol)
+        self.num = _trim(np.fft.fft(H * D[:, None, None], axis=0)/num_samples
+                         * scale[:, None, None], self.tol)
+        logger.debug("Extracted N(u) of order %i and D(u) of order %i"
+                     % (len(self.num) - 1, len(self.den) - 1))
+        return self
+
+    def get_num_samples(self):
+        """ number of samples of u on a circle that recover the polynomials in u
+
+        Upper bound of the degrees of N(u), D(u) and of the entries of the
+        system matrix A(u): every BTU port is passed at most once per column
+        of the system, also through the chain weights of the collapsed BTUs.
+        The same bound is used by initialize and get_poles, so that neither
+        aliases.
+        """
+        n = self.unit_delay['n']
+        max_degree = int(4*n.sum() + 4*n.max())
+        return 2**int(np.ceil(np.log2(max_degree + 1)))
+
+    def get_fsr(self):
+        """ period [Hz] of the response in frequency, u advances by 2*pi """
+        return c/(self.unit_delay['ng']*self.unit_delay['length'])
+
+    def to_frequency(self, u):
+        """ complex frequency [Hz] of u (in the period around the wl0 of the BTUs)
+
+        The imaginary part is the half width (half FWHM in power) of a
+        resonance at a pole u.
+        """
+        d = self.unit_delay
+        fsr = self.get_fsr()
+        f0 = fsr*d['length']*(d['ng'] - d['neff'])/d['wl0']
+        f = f0 + fsr*(np.angle(u) - 1j*np.log(np.abs(u)))/(2*np.pi)
+        return f + fsr*np.round((c/d['wl0'] - f.real)/fsr)
+
+    def get_system(self, u):
+        """ system of the (reduced) sparse solver at complex values of u
+
+        Returns:
+            data, rhs, t as in SparseMeshSolver.assemble, along the axis of u
+        """
+        n = self.unit_delay['n']
+        wl = np.array([self.unit_delay['wl0']])
+        T = solvers.get_btu_S(self.mesh, wl)[:, 0] / self.get_u(wl)[0]**n[:, None, None]
+        S = np.asarray(u)[None, :, None, None]**n[:, None, None, None] * T[:, None]
+        return self.sparse_solver.assemble(S)
+
+    def get_poles(self, tol=1e-6):
+        """ poles of the transmission in u, with their residues
+
+        The system matrix A(u) = A_0 - sum_d u**d M_d of the sparse solver is
+        a matrix polynomial in u, its coefficients are recovered by FFT from
+        the roots of unity (as N(u) and D(u) in initialize). With v = 1/u,
+        det A(u) = 0 is the generalized eigenproblem of the block companion
+        pencil
+
+            [M_1  M_2  ...  M_m]         [A_0          ]
+            [I    0    ...  0  ]  =  v   [     I       ]
+            [     ...          ]         [        ...  ]
+
+        whose finite, nonzero eigenvalues v are the inverse poles. A_0 is
+        not inverted, so a singular A_0 (poles at u = 0) is no problem. The residue of
+        H(u) at a pole with right and left null vectors X, Y of A(u_p) is
+        readout(X) (Y^H A'(u_p) X)^-1 Y^H rhs(u_p). Poles that coincide
+        within tol (e.g. the two directions of a ring) share their null
+        space, its residue is given at the first of them and zero at the
+        others.
+
+        Returns:
+            poles (np.ndarray[#poles]), residues
+            (np.ndarray[#poles, #detectors, #sources]) of H(u)
+        """
+        if not self.initialized:
+            self.initialize()
+        if self.num is None:
+            raise ValueError("BTU delays are not commensurate, use get_resonances")
+        sp = self.sparse_solver
+        P = sp.num_ports
+        if P == 0:
+            return np.zeros(0, dtype=np.complex128), np.zeros((0, len(sp.det_list), len(sp.src_list)))
+
+        # matrix coefficients of A(u) in CSC order, (#degrees, nnz)
+        num_samples = self.get_num_samples()
+        data = self.get_system(np.exp(2j*np.pi*np.arange(num_samples)/num_samples))[0]
+        coeffs = _trim(np.fft.fft(data, axis=0)/num_samples, self.tol)
+        def to_dense(values):
+            return sparse.csc_matrix((values, sp._csc_indices, sp._csc_indptr), shape=(P, P)).toarray()
+        A0 = to_dense(coeffs[0])
+        M = [to_dense(-x) for x in coeffs[1:]]
+        m = len(M)
+        if m == 0:
+            return np.zeros(0, dtype=np.complex128), np.zeros((0, len(sp.det_list), len(sp.src_list)))
+
+        E = np.zeros((m*P, m*P), dtype=np.complex128)
+        E[:P] = np.concatenate(M, 1)
+        E[P:, :-P] = np.eye((m - 1)*P)
+        B = np.eye(m*P, dtype=np.complex128)
+        B[:P, :P] = A0
+        v = linalg.eigvals(E, B)
+        v = v[np.isfinite(v)]
+        poles = 1/v[np.abs(v) > self.tol*np.abs(v).max()] if len(v) else v
+        poles = poles[np.argsort(np.abs(poles))]
+
+        residues = np.zeros((len(poles), len(sp.det_list), len(sp.src_list)), dtype=np.complex128)
+        data, rhs, t = self.get_system(poles)
+        dA = coeffs[1:]*np.arange(1, m + 1)[:, None]
+        done = np.zeros(len(poles), dtype=bool)
+        for i, u in enumerate(poles):
+            if done[i]:
+                continue
+            group = np.where(~done & (np.abs(poles - u) <= tol*(1 + np.abs(u))))[0]
+            done[group] = True
+            U, _, Vh = np.linalg.svd(to_dense(data[i]))
+            X, Y = Vh[-len(group):].conj().T, U[:, -len(group):]
+            derivative = to_dense(np.polynomial.polynomial.polyval(u, dA))
+            b = X @ np.linalg.lstsq(Y.conj().T @ derivative @ X, Y.conj().T @ rhs[i], rcond=None)[0]
+            for port, d, chain in sp.detectors:
+                residues[i, d] += t[chain, i] * b[port]
+        return poles, residues
+
+    def get_zeros(self):
+        """ zeros in u of the transmission from every source to every detector
+
+        Returns:
+            list (per detector) of lists (per source) of np.ndarray, the
+            roots of the numerator N(u)
+        """
+        if not self.initialized:
+            self.initialize()
+        if self.num is None:
+            raise ValueError("BTU delays are not commensurate")
+        return [[np.polynomial.polynomial.polyroots(_trim(self.num[:, d, s], self.tol))
+                 for s in range(self.num.shape[2])] for d in range(self.num.shape[1])]
+
+    def get_resonances(self, wl=None, tol=1e-6):
+        """ resonances of the mesh, from the poles of the transmission
+
+        For commensurate delays every pole u_p gives a resonance in every
+        period of the response, no sweep is needed. Otherwise the response
+        of the sparse solver at wl is fitted with a rational function (AAA)
+        and its poles are taken, except for those wider than the range of wl.
+
+        The extinction compares the power at a resonance with the power
+        halfway to the neighbouring resonances (the larger of the two).
+
+        Args:
+            wl (optional, np.ndarray): wavelengths, their frequency range
+                bounds the resonances (and they are the samples of the
+                fit), defaults to the current photontorch environment
+            tol (float): poles whose peak field (residue over distance
+                from the real frequency axis) is below tol at all detectors
+                are not observable and left out
+
+        Returns:
+            dict: the period of the response 'fsr' [Hz] (None for a fitted
+            response) and the 'resonances', sorted by frequency, each a dict
+            with the frequency 'f' [Hz], the 'linewidth' (FWHM) [Hz], the
+            'Q', the 'transmission' [dB] at resonance and the 'extinction'
+            [dB] (np.ndarray[#detectors, #sources])
+        """
+        wl = solvers.get_wavelengths(wl)
+        f = c/wl
+        fmin, fmax = f.min(), f.max()
+        if not self.initialized:
+            self.initialize()
+        if self.num is not None:
+            fsr = self.get_fsr()
+            poles, residues = self.get_poles()
+            peak = np.abs(residues).max((1, 2))/np.maximum(np.abs(np.abs(poles) - 1), 1e-300)
+            f_p = self.to_frequency(poles[peak > tol])
+            # every pole repeats with the period fsr
+            k = np.arange(np.floor((fmin - c/self.unit_delay['wl0'])/fsr) - 2,
+                          np.ceil((fmax - c/self.unit_delay['wl0'])/fsr) + 3)
+            f_p = (f_p[:, None] + fsr*k[None, :]).ravel()
+        else:
+            fsr = None
+            # AAA on a normalized frequency axis
+            f0, scale = (fmax + fmin)/2, (fmax - fmin)/2
+            H = self.sparse_solver.solve(wl)
+            z, residues = _aaa((f - f0)/scale, H.reshape(len(f), -1))
+            peak = np.abs(residues).max(1)/np.maximum(np.abs(z.imag), 1e-300)
+            # poles wider than the samples only shape the background
+            f_p = f0 + scale*z[(peak > tol) & (2*np.abs(z.imag) < 2)]
+        f_p = np.sort_complex(f_p)
+        if len(f_p):
+            # coinciding poles form one resonance
+            f_p = f_p[np.concatenate([[True], np.abs(np.diff(f_p)) > 1e-3*np.abs(f_p[1:].imag)])]
+
+        f_r, width = f_p.real, 2*np.abs(f_p.imag)
+        inside = np.where((f_r >= fmin) & (f_r <= fmax))[0]
+        f_off = [[(f_r[i] + f_r[j])/2 for j in (i - 1, i + 1) if 0 <= j < len(f_r)] or [f_r[i] + 5*width[i]]
+                 for i in inside]
+        freqs = np.concatenate([f_r[inside]] + [np.asarray(x) for x in f_off]) if len(inside) else np.zeros(0)
+        power = 10*np.log10(np.maximum(np.abs(self.solve(c/freqs))**2, 1e-30)) if len(freqs) else None
+
+        resonances = []
+        start = len(inside)
+        for l, i in enumerate(inside):
+            off = power[start:start + len(f_off[l])]
+            start += len(f_off[l])
+            resonances.append({
+                'f': float(f_r[i]),
+                'linewidth': float(width[i]),
+                'Q': float(f_r[i]/width[i]) if width[i] > 0 else np.inf,
+                'transmission': power[l],
+                'extinction': np.abs(power[l] - off).max(0),
+            })
+        logger.info("%i resonances in [%.6e, %.6e] Hz" % (len(resonances), fmin, fmax))
+        return {'fsr': fsr, 'resonances': resonances}
+
+    def solve(self, wl=None):
+        """ complex transmission from every source to every detector
+
+        Args:
+            wl (optional, np.ndarray): wavelengths, defaults to the current
+                photontorch environment
+
+        Returns:
+            np.ndarray[#wavelengths, #detectors, #sources] (complex128)
+        """
+        wl = solvers.get_wavelengths(wl)
+        if not self.initialized:
+            self.initialize()
+        if self.num is None:
+            return self.sparse_solver.solve(wl)
+        u = self.get_u(wl)
+        num = np.polynomial.polynomial.polyval(u, self.num)
+        den = np.polynomial.polynomial.polyval(u, self.den)
+        return np.moveaxis(num / den, -1, 0)
+
+    def forward(self, source=1, wl=None):
+        """ detected power, in the layout of the terminated photontorch network
+
+        Args:
+            source (float|array): field amplitude of each source
+            wl (optional, np.ndarray): wavelengths, defaults to the current
+                photontorch environment
+
+        Returns:
+            Tensor[1, #wavelengths, #detectors, 1]
+        """
+        H = self.solve(wl)
+        source = np.broadcast_to(np.asarray(source, dtype=np.complex128), (H.shape[2],))
+        det = np.abs(H @ source)**2
+        return torch.tensor(det, dtype=torch.get_default_dtype())[None, :, :, None]
+###############################################################################